@@ -20,6 +20,20 @@ interface ComparisonData {
   lit_chunks?: any[]; // From backend, not used in UI yet
 }
 
+// "Stim Params" and "Evidence" cells hold lists of objects (one per parameter set / evidence record)
+const formatCell = (cell: any): string => {
+  if (cell === null || cell === undefined) return 'N/A';
+  if (Array.isArray(cell)) {
+    if (cell.length === 0) return 'N/A';
+    return cell
+      .map((item) => (item && typeof item === 'object'
+        ? Object.values(item).filter((value) => value !== null && value !== undefined).join(', ')
+        : String(item)))
+      .join('; ');
+  }
+  return String(cell);
+};
+
 const ProtocolComparatorPage: React.FC = () => {
   const [availableProtocols, setAvailableProtocols] = useState<ProtocolCardItem[]>([]);
   const [selectedIds, setSelectedIds] = useState<string[]>([]);
@@ -379,7 +393,7 @@ const ProtocolComparatorPage: React.FC = () => {
                           <tr key={rowIndex} className={`${rowIndex % 2 === 0 ? '' : 'bg-gray-50'} hover:bg-gray-100 transition-colors`}>
                             {row.map((cell, cellIndex) => {
                               const columnName = comparisonData?.table?.columns[cellIndex];
-                              const cellData = cell === null || cell === undefined ? 'N/A' : String(cell);
+                              const cellData = formatCell(cell);
 
                               if (columnName === 'DOI' && cellData !== 'N/A' && cellData.startsWith('10.')) { // Basic DOI check
                                 return (
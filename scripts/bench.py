@@ -0,0 +1,305 @@
+"""
+Offline micro-benchmarks for the APGE API and ETL hot paths.
+
+Runs entirely against in-memory fakes (no Neo4j, Redis or OpenAI needed) and writes the results as JSON,
+so two commits can be compared:
+
+    python scripts/bench.py --output bench-results/base.json
+    git checkout my-branch
+    python scripts/bench.py --output bench-results/head.json
+    python scripts/bench.py --compare bench-results/base.json bench-results/head.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+# Same sys.path setup as seed.py, so `src.apge` imports work when run as a script
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+from src.apge import main as apge_main
+from src.apge.etl import GraphDAO, parse_intensity_pct
+
+LIST_SIZES = [10, 1_000, 100_000]
+COMPARE_SIZES = [2, 4, 100]
+ETL_SIZES = [100, 1_000]
+INTENSITY_SIZES = [10_000]
+QUICK_SIZES = 10 # --quick: every benchmark runs once at this size (smoke test)
+
+
+# --- Fakes ---
+
+class FakeRecord:
+    """Mimics neo4j.Record (and the tests' MockNeo4jRecord): item access, get() and data()."""
+
+    def __init__(self, data):
+        self._data = data
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def data(self):
+        return self._data
+
+
+class FakeResult:
+    def single(self):
+        return [None]
+
+    def __iter__(self):
+        return iter(())
+
+
+class FakeTransaction:
+    def run(self, query, *args, **kwargs):
+        return FakeResult()
+
+
+class FakeSession:
+    """Runs each transaction function against a FakeTransaction, so the ETL builds its Cypher and parameters."""
+
+    def execute_write(self, fn, *args, **kwargs):
+        return fn(FakeTransaction(), *args, **kwargs)
+
+    def execute_read(self, fn, *args, **kwargs):
+        return []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class FakeDriver:
+    def session(self):
+        return FakeSession()
+
+
+def make_list_records(n):
+    return [
+        FakeRecord({"id": f"p{i}", "label": f"Protocol {i}", "device": f"Device {i % 7}", "evidence_level": "High"})
+        for i in range(n)
+    ]
+
+
+def make_compare_records(n):
+    """COMPARE_QUERY records: each protocol has two StimParams and three Evidence records."""
+    return [
+        FakeRecord({
+            "protocol_id": f"p{i}", "protocol_name": f"Protocol {i}",
+            "stim_params": [
+                {"frequency": frequency, "intensity": 120.0, "pulses_per_session": 3000, "num_sessions": "20-30",
+                 "device": {"name": f"Device {i % 7}", "coil_type": "Figure-8", "manufacturer": "MagVenture"}}
+                for frequency in ("10 Hz", "iTBS")
+            ],
+            "evidence": [
+                {"level": level, "year": 2015 + j, "title": f"Randomized trial {i}.{j}", "doi": f"10.1000/trial.{i}.{j}"}
+                for j, level in enumerate(("Moderate", "High", "High"))
+            ],
+        })
+        for i in range(n)
+    ]
+
+
+def make_protocol_db(n_symptoms):
+    """protocols.yaml-shaped dict with `n_symptoms` symptoms spread over 10 diagnoses."""
+    db = {}
+    for i in range(n_symptoms):
+        db.setdefault(f"Diagnosis {i % 10}", {})[f"Symptom {i}"] = {
+            "target": f"Target {i % 25}", "frequency": "10 Hz", "intensity": f"{100 + i % 30}% MT",
+            "pulses": 3000, "sessions": "20-30", "evidence": "High", "notes": f"Notes {i}",
+            "references": [f"Author {i} et al., 2020"],
+        }
+    return db
+
+
+# --- Benchmarks ---
+# Each benchmark takes a size, does its setup, and returns the zero-argument callable to time.
+
+def bench_list_cards(n):
+    records = make_list_records(n)
+    return lambda: apge_main.protocol_cards_from_records(records)
+
+
+def bench_list_render(n):
+    cards = apge_main.protocol_cards_from_records(make_list_records(n))
+    return lambda: apge_main.JSONResponse(content=apge_main.jsonable_encoder(cards)).body
+
+
+def bench_list_render_fast(n):
+    # FAST_JSON_RESPONSES: records to dicts to bytes, the counterpart of list_cards + list_render
+    records = make_list_records(n)
+    return lambda: apge_main.dumps(apge_main.protocol_card_dicts_from_records(records))
+
+
+def bench_compare_table(n):
+    records = make_compare_records(n)
+
+    def run():
+        rows = [apge_main.compare_row_from_record(record) for record in records]
+        return [dict(zip(apge_main.COMPARE_TABLE_COLUMNS, row)) for row in rows]
+    return run
+
+
+def bench_compare_prompt(n):
+    rows = [apge_main.compare_row_from_record(record) for record in make_compare_records(n)]
+    protocols_json_list = [dict(zip(apge_main.COMPARE_TABLE_COLUMNS, row)) for row in rows]
+
+    def run():
+        apge_main.narrative_cache_key(protocols_json_list, [])
+        return apge_main.build_narrative_messages(protocols_json_list, [])
+    return run
+
+
+def bench_etl_per_row(n):
+    db = make_protocol_db(n)
+    dao = GraphDAO(FakeDriver())
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()): # process_database prints a completion line
+            dao.process_database(db)
+    return run
+
+
+def bench_etl_bulk(n):
+    db = make_protocol_db(n)
+    dao = GraphDAO(FakeDriver())
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            dao.process_database_bulk(db)
+    return run
+
+
+def bench_parse_intensity(n):
+    values = [f"{80 + i % 60}% {'AMT' if i % 2 else 'MT'}" for i in range(n)]
+    return lambda: [parse_intensity_pct(value) for value in values]
+
+
+BENCHMARKS = [
+    ("list_cards", bench_list_cards, LIST_SIZES),
+    ("list_render", bench_list_render, LIST_SIZES),
+    ("list_render_fast", bench_list_render_fast, LIST_SIZES),
+    ("compare_table", bench_compare_table, COMPARE_SIZES),
+    ("compare_prompt", bench_compare_prompt, COMPARE_SIZES),
+    ("etl_per_row", bench_etl_per_row, ETL_SIZES),
+    ("etl_bulk", bench_etl_bulk, ETL_SIZES),
+    ("parse_intensity", bench_parse_intensity, INTENSITY_SIZES),
+]
+
+
+def time_callable(fn, min_time, min_rounds):
+    """Times `fn` for at least `min_rounds` rounds and `min_time` seconds; returns per-call seconds."""
+    fn() # Warm-up
+    timings = []
+    deadline = time.perf_counter() + min_time
+    while len(timings) < min_rounds or time.perf_counter() < deadline:
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=project_root,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(selected=None, min_time=0.5, min_rounds=3, quick=False):
+    results = {}
+    for name, bench, sizes in BENCHMARKS:
+        if selected and name not in selected:
+            continue
+        for size in ([QUICK_SIZES] if quick else sizes):
+            timings = time_callable(bench(size), 0 if quick else min_time, 1 if quick else min_rounds)
+            key = f"{name}[{size}]"
+            results[key] = {
+                "benchmark": name,
+                "size": size,
+                "rounds": len(timings),
+                "min_s": min(timings),
+                "median_s": statistics.median(timings),
+                "mean_s": statistics.fmean(timings),
+                "per_item_ns": min(timings) / size * 1e9,
+            }
+            print(f"{key:<28} median {results[key]['median_s'] * 1000:10.3f} ms  ({len(timings)} rounds)")
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def compare_results(base, head, threshold_pct):
+    """Prints median changes between two result files; returns the keys that regressed by more than threshold_pct."""
+    regressions = []
+    print(f"{'benchmark':<28} {'base ms':>12} {'head ms':>12} {'change':>9}")
+    for key, head_result in head["results"].items():
+        base_result = base["results"].get(key)
+        if base_result is None:
+            print(f"{key:<28} {'-':>12} {head_result['median_s'] * 1000:12.3f} {'new':>9}")
+            continue
+        change_pct = (head_result["median_s"] / base_result["median_s"] - 1) * 100
+        marker = ""
+        if change_pct > threshold_pct:
+            regressions.append(key)
+            marker = "  REGRESSION"
+        print(f"{key:<28} {base_result['median_s'] * 1000:12.3f} {head_result['median_s'] * 1000:12.3f} "
+              f"{change_pct:+8.1f}%{marker}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the offline APGE micro-benchmarks or compare two result files.")
+    parser.add_argument("--output", help="Write results as JSON to this path (default: bench-results/<commit>.json).")
+    parser.add_argument("--only", nargs="+", choices=[name for name, _, _ in BENCHMARKS], help="Run only these benchmarks.")
+    parser.add_argument("--min-time", type=float, default=0.5, help="Minimum seconds to spend timing each case (default: 0.5).")
+    parser.add_argument("--quick", action="store_true", help=f"Run each benchmark once at size {QUICK_SIZES} (smoke test).")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"), help="Compare two result files instead of running.")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="With --compare, exit non-zero if a median is more than this %% slower (default: 10).")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.compare:
+        base_path, head_path = args.compare
+        with open(base_path) as base_file, open(head_path) as head_file:
+            regressions = compare_results(json.load(base_file), json.load(head_file), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by more than {args.threshold}%.")
+            return 1
+        return 0
+
+    report = run_benchmarks(args.only, min_time=args.min_time, quick=args.quick)
+    output = args.output or os.path.join(project_root, "bench-results", f"{report['meta']['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import os
+import sys
+
+from dotenv import load_dotenv
+
+# Same sys.path setup as seed.py, so `src.apge` imports work when run as a script
+project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, project_root)
+
+# Load the API's settings (Neo4j, Redis, OpenAI) before src.apge.main reads them at import time
+load_dotenv(dotenv_path=os.path.join(project_root, 'src', 'apge', '.env'))
+
+from src.apge import main as apge_main
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate and cache the narratives of the most requested protocol comparisons. "
+                    "Run it after seeding so popular comparisons never hit a cold cache."
+    )
+    parser.add_argument(
+        "--top-k", type=int, default=apge_main.NARRATIVE_PREWARM_TOP_K,
+        help=f"Number of most popular compare sets to warm (default: {apge_main.NARRATIVE_PREWARM_TOP_K})."
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=apge_main.NARRATIVE_PREWARM_CONCURRENCY,
+        help=f"Maximum concurrent LLM calls (default: {apge_main.NARRATIVE_PREWARM_CONCURRENCY})."
+    )
+    return parser.parse_args(argv)
+
+
+async def run(top_k: int, concurrency: int) -> dict:
+    # Runs the API's startup/shutdown (Redis ping, client cleanup) around the pre-warm
+    async with apge_main.lifespan(apge_main.app):
+        return await apge_main.prewarm_narratives(top_k=top_k, concurrency=concurrency)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.top_k < 1 or args.concurrency < 1:
+        print("--top-k and --concurrency must be positive integers.")
+        return 1
+    stats = asyncio.run(run(args.top_k, args.concurrency))
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,8 @@
+import argparse
+import glob
 import os
 import sys
+import time
 import yaml
 from neo4j import GraphDatabase
 from dotenv import load_dotenv
@@ -10,13 +13,47 @@ from dotenv import load_dotenv
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.insert(0, project_root)
 
-from src.apge.etl import GraphDAO
+from src.apge.etl import GraphDAO, DEFAULT_BULK_BATCH_SIZE
 from src.apge.graph_schema import SCHEMA_VERSION, Diagnosis, Symptom, Target, StimParams, Evidence
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Seed the APGE Neo4j graph from protocols.yaml.")
+    parser.add_argument(
+        "--mode", choices=["bulk", "per-row", "sync"], default="bulk",
+        help="bulk: clear and reload with batched UNWIND transactions (default). "
+             "per-row: clear and reload with one transaction per MERGE. "
+             "sync: incremental, hash-based diff that only writes what changed (no clear)."
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=DEFAULT_BULK_BATCH_SIZE,
+        help=f"Rows per UNWIND transaction for the bulk and sync loaders and the literature ingest "
+             f"(default: {DEFAULT_BULK_BATCH_SIZE})."
+    )
+    parser.add_argument(
+        "--literature", action="store_true",
+        help="Also ingest data/studies.json and research_sources/*.bib as Evidence nodes keyed by DOI "
+             "(unchanged entries are skipped)."
+    )
+    return parser.parse_args(argv)
+
+def graph_changed(mode, sync_stats=None, literature_stats=None):
+    """
+    Whether the seed changed the graph. Clearing modes always do; a sync or literature ingest only
+    if it created, updated or deleted something.
+    """
+    if mode != "sync":
+        return True
+    sync_keys = ("nodes_created", "nodes_updated", "nodes_deleted", "relationships_created", "relationships_deleted")
+    literature_keys = ("created", "updated")
+    return any((sync_stats or {}).get(key) for key in sync_keys) or \
+        any((literature_stats or {}).get(key) for key in literature_keys)
+
+def main(argv=None):
     """
     Main function to seed the Neo4j database with protocol data from a YAML file.
     """
+    args = parse_args(argv)
+
     # Construct the absolute path to the .env file
     dotenv_path = os.path.join(project_root, 'src', 'apge', '.env')
     load_dotenv(dotenv_path=dotenv_path)
@@ -70,14 +107,46 @@ def main():
         # Apply schema constraints before clearing or adding data
         dao.apply_schema_constraints()
 
-        print("Clearing existing APGE graph data...")
-        dao.clear_apge_graph()
-        print("Graph data cleared.")
-
-        print("Processing and seeding new data from YAML...")
-        dao.process_database(protocol_data_from_yaml) # This method is in etl.py
+        if args.mode != "sync":
+            print("Clearing existing APGE graph data...")
+            dao.clear_apge_graph()
+            print("Graph data cleared.")
+
+        print(f"Processing and seeding new data from YAML (mode: {args.mode})...")
+        start_time = time.perf_counter()
+        stats, literature_stats = None, None
+        if args.mode == "bulk":
+            stats = dao.process_database_bulk(protocol_data_from_yaml, batch_size=args.batch_size)
+            elapsed = time.perf_counter() - start_time
+            rows_written = stats["nodes"] + stats["relationships"]
+            rows_per_second = rows_written / elapsed if elapsed > 0 else float("inf")
+            print(f"Wrote {rows_written} rows ({stats['nodes']} nodes, {stats['relationships']} relationships) "
+                  f"in {stats['transactions']} transactions, {elapsed:.2f}s ({rows_per_second:.0f} rows/s).")
+        elif args.mode == "sync":
+            stats = dao.sync_database(protocol_data_from_yaml, batch_size=args.batch_size)
+            touched = stats["nodes_created"] + stats["nodes_updated"] + stats["nodes_deleted"]
+            print(f"Incremental sync touched {touched} nodes in {stats['transactions']} transactions, "
+                  f"{time.perf_counter() - start_time:.2f}s.")
+        else:
+            dao.process_database(protocol_data_from_yaml) # This method is in etl.py
+            print(f"Per-row seeding took {time.perf_counter() - start_time:.2f}s.")
+
+        if args.literature:
+            studies_path = os.path.join(project_root, 'data', 'studies.json')
+            bib_paths = sorted(glob.glob(os.path.join(project_root, 'research_sources', '*.bib')))
+            print(f"Ingesting literature from {studies_path} and {len(bib_paths)} BibTeX file(s)...")
+            literature_stats = dao.ingest_literature(studies_path if os.path.exists(studies_path) else None, bib_paths,
+                                                     batch_size=args.batch_size)
+
+        # Tell the API that cached list/compare data derived from the old graph is stale. A new generation
+        # invalidates every cached list and the snapshot, so a sync that changed nothing keeps the old one.
+        if graph_changed(args.mode, stats, literature_stats):
+            dao.bump_graph_generation()
+        else:
+            print("Graph unchanged; keeping the current graph generation.")
 
         print("Seeding process completed successfully.")
+        print("Run scripts/prewarm.py to regenerate the narratives of popular comparisons.")
 
     except Exception as e:
         print(f"An error occurred during the seeding process: {e}")
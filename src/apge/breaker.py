@@ -0,0 +1,152 @@
+import asyncio
+import inspect
+import time
+from typing import Any, Awaitable, Callable
+
+import redis
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(redis.exceptions.ConnectionError):
+    """Raised instead of calling Redis while the breaker is open. A ConnectionError, so existing
+    `except redis.exceptions.RedisError` handlers treat it like any other unavailable-Redis failure."""
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker.
+
+    Closed: calls go through; `failure_threshold` connection failures in a row open the circuit.
+    Open: calls are refused immediately, so an outage costs no socket timeouts.
+    Half-open: `probe()` lets a single health check through; success closes the circuit, failure reopens it.
+    Only used from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 3, clock: Callable[[], float] = time.monotonic):
+        if failure_threshold < 1:
+            raise ValueError(f"failure_threshold must be a positive integer, got {failure_threshold}")
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self._clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+
+    @property
+    def is_closed(self) -> bool:
+        return self.state == CLOSED
+
+    def allow_request(self) -> bool:
+        return self.state == CLOSED
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            print(f"{self.name} circuit closed: connection restored.")
+            self.state = CLOSED
+            self.opened_at = None
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.trip()
+
+    def reset(self):
+        """Back to closed with no failure history, e.g. for a newly created client."""
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    def trip(self):
+        """Opens the circuit now (also used when Redis is already unreachable at startup)."""
+        if self.state == CLOSED:
+            print(f"{self.name} circuit opened after {self.consecutive_failures} consecutive failure(s).")
+            self.times_opened += 1
+        self.state = OPEN
+        self.opened_at = self._clock()
+
+    async def probe(self, health_check: Callable[[], Awaitable[Any]]) -> bool:
+        """Runs `health_check` as the half-open trial call (if the circuit is not closed). Returns whether it is closed."""
+        if self.state == CLOSED:
+            return True
+        self.state = HALF_OPEN
+        try:
+            await health_check()
+        except Exception as e:
+            print(f"{self.name} health check failed: {e}")
+            self.record_failure()
+            return False
+        self.record_success()
+        return True
+
+    async def run_probe_loop(self, health_check: Callable[[], Awaitable[Any]], interval_seconds: float):
+        """Probes every `interval_seconds` while the circuit is open, so recovery needs no restart."""
+        while True:
+            await asyncio.sleep(interval_seconds)
+            if not self.is_closed:
+                await self.probe(health_check)
+
+
+# Failures that say Redis is unreachable. Command errors (e.g. WRONGTYPE) come from a healthy server
+# and must not open the circuit.
+_CONNECTION_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError, OSError, asyncio.TimeoutError)
+
+
+class CircuitBreakerRedis:
+    """
+    Wraps a redis.asyncio client: every command goes through `breaker`, failing fast with CircuitOpenError
+    while it is open and recording connection failures/successes otherwise. A pipeline's execute() is
+    guarded the same way. Anything that is not an awaitable command (attributes, close()) passes straight through.
+    """
+
+    _UNGUARDED = frozenset({"close", "aclose"})
+
+    def __init__(self, client, breaker: CircuitBreaker):
+        self.client = client
+        self.breaker = breaker
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name in self._UNGUARDED:
+            return attribute
+
+        def call(*args, **kwargs):
+            # Commands return a coroutine; building it does no I/O, so it can still be dropped if the circuit is open
+            result = attribute(*args, **kwargs)
+            return self._guard(result) if inspect.isawaitable(result) else result
+        return call
+
+    def pipeline(self, *args, **kwargs) -> "CircuitBreakerPipeline":
+        # A redis.asyncio Pipeline is itself awaitable, so __getattr__ would wrap it as if it were a command
+        return CircuitBreakerPipeline(self.client.pipeline(*args, **kwargs), self)
+
+    async def _guard(self, awaitable):
+        if not self.breaker.allow_request():
+            if inspect.iscoroutine(awaitable):
+                awaitable.close()
+            raise CircuitOpenError(f"{self.breaker.name} circuit is open")
+        try:
+            result = await awaitable
+        except _CONNECTION_ERRORS:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return result
+
+
+class CircuitBreakerPipeline:
+    """A pipeline whose execute() goes through the breaker. Queuing commands does no I/O, so it is not guarded."""
+
+    def __init__(self, pipeline, redis_client: CircuitBreakerRedis):
+        self.pipeline = pipeline
+        self.redis_client = redis_client
+
+    def __getattr__(self, name: str):
+        return getattr(self.pipeline, name)
+
+    async def execute(self, *args, **kwargs):
+        return await self.redis_client._guard(self.pipeline.execute(*args, **kwargs))
@@ -1,11 +1,14 @@
 import os
+import json
+import hashlib
+import uuid
 from dotenv import load_dotenv
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from neo4j import GraphDatabase, Driver, ManagedTransaction, unit_of_work
 from dataclasses import asdict
 
-# Assuming graph_schema.py is in the same directory or PYTHONPATH is set up
-from graph_schema import Diagnosis, Symptom, Target, StimParams, Evidence, SCHEMA_VERSION
+from .graph_schema import Diagnosis, Symptom, Target, StimParams, Evidence, SCHEMA_VERSION
+from .literature import merge_literature_records, normalize_doi
 
 # --- Configuration ---
 # Configuration and database connection details are now primarily managed by scripts/seed.py
@@ -14,6 +17,176 @@ from graph_schema import Diagnosis, Symptom, Target, StimParams, Evidence, SCHEM
 # For clarity, we'll keep it, but the seed script has its own .env loading.
 load_dotenv()
 
+# Number of rows sent per UNWIND transaction by GraphDAO.process_database_bulk
+DEFAULT_BULK_BATCH_SIZE = int(os.getenv("APGE_BULK_BATCH_SIZE", 1000))
+
+# Primary key used to MERGE each node label written by the ETL
+NODE_PRIMARY_KEYS = {
+    "Diagnosis": "name",
+    "Symptom": "name",
+    "Target": "region",
+    "StimParams": "unique_id",
+    "Evidence": "unique_id",
+}
+
+# (from_label, rel_type, to_label) for every relationship written by the ETL.
+# Endpoints are matched on the primary keys in NODE_PRIMARY_KEYS.
+RELATIONSHIP_SPECS = [
+    ("Diagnosis", "HAS_SYMPTOM", "Symptom"),
+    ("Symptom", "TARGETED_BY", "Target"),
+    ("Target", "USUALLY_TREATED_WITH", "StimParams"),
+    ("StimParams", "SUPPORTED_BY", "Evidence"),
+]
+
+
+# Full-text index over Diagnosis name/subtype, queried by the API's /api/diagnosis/search endpoint
+DIAGNOSIS_FULLTEXT_INDEX = "diagnosis_search"
+
+# Evidence nodes ingested from the literature (studies.json, *.bib) are keyed by normalized DOI instead of
+# unique_id, so protocol syncs (which only manage Evidence with a unique_id) never delete them, and
+# clear_apge_graph skips them too (LITERATURE_EVIDENCE_MATCH).
+LITERATURE_EVIDENCE_KEY = "doi"
+LITERATURE_EVIDENCE_MATCH = f"n:Evidence AND n.{LITERATURE_EVIDENCE_KEY} IS NOT NULL AND n.unique_id IS NULL"
+# Level given to literature Evidence; the sources carry no graded level of evidence
+LITERATURE_EVIDENCE_LEVEL = "Literature"
+
+# Singleton node holding the graph generation stamp. It has no schema_version, so clear_apge_graph and
+# sync_database leave it alone; the API compares the stamp to decide when its cached responses are stale.
+GRAPH_META_LABEL = "APGEGraphMeta"
+
+
+def compute_content_hash(properties: Dict[str, Any]) -> str:
+    """
+    Stable hash of a node's properties (plus SCHEMA_VERSION), stored as `content_hash` so that
+    incremental syncs can tell which nodes actually changed. The content_hash key itself is ignored.
+    """
+    hashed_props = {key: value for key, value in properties.items() if key != 'content_hash'}
+    canonical = json.dumps([SCHEMA_VERSION, hashed_props], sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def normalize_lookup(value: Optional[str]) -> Optional[str]:
+    """Normalized form used for the indexed *_norm lookup properties. Must match the API's normalization."""
+    return value.strip().lower() if value is not None else None
+
+
+def parse_intensity_pct(raw_intensity: Any) -> float:
+    """Parses an intensity string such as '120% MT' or '80% AMT' into a float percentage."""
+    return float(str(raw_intensity if raw_intensity is not None else '0% MT').replace('% MT', '').replace('% AMT', '').strip())
+
+
+def build_symptom_entities(diagnosis_name: str, symptom_name: str, params_data: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """
+    Builds the node property dicts for one (diagnosis, symptom) entry of protocols.yaml.
+    Returns a dict keyed by node label. schema_version is left out; it is set by the writers.
+    Each dict carries a `content_hash` of its other properties.
+    """
+    diag_props = asdict(Diagnosis(name=diagnosis_name, name_norm=normalize_lookup(diagnosis_name)))
+    sympt_props = asdict(Symptom(name=symptom_name))
+
+    target_name = params_data.get('target')
+    target_props = asdict(Target(region=target_name)) # Assuming mni_coords might be added later
+
+    stim_params_obj = StimParams(
+        pattern=params_data.get('frequency'), # 'frequency' field seems to map to 'pattern'
+        pulses=params_data.get('pulses'),
+        intensity_pct=parse_intensity_pct(params_data.get('intensity', '0% MT')), # Basic parsing
+        sessions=str(params_data.get('sessions'))
+    )
+    # StimParams has no simple unique 'name', so we derive a unique_id from its core properties for MERGE.
+    stim_unique_id = f"{target_name}_{stim_params_obj.pattern}_{stim_params_obj.pulses}_{stim_params_obj.intensity_pct}_{stim_params_obj.sessions}"
+    stim_params_props = {**asdict(stim_params_obj), "unique_id": stim_unique_id}
+
+    evidence_obj = Evidence(
+        level=params_data.get('evidence'),
+        references=params_data.get('references', []),
+        notes=params_data.get('notes')
+    )
+    # Evidence is assumed to be specific to this StimParams instance, so its unique_id is derived from it.
+    evidence_unique_id = f"ev_{stim_unique_id}_{evidence_obj.level}"
+    if evidence_obj.references: # Add first reference to unique ID if exists
+        evidence_unique_id += f"_{evidence_obj.references[0][:20]}" # first 20 chars of first ref
+    evidence_props = {**asdict(evidence_obj), "unique_id": evidence_unique_id}
+
+    entities = {
+        "Diagnosis": diag_props,
+        "Symptom": sympt_props,
+        "Target": target_props,
+        "StimParams": stim_params_props,
+        "Evidence": evidence_props,
+    }
+    for props in entities.values():
+        props.pop('schema_version', None)
+        props['content_hash'] = compute_content_hash(props)
+    return entities
+
+
+def collect_bulk_rows(db_dict: Dict[str, Any]) -> Tuple[Dict[str, List[Dict[str, Any]]], Dict[Tuple[str, str, str], List[Dict[str, Any]]]]:
+    """
+    Flattens the protocol dict into UNWIND parameter lists.
+
+    Returns (node_rows, rel_rows):
+      node_rows: label -> list of property dicts, deduplicated on the label's primary key
+                 (later entries win, matching the ON MATCH SET behaviour of the per-row loader).
+      rel_rows:  (from_label, rel_type, to_label) -> list of {"from_val": ..., "to_val": ...}, deduplicated.
+    """
+    nodes_by_key: Dict[str, Dict[Any, Dict[str, Any]]] = {label: {} for label in NODE_PRIMARY_KEYS}
+    rels_seen: Dict[Tuple[str, str, str], Dict[Tuple[Any, Any], None]] = {spec: {} for spec in RELATIONSHIP_SPECS}
+
+    for diagnosis_name, symptoms_data in db_dict.items():
+        for symptom_name, params_data in symptoms_data.items():
+            entities = build_symptom_entities(diagnosis_name, symptom_name, params_data)
+            for label, props in entities.items():
+                nodes_by_key[label][props[NODE_PRIMARY_KEYS[label]]] = props
+            for spec in RELATIONSHIP_SPECS:
+                from_label, _, to_label = spec
+                from_val = entities[from_label][NODE_PRIMARY_KEYS[from_label]]
+                to_val = entities[to_label][NODE_PRIMARY_KEYS[to_label]]
+                rels_seen[spec][(from_val, to_val)] = None
+
+    node_rows = {label: list(rows.values()) for label, rows in nodes_by_key.items()}
+    rel_rows = {
+        spec: [{"from_val": from_val, "to_val": to_val} for from_val, to_val in pairs]
+        for spec, pairs in rels_seen.items()
+    }
+    return node_rows, rel_rows
+
+
+def _optional_int(value: Any) -> Optional[int]:
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def literature_evidence_props(record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Maps one merged studies.json / BibTeX record to Evidence properties (with `content_hash`).
+    Authors become `references`; the studies export's protocol and main finding become `notes`.
+    """
+    authors = record.get("authors") or record.get("author")
+    if isinstance(authors, str):
+        authors = [author.strip() for author in authors.split(" and ") if author.strip()]
+    notes = [f"{label}: {record[key]}" for key, label in (("protocol", "Protocol"), ("main_finding", "Main finding")) if record.get(key)]
+    evidence_obj = Evidence(
+        level=LITERATURE_EVIDENCE_LEVEL,
+        references=authors or [],
+        n_participants=_optional_int(record.get("n")),
+        pub_year=_optional_int(record.get("year")),
+        doi=normalize_doi(record.get("doi")),
+        title=record.get("title"),
+        notes="\n".join(notes) or None,
+    )
+    props = asdict(evidence_obj)
+    props.pop('schema_version', None)
+    props['content_hash'] = compute_content_hash(props)
+    return props
+
+
+def _batches(rows: List[Any], batch_size: int):
+    for start in range(0, len(rows), batch_size):
+        yield rows[start:start + batch_size]
+
 
 class GraphDAO:
     def __init__(self, driver: Driver):
@@ -36,7 +209,9 @@ class GraphDAO:
             "CREATE CONSTRAINT IF NOT EXISTS FOR (s:Symptom) REQUIRE s.name IS UNIQUE",
             "CREATE CONSTRAINT IF NOT EXISTS FOR (t:Target) REQUIRE t.region IS UNIQUE",
             "CREATE CONSTRAINT IF NOT EXISTS FOR (sp:StimParams) REQUIRE sp.unique_id IS UNIQUE",
-            "CREATE CONSTRAINT IF NOT EXISTS FOR (e:Evidence) REQUIRE e.unique_id IS UNIQUE"
+            "CREATE CONSTRAINT IF NOT EXISTS FOR (e:Evidence) REQUIRE e.unique_id IS UNIQUE",
+            # Literature Evidence is MERGEd on its normalized DOI (protocol Evidence has none; nulls are not constrained)
+            "CREATE CONSTRAINT IF NOT EXISTS FOR (e:Evidence) REQUIRE e.doi IS UNIQUE"
         ]
         with self.driver.session() as session:
             for query_string in constraint_queries:
@@ -47,14 +222,47 @@ class GraphDAO:
                 except Exception as e:
                     # This might catch errors if the constraint creation fails for reasons other than already existing
                     print(f"Error applying constraint {query_string}: {e}")
+
+        # Lookup indexes: range indexes for exact, case-insensitive Diagnosis filters on the normalized
+        # properties, and a full-text index for diagnosis search/typeahead.
+        index_queries = [
+            "CREATE INDEX diagnosis_name_norm IF NOT EXISTS FOR (d:Diagnosis) ON (d.name_norm)",
+            "CREATE INDEX diagnosis_subtype_norm IF NOT EXISTS FOR (d:Diagnosis) ON (d.subtype_norm)",
+            f"CREATE FULLTEXT INDEX {DIAGNOSIS_FULLTEXT_INDEX} IF NOT EXISTS FOR (d:Diagnosis) ON EACH [d.name, d.subtype]",
+            # Backs the API's keyset pagination of the protocol list, ordered by (name, id)
+            "CREATE INDEX protocol_name_id IF NOT EXISTS FOR (p:Protocol) ON (p.name, p.id)",
+        ]
+        with self.driver.session() as session:
+            for query_string in index_queries:
+                try:
+                    print(f"Applying index: {query_string}")
+                    session.execute_write(self._execute_query, query_string)
+                except Exception as e:
+                    print(f"Error applying index {query_string}: {e}")
         print("Schema constraints application process complete.")
 
+    def bump_graph_generation(self) -> str:
+        """
+        Stamps the graph with a new, unique generation id after a (re)seed. A random id rather than a
+        counter, so a stamp is never reused even if the meta node is deleted and recreated.
+        """
+        generation = uuid.uuid4().hex
+        query = (
+            f"MERGE (m:{GRAPH_META_LABEL} {{name: 'apge'}}) "
+            "SET m.generation = $generation, m.updated_at = datetime()"
+        )
+        with self.driver.session() as session:
+            session.execute_write(self._execute_query, query, {"generation": generation})
+        print(f"Graph generation bumped to {generation}.")
+        return generation
+
     def clear_apge_graph(self):
         print("Clearing existing APGE graph data (Diagnosis, Symptom, Target, StimParams, Evidence nodes and their relationships)...")
         # Detach delete to remove nodes and their relationships
-        # Matches nodes based on schema_version to only remove APGE data
+        # Matches nodes based on schema_version to only remove APGE data; literature Evidence is kept, since
+        # it is ingested separately (ingest_literature) and its hashes let re-ingests skip unchanged entries
         queries = [
-            "MATCH (n) WHERE n.schema_version IS NOT NULL DETACH DELETE n",
+            f"MATCH (n) WHERE n.schema_version IS NOT NULL AND NOT ({LITERATURE_EVIDENCE_MATCH}) DETACH DELETE n",
         ]
         with self.driver.session() as session:
             for query in queries:
@@ -70,10 +278,13 @@ class GraphDAO:
         if prop_str:
             create_prop_str += f", {prop_str}"
 
+        # prop_str is empty for nodes that only carry their primary key (e.g. Diagnosis)
+        match_prop_str = f"{prop_str}, " if prop_str else ""
+
         query = (
             f"MERGE (n:{label} {{{primary_key}: $props.{primary_key}}}) "
             f"ON CREATE SET {create_prop_str}, n.schema_version = $schema_version "
-            f"ON MATCH SET {prop_str}, n.schema_version = $schema_version " # Ensure update on match too, primary key doesn't change
+            f"ON MATCH SET {match_prop_str}n.schema_version = $schema_version " # Ensure update on match too, primary key doesn't change
             "RETURN n"
         )
         
@@ -96,59 +307,236 @@ class GraphDAO:
         tx.run(query, from_val=from_props[from_primary_key], to_val=to_props[to_primary_key])
 
     def process_database(self, db_dict: Dict[str, Any]):
+        """Per-row loader: one write transaction per node and per relationship MERGE."""
         with self.driver.session() as session:
             for diagnosis_name, symptoms_data in db_dict.items():
-                diag_props = asdict(Diagnosis(name=diagnosis_name))
-                
-                session.execute_write(self.add_node_tx, "Diagnosis", diag_props)
-
                 for symptom_name, params_data in symptoms_data.items():
-                    sympt_props = asdict(Symptom(name=symptom_name))
-                    session.execute_write(self.add_node_tx, "Symptom", sympt_props)
-                    session.execute_write(self.add_relationship_tx, "Diagnosis", diag_props, "Symptom", sympt_props, "HAS_SYMPTOM")
-
-                    target_name = params_data.get('target')
-                    target_props = asdict(Target(region=target_name)) # Assuming mni_coords might be added later
-                    session.execute_write(self.add_node_tx, "Target", target_props, primary_key="region")
-                    session.execute_write(self.add_relationship_tx, "Symptom", sympt_props, "Target", target_props, "TARGETED_BY", to_primary_key="region")
-                    
-                    # Create StimParams node properties
-                    stim_params_obj = StimParams(
-                        pattern=params_data.get('frequency'), # 'frequency' field seems to map to 'pattern'
-                        pulses=params_data.get('pulses'),
-                        intensity_pct=float(str(params_data.get('intensity', '0% MT')).replace('% MT', '').replace('% AMT', '').strip()), # Basic parsing
-                        sessions=str(params_data.get('sessions'))
+                    entities = build_symptom_entities(diagnosis_name, symptom_name, params_data)
+                    for label, props in entities.items():
+                        session.execute_write(self.add_node_tx, label, props, primary_key=NODE_PRIMARY_KEYS[label])
+                    for from_label, rel_type, to_label in RELATIONSHIP_SPECS:
+                        session.execute_write(
+                            self.add_relationship_tx,
+                            from_label, entities[from_label], to_label, entities[to_label], rel_type,
+                            from_primary_key=NODE_PRIMARY_KEYS[from_label], to_primary_key=NODE_PRIMARY_KEYS[to_label]
+                        )
+            print("Database processing complete.")
+
+    def process_database_bulk(self, db_dict: Dict[str, Any], batch_size: int = DEFAULT_BULK_BATCH_SIZE) -> Dict[str, int]:
+        """
+        Bulk loader: collects all node and relationship rows up front and writes them with
+        `UNWIND $rows AS row MERGE ...` in transactions of at most `batch_size` rows.
+        All nodes are written before any relationships so that relationship MATCHes find their endpoints.
+        Returns counts of nodes, relationships and transactions written.
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be a positive integer, got {batch_size}")
+
+        node_rows, rel_rows = collect_bulk_rows(db_dict)
+        stats = {"nodes": 0, "relationships": 0, "transactions": 0}
+
+        with self.driver.session() as session:
+            for label, rows in node_rows.items():
+                stats["transactions"] += self._write_node_rows(session, label, rows, batch_size)
+                stats["nodes"] += len(rows)
+
+            for spec, rows in rel_rows.items():
+                stats["transactions"] += self._write_relationship_rows(session, spec, rows, batch_size)
+                stats["relationships"] += len(rows)
+
+        print(f"Bulk database processing complete: {stats['nodes']} nodes, {stats['relationships']} relationships "
+              f"in {stats['transactions']} transactions.")
+        return stats
+
+    def sync_database(self, db_dict: Dict[str, Any], batch_size: int = DEFAULT_BULK_BATCH_SIZE) -> Dict[str, int]:
+        """
+        Incremental loader: diffs the desired graph against the existing one and writes only the changes.
+
+        Nodes are matched on their primary keys (NODE_PRIMARY_KEYS) and compared by `content_hash`;
+        new or changed nodes are upserted, nodes no longer present in `db_dict` are detach-deleted.
+        Relationships are diffed on their endpoint keys. Unlike clear_apge_graph + reload, unchanged
+        data is never removed, so readers keep seeing a complete graph while the sync runs.
+        Returns counts of created/updated/deleted/unchanged nodes and created/deleted relationships.
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be a positive integer, got {batch_size}")
+
+        node_rows, rel_rows = collect_bulk_rows(db_dict)
+        stats = {
+            "nodes_created": 0, "nodes_updated": 0, "nodes_deleted": 0, "nodes_unchanged": 0,
+            "relationships_created": 0, "relationships_deleted": 0, "transactions": 0,
+        }
+
+        with self.driver.session() as session:
+            # Upsert new/changed nodes first so that relationship writes can find their endpoints
+            stale_keys_by_label = {}
+            for label, rows in node_rows.items():
+                primary_key = NODE_PRIMARY_KEYS[label]
+                existing_hashes = {
+                    record["key"]: record["content_hash"]
+                    for record in session.execute_read(
+                        self._execute_query,
+                        f"MATCH (n:{label}) WHERE n.schema_version IS NOT NULL AND n.{primary_key} IS NOT NULL "
+                        f"RETURN n.{primary_key} AS key, n.content_hash AS content_hash"
                     )
-                    stim_params_props = asdict(stim_params_obj)
-                    # StimParams might not have a simple unique 'name'. We need a composite key or unique ID.
-                    # For now, we'll merge based on all its core properties to ensure uniqueness.
-                    # This requires a different add_node_tx or modification.
-                    # Let's define a unique_id for StimParams for simplicity in MERGE.
-                    stim_unique_id = f"{target_name}_{stim_params_obj.pattern}_{stim_params_obj.pulses}_{stim_params_obj.intensity_pct}_{stim_params_obj.sessions}"
-                    stim_params_props_with_id = {**stim_params_props, "unique_id": stim_unique_id}
-
-                    session.execute_write(self.add_node_tx, "StimParams", stim_params_props_with_id, primary_key="unique_id")
-                    session.execute_write(self.add_relationship_tx, "Target", target_props, "StimParams", stim_params_props_with_id, "USUALLY_TREATED_WITH", from_primary_key="region", to_primary_key="unique_id")
-
-                    evidence_obj = Evidence(
-                        level=params_data.get('evidence'),
-                        references=params_data.get('references', []),
-                        notes=params_data.get('notes')
+                }
+                changed_rows = []
+                for row in rows:
+                    key = row[primary_key]
+                    if key not in existing_hashes:
+                        stats["nodes_created"] += 1
+                        changed_rows.append(row)
+                    elif existing_hashes[key] != row["content_hash"]:
+                        stats["nodes_updated"] += 1
+                        changed_rows.append(row)
+                    else:
+                        stats["nodes_unchanged"] += 1
+                desired_keys = {row[primary_key] for row in rows}
+                # A set: the relationship pass below checks every existing pair's endpoints against it
+                stale_keys_by_label[label] = set(existing_hashes) - desired_keys
+                stats["transactions"] += self._write_node_rows(session, label, changed_rows, batch_size)
+
+            for spec, rows in rel_rows.items():
+                from_label, rel_type, to_label = spec
+                existing_pairs = {
+                    (record["from_val"], record["to_val"])
+                    for record in session.execute_read(
+                        self._execute_query,
+                        f"MATCH (a:{from_label})-[:{rel_type}]->(b:{to_label}) "
+                        "WHERE a.schema_version IS NOT NULL AND b.schema_version IS NOT NULL "
+                        f"RETURN a.{NODE_PRIMARY_KEYS[from_label]} AS from_val, b.{NODE_PRIMARY_KEYS[to_label]} AS to_val"
                     )
-                    evidence_props = asdict(evidence_obj)
-                    # Evidence also needs a unique identifier for MERGE if not just linking to one StimParams
-                    # For now, assume evidence is specific to this StimParams instance.
-                    # If evidence can be shared, it needs its own unique properties for MERGE.
-                    # Let's create a unique_id for Evidence as well.
-                    evidence_unique_id = f"ev_{stim_unique_id}_{evidence_obj.level}"
-                    if evidence_obj.references: # Add first reference to unique ID if exists
-                        evidence_unique_id += f"_{evidence_obj.references[0][:20]}" # first 20 chars of first ref
-                    
-                    evidence_props_with_id = {**evidence_props, "unique_id": evidence_unique_id}
-
-                    session.execute_write(self.add_node_tx, "Evidence", evidence_props_with_id, primary_key="unique_id")
-                    session.execute_write(self.add_relationship_tx, "StimParams", stim_params_props_with_id, "Evidence", evidence_props_with_id, "SUPPORTED_BY", from_primary_key="unique_id", to_primary_key="unique_id")
-            print("Database processing complete.")
+                }
+                desired_pairs = {(row["from_val"], row["to_val"]) for row in rows}
+                missing_rows = [row for row in rows if (row["from_val"], row["to_val"]) not in existing_pairs]
+                # Relationships attached to nodes that are about to be deleted go away with DETACH DELETE
+                stale_rows = [
+                    {"from_val": from_val, "to_val": to_val}
+                    for from_val, to_val in existing_pairs - desired_pairs
+                    if from_val not in stale_keys_by_label[from_label] and to_val not in stale_keys_by_label[to_label]
+                ]
+                stats["transactions"] += self._write_relationship_rows(session, spec, missing_rows, batch_size)
+                stats["transactions"] += self._delete_relationship_rows(session, spec, stale_rows, batch_size)
+                stats["relationships_created"] += len(missing_rows)
+                stats["relationships_deleted"] += len(stale_rows)
+
+            for label, stale_keys in stale_keys_by_label.items():
+                primary_key = NODE_PRIMARY_KEYS[label]
+                query = (
+                    "UNWIND $keys AS key "
+                    f"MATCH (n:{label} {{{primary_key}: key}}) WHERE n.schema_version IS NOT NULL "
+                    "DETACH DELETE n"
+                )
+                for batch in _batches(sorted(stale_keys, key=str), batch_size):
+                    session.execute_write(self._execute_query, query, {"keys": batch})
+                    stats["transactions"] += 1
+                stats["nodes_deleted"] += len(stale_keys)
+
+        print(f"Incremental sync complete: {stats['nodes_created']} nodes created, {stats['nodes_updated']} updated, "
+              f"{stats['nodes_deleted']} deleted, {stats['nodes_unchanged']} unchanged; "
+              f"{stats['relationships_created']} relationships created, {stats['relationships_deleted']} deleted.")
+        return stats
+
+    def ingest_literature(self, studies_path: Optional[str], bib_paths: List[str],
+                          batch_size: int = DEFAULT_BULK_BATCH_SIZE) -> Dict[str, int]:
+        """
+        Upserts one Evidence node per DOI from the studies export and BibTeX files.
+
+        Files are stream-parsed and merged by normalized DOI with literature.merge_literature_records, the same
+        routine the retrieval index uses; entries without a DOI are skipped. Rows are compared by `content_hash` with the Evidence
+        already in the graph, and only new or changed ones are written, in UNWIND batches MERGEd on the DOI
+        constraint, so re-running over an unchanged bibliography costs one read and no writes.
+        Returns counts of records read, duplicates merged and Evidence created/updated/unchanged.
+        """
+        if batch_size < 1:
+            raise ValueError(f"batch_size must be a positive integer, got {batch_size}")
+
+        stats = {"records": 0, "duplicates": 0, "created": 0, "updated": 0, "unchanged": 0, "transactions": 0}
+        records, sources = merge_literature_records(studies_path, bib_paths)
+        # Entries without a DOI cannot be keyed in the graph and are skipped
+        merged = {key: record for key, record in records.items() if record["doi"]}
+        stats["records"] = sum(sources[key] for key in merged)
+        stats["duplicates"] = stats["records"] - len(merged)
+
+        with self.driver.session() as session:
+            existing_hashes = {
+                record["key"]: record["content_hash"]
+                for record in session.execute_read(
+                    self._execute_query,
+                    f"MATCH (e:Evidence) WHERE e.{LITERATURE_EVIDENCE_KEY} IS NOT NULL "
+                    f"RETURN e.{LITERATURE_EVIDENCE_KEY} AS key, e.content_hash AS content_hash"
+                )
+            }
+            changed_rows = []
+            for record in merged.values():
+                row = literature_evidence_props(record)
+                key = row[LITERATURE_EVIDENCE_KEY]
+                if key not in existing_hashes:
+                    stats["created"] += 1
+                elif existing_hashes[key] != row["content_hash"]:
+                    stats["updated"] += 1
+                else:
+                    stats["unchanged"] += 1
+                    continue
+                changed_rows.append(row)
+
+            query = (
+                "UNWIND $rows AS row "
+                f"MERGE (e:Evidence {{{LITERATURE_EVIDENCE_KEY}: row.{LITERATURE_EVIDENCE_KEY}}}) "
+                "SET e += row, e.schema_version = $schema_version"
+            )
+            for batch in _batches(changed_rows, batch_size):
+                session.execute_write(self._execute_query, query, {"rows": batch, "schema_version": SCHEMA_VERSION})
+                stats["transactions"] += 1
+
+        print(f"Literature ingest complete: {stats['records']} records ({stats['duplicates']} duplicate DOIs merged), "
+              f"{stats['created']} Evidence created, {stats['updated']} updated, {stats['unchanged']} unchanged "
+              f"in {stats['transactions']} transactions.")
+        return stats
+
+    def _write_node_rows(self, session, label: str, rows: List[Dict[str, Any]], batch_size: int) -> int:
+        """MERGEs `rows` of `label` in UNWIND batches. Returns the number of transactions used."""
+        primary_key = NODE_PRIMARY_KEYS[label]
+        query = (
+            "UNWIND $rows AS row "
+            f"MERGE (n:{label} {{{primary_key}: row.{primary_key}}}) "
+            "SET n += row, n.schema_version = $schema_version"
+        )
+        transactions = 0
+        for batch in _batches(rows, batch_size):
+            session.execute_write(self._execute_query, query, {"rows": batch, "schema_version": SCHEMA_VERSION})
+            transactions += 1
+        return transactions
+
+    def _write_relationship_rows(self, session, spec: Tuple[str, str, str], rows: List[Dict[str, Any]], batch_size: int) -> int:
+        """MERGEs relationship `rows` ({"from_val", "to_val"}) in UNWIND batches. Returns the number of transactions used."""
+        from_label, rel_type, to_label = spec
+        query = (
+            "UNWIND $rows AS row "
+            f"MATCH (a:{from_label} {{{NODE_PRIMARY_KEYS[from_label]}: row.from_val}}) "
+            f"MATCH (b:{to_label} {{{NODE_PRIMARY_KEYS[to_label]}: row.to_val}}) "
+            f"MERGE (a)-[:{rel_type}]->(b)"
+        )
+        transactions = 0
+        for batch in _batches(rows, batch_size):
+            session.execute_write(self._execute_query, query, {"rows": batch})
+            transactions += 1
+        return transactions
+
+    def _delete_relationship_rows(self, session, spec: Tuple[str, str, str], rows: List[Dict[str, Any]], batch_size: int) -> int:
+        """Deletes relationship `rows` ({"from_val", "to_val"}) in UNWIND batches. Returns the number of transactions used."""
+        from_label, rel_type, to_label = spec
+        query = (
+            "UNWIND $rows AS row "
+            f"MATCH (a:{from_label} {{{NODE_PRIMARY_KEYS[from_label]}: row.from_val}})"
+            f"-[r:{rel_type}]->(b:{to_label} {{{NODE_PRIMARY_KEYS[to_label]}: row.to_val}}) "
+            "DELETE r"
+        )
+        transactions = 0
+        for batch in _batches(rows, batch_size):
+            session.execute_write(self._execute_query, query, {"rows": batch})
+            transactions += 1
+        return transactions
 
     # Transactional versions of add_node and add_relationship for use within session.execute_write
     def add_node_tx(self, tx: ManagedTransaction, label: str, properties: Dict[str, Any], primary_key: str = "name"):
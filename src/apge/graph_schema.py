@@ -8,11 +8,17 @@ SCHEMA_VERSION = "1.0"
 class BaseNode:
     # Base class for all nodes in the graph
     # All nodes will have a schema_version field
-    schema_version: str = field(default_factory=lambda: SCHEMA_VERSION)
+    # kw_only so that subclasses can declare required fields after this defaulted one
+    schema_version: str = field(default_factory=lambda: SCHEMA_VERSION, kw_only=True)
 
 @dataclass
 class Diagnosis(BaseNode):
     name: str  # e.g., "PTSD", "Major Depressive Disorder"
+    subtype: Optional[str] = None  # e.g., "Treatment-Resistant"
+    # Normalized (trimmed, lower-cased) copies of name/subtype, written by the ETL so that
+    # case-insensitive lookups can use the range indexes on these properties
+    name_norm: Optional[str] = None
+    subtype_norm: Optional[str] = None
     # Relationships:
     # (:Diagnosis)-[:HAS_SYMPTOM]->(:Symptom)
 
@@ -0,0 +1,206 @@
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, Iterator, Optional, TextIO, Tuple
+
+# Placeholder the literature export writes for fields the BibTeX source does not have
+MISSING_FIELD_PLACEHOLDER = "Information not available in BibTeX"
+
+_DOI_PREFIXES = ("https://doi.org/", "http://doi.org/", "https://dx.doi.org/", "http://dx.doi.org/", "doi:")
+_ENTRY_START = re.compile(r"^\s*@(\w+)\s*\{\s*([^,\s]*)\s*,?")
+_FIELD_START = re.compile(r"\s*(\w+)\s*=\s*")
+# What may follow a number or literal (true/false/null) inside an array
+_SCALAR_END = re.compile(r"[\s,\]]")
+
+
+def normalize_doi(doi: Optional[str]) -> Optional[str]:
+    """Lower-cased DOI without resolver prefixes, e.g. 'https://doi.org/10.1000/ABC' -> '10.1000/abc'."""
+    if not doi:
+        return None
+    doi = doi.strip()
+    for prefix in _DOI_PREFIXES:
+        if doi.lower().startswith(prefix):
+            doi = doi[len(prefix):]
+            break
+    return doi.strip().lower() or None
+
+
+def clean_field(value: Any) -> Any:
+    """Drops the export's 'not available' placeholders so they are treated as missing."""
+    if isinstance(value, str) and value.strip() == MISSING_FIELD_PLACEHOLDER:
+        return None
+    return value
+
+
+def _parse_bibtex_fields(body: str) -> Dict[str, str]:
+    """Parses `name = {value}`, `name = "value"` and `name = 123` fields of one entry body."""
+    fields = {}
+    pos = 0
+    while True:
+        match = _FIELD_START.search(body, pos)
+        if not match:
+            return fields
+        name, pos = match.group(1).lower(), match.end()
+        if pos >= len(body):
+            return fields
+        opener = body[pos]
+        if opener in "{\"":
+            closer, depth, start = ("}" if opener == "{" else "\""), 0, pos + 1
+            pos += 1
+            while pos < len(body):
+                char = body[pos]
+                if char == "{" and opener == "{":
+                    depth += 1
+                elif char == closer and depth == 0:
+                    break
+                elif char == "}" and opener == "{":
+                    depth -= 1
+                pos += 1
+            value = body[start:pos]
+            pos += 1
+        else:
+            end = body.find(",", pos)
+            end = len(body) if end == -1 else end
+            value, pos = body[pos:end], end
+        # Collapse the line wrapping and brace-protection of the source
+        fields[name] = re.sub(r"\s+", " ", value.replace("{", "").replace("}", "")).strip()
+
+
+def iter_bibtex_entries(stream: TextIO) -> Iterator[Dict[str, str]]:
+    """
+    Streams entries from a BibTeX file one at a time, without loading the whole file.
+    Each entry is a dict of its (lower-cased) fields plus `entry_type` and `citation_key`.
+    """
+    header, lines, depth = None, [], 0
+    for line in stream:
+        if header is None:
+            match = _ENTRY_START.match(line)
+            if not match or match.group(1).lower() in ("comment", "preamble", "string"):
+                continue
+            header = match
+            line = line[match.end():]
+            depth = 1
+        depth += line.count("{") - line.count("}")
+        lines.append(line)
+        if depth <= 0:
+            body = "".join(lines)
+            body = body[:body.rfind("}")] # Drop the entry's closing brace
+            entry = _parse_bibtex_fields(body)
+            entry["entry_type"] = header.group(1).lower()
+            entry["citation_key"] = header.group(2)
+            yield entry
+            header, lines = None, []
+
+
+def iter_json_array(stream: TextIO, chunk_size: int = 64 * 1024) -> Iterator[Any]:
+    """
+    Streams the elements of a top-level JSON array, decoding one element at a time from `chunk_size` reads,
+    so memory is bounded by the largest element rather than the whole file.
+    """
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        chunk = stream.read(chunk_size)
+        buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+        return bool(chunk)
+
+    def next_char() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return buffer[pos] if pos < len(buffer) else ""
+
+    if next_char() != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    if next_char() == "]":
+        return
+    while True:
+        if next_char() not in "{[\"":
+            # Numbers and literals have no closing character, and a prefix of one can decode on its own
+            # ("6.5" of "6.5e10"): read up to the delimiter that ends it before decoding
+            while not _SCALAR_END.search(buffer, pos) and fill():
+                pass
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Object or string cut off at the end of the buffer: read more and retry
+            if eof:
+                raise
+            fill()
+            continue
+        pos = end
+        yield element
+        separator = next_char()
+        pos += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or ']' in JSON array, got {separator!r}")
+
+
+def iter_study_records(stream: TextIO) -> Iterator[Dict[str, Any]]:
+    """Streams the records of a studies.json export (a JSON array) with placeholder fields set to None."""
+    for record in iter_json_array(stream):
+        yield {key: clean_field(value) for key, value in record.items()}
+
+
+def _study_doi(record: Dict[str, Any]) -> Optional[str]:
+    """The record's normalized DOI; the studies export's `id` is used when it is a DOI itself."""
+    doi = normalize_doi(record.get("doi"))
+    if not doi:
+        doi = normalize_doi(record.get("id") if isinstance(record.get("id"), str) else None)
+        doi = doi if doi and doi.startswith("10.") else None
+    return doi
+
+
+def bibtex_study_record(entry: Dict[str, str]) -> Dict[str, Any]:
+    """A BibTeX entry as a studies.json-shaped record."""
+    return {
+        "title": entry.get("title"),
+        "journal": entry.get("journal") or entry.get("booktitle") or entry.get("howpublished"),
+        "year": entry.get("year"),
+        "authors": entry.get("author"),
+        "doi": entry.get("doi"),
+    }
+
+
+def merge_literature_records(studies_path: Optional[str], bib_paths: Iterable[str]) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, int]]:
+    """
+    Merges the studies export and then each BibTeX file, streamed entry by entry, into one record per
+    study: records sharing a key are merged field by field, the first non-empty value winning. The key is
+    the normalized DOI, or the study id / citation key for entries without one; each merged record's
+    `doi` is the normalized DOI (None without one). Used by both the graph ingest and the retrieval index,
+    so the two always agree on what a study is.
+    Returns (records by key in first-seen order, number of source entries merged into each). Missing files are skipped.
+    """
+    records: Dict[str, Dict[str, Any]] = {}
+    sources: Dict[str, int] = {}
+
+    def merge(record: Dict[str, Any], fallback_key: Optional[str]):
+        doi = _study_doi(record)
+        key = doi or fallback_key
+        if not key:
+            return
+        sources[key] = sources.get(key, 0) + 1
+        merged = records.setdefault(key, {})
+        for name, value in record.items():
+            if value not in (None, "") and merged.get(name) in (None, ""):
+                merged[name] = value
+        merged["doi"] = doi
+
+    if studies_path and os.path.exists(studies_path):
+        with open(studies_path, encoding="utf-8") as stream:
+            for record in iter_study_records(stream):
+                merge(record, record.get("id"))
+    for bib_path in bib_paths:
+        if not os.path.exists(bib_path):
+            continue
+        with open(bib_path, encoding="utf-8") as stream:
+            for entry in iter_bibtex_entries(stream):
+                merge(bibtex_study_record(entry), entry.get("citation_key"))
+    return records, sources
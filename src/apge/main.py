@@ -1,20 +1,46 @@
-from fastapi import FastAPI, Body, Depends
-from typing import List, Any, Optional
-from pydantic import BaseModel
+from fastapi import FastAPI, Body, Depends, Header, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from typing import List, Any, AsyncIterator, Awaitable, Callable, Literal, Optional, Tuple, Union
+from pydantic import BaseModel, Field
 from neo4j import GraphDatabase, Session as Neo4jSession
 import os
+import asyncio
+import contextlib
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 import json # Added for OpenAI prompt data formatting
-from openai import OpenAI # Added for OpenAI integration
-import redis # Added for Redis caching
+import redis # Added for Redis caching (redis.exceptions)
+import redis.asyncio
 import hashlib # Added for cache key generation
+import base64
+import time
+import uuid
+
+from .breaker import CircuitBreaker, CircuitBreakerRedis
+from .cache import LRUCache
+from .metrics import (CONTENT_TYPE_LATEST, MetricsRegistry, end_request_phases, phase_timer,
+                      server_timing_header, start_request_phases)
+from .narrative_backend import DeadlineNarrativeBackend, NarrativeBackend, NarrativeGenerationError, TemplateNarrativeBackend
+from .narrative_store import NarrativeTTLPolicy, decode_narrative, encode_narrative
+from .prompt import build_compare_prompt
+from .serialization import compress, dumps, negotiate_encoding
+from .singleflight import SingleFlight, acquire_lease, release_lease
+from .snapshot import GraphSnapshot, SnapshotEngine, build_snapshot
 
 # Pydantic Models
 class ProtocolCard(BaseModel):
     id: str
-    label: str
+    label: Optional[str] = None # Protocol nodes without a name are listed last
     device: Optional[str] = None
     evidence_level: Optional[str] = None
 
+class DiagnosisMatch(BaseModel):
+    name: str
+    subtype: Optional[str] = None
+    score: float
+
 class CompareRequest(BaseModel):
     ids: List[str]
 
@@ -27,41 +53,504 @@ class CompareResponse(BaseModel):
     narrative_md: str
     lit_chunks: List[Any] # Define more specifically if lit_chunks structure is known, using Any for now
 
+# layout=columns bodies (see compare_table_payload); only ever produced by the fast path
+class ColumnsTableResponse(BaseModel):
+    columns: List[str]
+    layout: Literal["columns"]
+    data: List[List[Any]] # One list per column, in `columns` order
+
+class CompareColumnsResponse(BaseModel):
+    table: ColumnsTableResponse
+    narrative_md: str
+    lit_chunks: List[Any]
+
+COMPARE_BATCH_MAX_SETS = int(os.getenv("COMPARE_BATCH_MAX_SETS", 50))
+
+class CompareBatchRequest(BaseModel):
+    sets: List[List[str]] = Field(..., max_length=COMPARE_BATCH_MAX_SETS)
+
+class CompareBatchResponse(BaseModel):
+    results: List[CompareResponse] # One per requested set, in request order
+
+class CompareColumnsBatchResponse(BaseModel):
+    results: List[CompareColumnsResponse]
+
+# Fast response path (opt-in): list and compare bodies are built as plain dicts/lists and encoded once
+# with serialization.dumps (orjson when installed) instead of validating a Pydantic model per row.
+# The default row-major bodies are byte-identical to the model path. layout=columns on the compare
+# endpoints always uses it, and compare bodies of at least RESPONSE_COMPRESSION_MIN_BYTES are
+# gzip/brotli-compressed when the client accepts it.
+FAST_JSON_RESPONSES = os.getenv("FAST_JSON_RESPONSES", "false").lower() in ("1", "true", "yes")
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv("RESPONSE_COMPRESSION_MIN_BYTES", 4096))
+COMPARE_LAYOUT_PATTERN = "^(rows|columns)$"
+
+# Metrics
+# Exposed in Prometheus text format on /metrics. PHASE_SECONDS times the parts of a request (cypher,
+# rows, cache_get, cache_set, llm, encode); the same phases are reported per response in the Server-Timing header.
+metrics_registry = MetricsRegistry()
+PHASE_SECONDS = metrics_registry.histogram(
+    "apge_phase_duration_seconds", "Time spent in each request phase.", ["phase"])
+REQUEST_SECONDS = metrics_registry.histogram(
+    "apge_http_request_duration_seconds", "Total request handling time.", ["method", "route"])
+REQUESTS_TOTAL = metrics_registry.counter(
+    "apge_http_requests_total", "Requests handled.", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = metrics_registry.gauge(
+    "apge_http_requests_in_flight", "Requests currently being handled.")
+LLM_REQUESTS_IN_FLIGHT = metrics_registry.gauge(
+    "apge_llm_requests_in_flight", "Narrative LLM calls currently in progress.")
+LLM_TOKENS_TOTAL = metrics_registry.counter(
+    "apge_llm_tokens_total", "LLM tokens used by narrative generation.", ["kind"])
+NARRATIVE_CACHE_LOOKUPS = metrics_registry.counter(
+    "apge_narrative_cache_lookups_total", "Narrative cache lookups by result (local_hit, redis_hit, miss).", ["result"])
+NARRATIVE_PROMPT_TOKENS = metrics_registry.histogram(
+    "apge_narrative_prompt_tokens", "Estimated prompt tokens per narrative LLM request.",
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 8000, 16000))
+NARRATIVE_STORE_BYTES = metrics_registry.counter(
+    "apge_narrative_store_bytes_total", "Narrative bytes written to Redis, before (raw) and after (stored) compression.", ["kind"])
+NARRATIVE_FALLBACKS = metrics_registry.counter(
+    "apge_narrative_fallbacks_total", "Compare narratives answered by the template backend, by reason (deadline, error).", ["reason"])
+NARRATIVE_CACHE_HIT_RATIO = metrics_registry.gauge(
+    "apge_narrative_cache_hit_ratio", "Share of narrative cache lookups served from the local or Redis tier.")
+
+def narrative_cache_hit_ratio() -> float:
+    hits = NARRATIVE_CACHE_LOOKUPS.value(result="local_hit") + NARRATIVE_CACHE_LOOKUPS.value(result="redis_hit")
+    lookups = hits + NARRATIVE_CACHE_LOOKUPS.value(result="miss")
+    return hits / lookups if lookups else 0.0
+
+NARRATIVE_CACHE_HIT_RATIO.set_function(narrative_cache_hit_ratio)
+
+def record_llm_usage(usage):
+    # usage is missing when the API does not report it; only count what it actually reports
+    for kind in ("prompt_tokens", "completion_tokens"):
+        tokens = getattr(usage, kind, None)
+        if isinstance(tokens, int):
+            LLM_TOKENS_TOTAL.inc(tokens, kind=kind.replace("_tokens", ""))
+
 # Redis Client Setup
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD", None)
 
-redis_client = None
-try:
-    temp_redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, db=0, decode_responses=True)
-    temp_redis_client.ping()
-    redis_client = temp_redis_client # Assign to global only if connection successful
-    print("Successfully connected to Redis.")
-except redis.exceptions.ConnectionError as e:
-    print(f"Could not connect to Redis: {e}. Caching will be disabled.")
-    # redis_client remains None
+# Short socket timeouts: a slow or unreachable Redis should cost milliseconds, not a default (unbounded) wait
+REDIS_SOCKET_TIMEOUT_SECONDS = float(os.getenv("REDIS_SOCKET_TIMEOUT_SECONDS", 0.25))
+REDIS_CONNECT_TIMEOUT_SECONDS = float(os.getenv("REDIS_CONNECT_TIMEOUT_SECONDS", 0.25))
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+# Consecutive connection failures before the circuit opens, and how often an open circuit is probed
+REDIS_BREAKER_FAILURE_THRESHOLD = int(os.getenv("REDIS_BREAKER_FAILURE_THRESHOLD", 3))
+REDIS_PROBE_INTERVAL_SECONDS = float(os.getenv("REDIS_PROBE_INTERVAL_SECONDS", 5))
+
+# Async client over a bounded connection pool, so cache round trips never block the event loop.
+# Commands go through a circuit breaker: while Redis is down they fail immediately (CircuitOpenError is a
+# RedisError, so callers degrade as on any Redis error), and a background probe closes the circuit again
+# once Redis answers. Nothing needs a restart after an outage, including one at startup.
+# The pool and client are created by init_redis_client() in the lifespan handler and reset to None when it
+# ends; until then (and in code that never runs the lifespan) redis_client is None and caching is local only.
+# Replies are bytes (decode_responses=False): narratives are stored as compressed binary payloads.
+redis_pool: Optional[redis.asyncio.ConnectionPool] = None
+redis_client: Optional[CircuitBreakerRedis] = None
+redis_breaker = CircuitBreaker("Redis", failure_threshold=REDIS_BREAKER_FAILURE_THRESHOLD)
+
+def init_redis_client() -> CircuitBreakerRedis:
+    global redis_pool, redis_client
+    if redis_client is None:
+        redis_pool = redis.asyncio.ConnectionPool(
+            host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, db=0, decode_responses=False,
+            max_connections=REDIS_MAX_CONNECTIONS,
+            socket_timeout=REDIS_SOCKET_TIMEOUT_SECONDS,
+            socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SECONDS,
+        )
+        redis_breaker.reset() # A new client starts with a closed circuit, whatever happened to the last one
+        redis_client = CircuitBreakerRedis(redis.asyncio.Redis(connection_pool=redis_pool), redis_breaker)
+    return redis_client
+
+def redis_available() -> bool:
+    """False when Redis is not configured or its circuit is open; callers then skip Redis entirely."""
+    return redis_client is not None and redis_breaker.allow_request()
+
+REDIS_CIRCUIT_OPEN = metrics_registry.gauge(
+    "apge_redis_circuit_open", "1 while the Redis circuit breaker is open (Redis calls are skipped), else 0.")
+REDIS_CIRCUIT_OPEN.set_function(lambda: 0.0 if redis_breaker.is_closed else 1.0)
+
+# OpenAI Client Setup
+# One long-lived AsyncOpenAI client per API key, so its HTTP connection pool is reused across requests
+# and many narrative generations can be in flight on one worker.
+# The openai SDK is a third of this module's import time, so it is imported on first use (the lifespan
+# handler imports it in the background after startup) rather than at import.
+AsyncOpenAI = None # openai.AsyncOpenAI once load_openai_sdk() has run
+_openai_client = None
+_openai_client_api_key: Optional[str] = None
+
+def load_openai_sdk():
+    global AsyncOpenAI
+    if AsyncOpenAI is None:
+        from openai import AsyncOpenAI as async_openai_class
+        AsyncOpenAI = async_openai_class
+    return AsyncOpenAI
+
+def get_openai_client(api_key: str):
+    global _openai_client, _openai_client_api_key
+    if _openai_client is None or _openai_client_api_key != api_key:
+        _openai_client = load_openai_sdk()(api_key=api_key)
+        _openai_client_api_key = api_key
+    return _openai_client
 
 # Neo4j Driver Setup
 NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
 NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "password") # Replace with a more secure default or ensure it's always set
 
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+# The sync Neo4j driver blocks on every round trip, so Cypher is run on a dedicated, bounded thread pool
+# instead of the event loop. The pool size caps concurrent queries per worker and should not exceed the
+# driver's connection pool size.
+NEO4J_EXECUTOR_WORKERS = int(os.getenv("NEO4J_EXECUTOR_WORKERS", 32))
+# Bounds the startup/readiness connectivity check (and new connections in general) when Neo4j is slow
+NEO4J_CONNECT_TIMEOUT_SECONDS = float(os.getenv("NEO4J_CONNECT_TIMEOUT_SECONDS", 5))
+
+driver = None # neo4j.Driver, created by get_driver() in the lifespan handler (or on first use)
+neo4j_executor: Optional[ThreadPoolExecutor] = None # Created by get_neo4j_executor(), likewise
+
+def get_neo4j_executor() -> ThreadPoolExecutor:
+    global neo4j_executor
+    if neo4j_executor is None:
+        neo4j_executor = ThreadPoolExecutor(max_workers=NEO4J_EXECUTOR_WORKERS, thread_name_prefix="neo4j")
+    return neo4j_executor
+
+def get_driver():
+    global driver
+    if driver is None:
+        driver = GraphDatabase.driver(
+            NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD),
+            max_connection_pool_size=max(NEO4J_EXECUTOR_WORKERS, 100),
+            connection_timeout=NEO4J_CONNECT_TIMEOUT_SECONDS,
+        )
+    return driver
 
 def get_db() -> Neo4jSession: # Changed type hint for clarity
     session = None
     try:
-        session = driver.session()
+        session = get_driver().session()
         yield session
     finally:
         if session:
             session.close()
 
-app = FastAPI()
+async def run_cypher(db: Neo4jSession, query: str, *args, **kwargs) -> List[Any]:
+    """
+    Runs `db.run(query, *args, **kwargs)` on the Neo4j executor and returns the fully consumed records,
+    so the event loop keeps serving other requests while this one waits on the database.
+    """
+    loop = asyncio.get_running_loop()
+    with phase_timer(PHASE_SECONDS, "cypher"):
+        return await loop.run_in_executor(get_neo4j_executor(), lambda: list(db.run(query, *args, **kwargs)))
+
+# --- Startup and readiness ---
+# The lifespan handler creates the clients and runs the connectivity checks concurrently, recording how
+# long each step took in startup_report (printed once startup finishes and returned by /ready).
+# /ready answers 200 only once startup has finished and the Neo4j pool holds verified, warm connections;
+# Redis is optional (without it narratives are cached locally), so it is reported but not required.
+NEO4J_WARM_CONNECTIONS = int(os.getenv("NEO4J_WARM_CONNECTIONS", 4))
+startup_report = {} # step -> milliseconds
+readiness = {"started": False, "neo4j": False}
+readiness_checks = SingleFlight() # Concurrent /ready probes share one Neo4j check
 
-@app.get("/api/protocol/list", response_model=List[ProtocolCard])
-async def list_protocols(diagnosis: Optional[str] = None, db: Neo4jSession = Depends(get_db)):
+async def timed_startup_step(name: str, step):
+    started = time.perf_counter()
+    try:
+        return await step
+    finally:
+        startup_report[name] = round((time.perf_counter() - started) * 1000, 1)
+
+def warm_neo4j_pool():
+    """Verifies connectivity, then opens NEO4J_WARM_CONNECTIONS pooled connections so early requests skip the handshake."""
+    neo4j_driver = get_driver()
+    neo4j_driver.verify_connectivity()
+    sessions, transactions = [], []
+    try:
+        for _ in range(max(NEO4J_WARM_CONNECTIONS, 1)):
+            # An open explicit transaction holds its connection, so each one adds a connection to the pool
+            sessions.append(neo4j_driver.session())
+            transactions.append(sessions[-1].begin_transaction())
+            transactions[-1].run("RETURN 1").consume()
+    finally:
+        for transaction in transactions:
+            transaction.close()
+        for session in sessions:
+            session.close()
+
+async def check_neo4j() -> bool:
+    try:
+        await asyncio.get_running_loop().run_in_executor(get_neo4j_executor(), warm_neo4j_pool)
+        readiness["neo4j"] = True
+    except Exception as e:
+        print(f"Could not connect to Neo4j: {e}. /ready reports unavailable until it is reachable.")
+        readiness["neo4j"] = False
+    return readiness["neo4j"]
+
+async def check_redis() -> bool:
+    client = init_redis_client()
+    try:
+        await client.ping()
+        print("Successfully connected to Redis.")
+        return True
+    except redis.exceptions.RedisError as e:
+        # Start with the circuit open; the probe loop re-enables caching once Redis is reachable
+        print(f"Could not connect to Redis: {e}. Caching is disabled until it becomes reachable.")
+        redis_breaker.trip()
+        return False
+
+async def start_neo4j_and_snapshot():
+    await timed_startup_step("neo4j", check_neo4j())
+    if graph_snapshot_engine:
+        try:
+            await timed_startup_step("snapshot", graph_snapshot_engine.refresh(force=True))
+        except Exception as e:
+            print(f"Initial graph snapshot load failed: {e}. Serving from Neo4j until a refresh succeeds.")
+        graph_snapshot_engine.start()
+
+async def start_literature_retriever():
+    global literature_retriever
+    try:
+        literature_retriever = await asyncio.get_running_loop().run_in_executor(None, load_literature_retriever)
+    except Exception as e:
+        print(f"Could not load the literature vector index: {e}. Comparisons will not include literature.")
+
+def preload_openai_sdk():
+    try:
+        load_openai_sdk()
+    except ImportError as e:
+        print(f"Could not import the openai SDK: {e}. Narrative generation will fail.")
+
+async def close_clients():
+    """Closes the clients and the Neo4j executor and resets them to None, so a later lifespan in this process creates new ones."""
+    global redis_client, redis_pool, _openai_client, _openai_client_api_key, neo4j_executor, driver
+    if redis_client:
+        await redis_client.close()
+    if redis_pool:
+        await redis_pool.disconnect()
+    redis_client = redis_pool = None
+    if _openai_client:
+        await _openai_client.close()
+    _openai_client = _openai_client_api_key = None
+    if neo4j_executor:
+        neo4j_executor.shutdown(wait=False)
+    neo4j_executor = None
+    if driver:
+        driver.close()
+    driver = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    startup_report.clear()
+    readiness.update(started=False, neo4j=False)
+
+    get_neo4j_executor() # Per lifespan: close_clients() shuts it down
+    # Neo4j (then the snapshot, which reads from it), Redis and the literature index are independent
+    steps = [start_neo4j_and_snapshot(), timed_startup_step("redis", check_redis())]
+    if LIT_RETRIEVAL_ENABLED:
+        steps.append(timed_startup_step("literature", start_literature_retriever()))
+    await asyncio.gather(*steps)
+
+    redis_probe_task = asyncio.create_task(
+        redis_breaker.run_probe_loop(redis_client.client.ping, REDIS_PROBE_INTERVAL_SECONDS)) if redis_client else None
+    prewarm_task = asyncio.create_task(run_prewarm_loop(NARRATIVE_PREWARM_INTERVAL_SECONDS)) \
+        if NARRATIVE_PREWARM_INTERVAL_SECONDS > 0 and redis_client else None
+    decay_task = asyncio.create_task(run_popularity_decay_loop(NARRATIVE_POPULARITY_DECAY_INTERVAL_SECONDS)) \
+        if NARRATIVE_POPULARITY_DECAY_INTERVAL_SECONDS > 0 and redis_client else None
+    # Not awaited: the SDK import finishes in the background instead of delaying startup
+    if os.getenv("OPENAI_API_KEY") and AsyncOpenAI is None:
+        asyncio.get_running_loop().run_in_executor(None, preload_openai_sdk)
+
+    startup_report["total"] = round((time.perf_counter() - started) * 1000, 1)
+    readiness["started"] = True
+    print("Startup complete in " + ", ".join(f"{step} {ms} ms" for step, ms in startup_report.items()) + ".")
+    yield
+    readiness["started"] = False
+    if prewarm_task:
+        prewarm_task.cancel()
+    if decay_task:
+        decay_task.cancel()
+    if isinstance(narrative_backend, DeadlineNarrativeBackend):
+        narrative_backend.cancel_pending()
+    if redis_probe_task:
+        redis_probe_task.cancel()
+    if graph_snapshot_engine:
+        await graph_snapshot_engine.stop()
+    await close_clients()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    phases, token = start_request_phases()
+    started = time.perf_counter()
+    status = 500
+    try:
+        with REQUESTS_IN_FLIGHT.track_inprogress():
+            response = await call_next(request)
+        status = response.status_code
+    finally:
+        end_request_phases(token)
+        elapsed = time.perf_counter() - started
+        # Label by route template, not the raw path, to keep the series count bounded
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        REQUEST_SECONDS.observe(elapsed, method=request.method, route=route)
+        REQUESTS_TOTAL.inc(method=request.method, route=route, status=str(status))
+    # For streamed responses this covers the work done before the first byte
+    response.headers["Server-Timing"] = server_timing_header({**phases, "total": elapsed})
+    return response
+
+@app.get("/ready", include_in_schema=False)
+async def ready():
+    """Readiness probe: 503 until startup has finished and Neo4j is reachable (re-checked while it is not)."""
+    if readiness["started"] and not readiness["neo4j"]:
+        await readiness_checks.do("neo4j", check_neo4j)
+    is_ready = readiness["started"] and readiness["neo4j"]
+    body = {
+        "status": "ready" if is_ready else "unavailable",
+        "checks": {
+            "neo4j": readiness["neo4j"],
+            "redis": redis_breaker.state if redis_client else "disabled",
+            "snapshot": (current_snapshot() is not None) if graph_snapshot_engine else "disabled",
+            "literature": literature_retriever is not None,
+        },
+        "startup_ms": startup_report,
+    }
+    return JSONResponse(content=body, status_code=200 if is_ready else 503)
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(content=metrics_registry.render(), media_type=CONTENT_TYPE_LATEST)
+
+# Graph generation stamp written by GraphDAO.bump_graph_generation at the end of every seed.
+# Responses cached under one generation are ignored once the seeder stamps a new one.
+GRAPH_GENERATION_QUERY = "MATCH (m:APGEGraphMeta {name: 'apge'}) RETURN m.generation AS generation"
+GRAPH_GENERATION_CHECK_SECONDS = float(os.getenv("GRAPH_GENERATION_CHECK_SECONDS", 5))
+
+class GraphGenerationTracker:
+    """Remembers the graph generation stamp, re-reading it from Neo4j at most every `check_interval_seconds`."""
+
+    def __init__(self, check_interval_seconds: float):
+        self.check_interval_seconds = check_interval_seconds
+        self.generation: Optional[str] = None
+        self._checked_at: Optional[float] = None
+
+    async def current(self, db: Neo4jSession) -> Optional[str]:
+        now = time.monotonic()
+        if self._checked_at is None or now - self._checked_at >= self.check_interval_seconds:
+            records = await run_cypher(db, GRAPH_GENERATION_QUERY)
+            self.generation = records[0].get("generation") if records else None
+            self._checked_at = now
+        return self.generation
+
+    def reset(self):
+        self.generation = None
+        self._checked_at = None
+
+graph_generation = GraphGenerationTracker(GRAPH_GENERATION_CHECK_SECONDS)
+
+# Rendered /api/protocol/list bodies, keyed by graph generation and normalized diagnosis
+LIST_CACHE_CONTROL = os.getenv("LIST_CACHE_CONTROL", "public, max-age=0, must-revalidate")
+list_response_cache = LRUCache(
+    max_entries=int(os.getenv("LIST_CACHE_MAX_ENTRIES", 256)),
+    max_bytes=int(os.getenv("LIST_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+    ttl_seconds=float(os.getenv("LIST_CACHE_TTL_SECONDS", 3600)),
+    sizeof=lambda key, value: len(key) + len(value[1]),
+)
+
+def make_etag(body: bytes) -> str:
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match uses weak comparison, so W/ prefixes are ignored."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return any(candidate.removeprefix("W/") == etag for candidate in candidates)
+
+def cached_json_response(body: bytes, etag: str, if_none_match: Optional[str], next_cursor: Optional[str] = None) -> Response:
+    headers = {"ETag": etag, "Cache-Control": LIST_CACHE_CONTROL}
+    if next_cursor:
+        headers[NEXT_CURSOR_HEADER] = next_cursor
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+# --- Pagination and field projection for /api/protocol/list ---
+# Paging is keyset-based on (name, id), the list's sort order, with unnamed protocols last: the opaque
+# cursor encodes the last protocol of the previous page (its name may be null), so each page is a range
+# read instead of an ever-growing SKIP.
+# The body stays a JSON array; the cursor for the next page is returned in the X-Next-Cursor header.
+LIST_FIELDS = ("id", "label", "device", "evidence_level")
+LIST_MAX_LIMIT = int(os.getenv("LIST_MAX_LIMIT", 500))
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def parse_list_fields(fields: Optional[str]) -> Tuple[str, ...]:
+    """Parses `fields=id,label` into the requested ProtocolCard fields, in LIST_FIELDS order."""
+    if fields is None:
+        return LIST_FIELDS
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested - set(LIST_FIELDS)
+    if not requested or unknown:
+        raise HTTPException(status_code=400, detail=f"fields must be a comma-separated subset of {', '.join(LIST_FIELDS)}")
+    return tuple(field for field in LIST_FIELDS if field in requested)
+
+def encode_list_cursor(name: Optional[str], protocol_id: Optional[str]) -> str:
+    raw = json.dumps([name, protocol_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_list_cursor(cursor: str) -> Tuple[Optional[str], str]:
+    try:
+        name, protocol_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not (name is None or isinstance(name, str)) or not isinstance(protocol_id, str):
+            raise ValueError("cursor name must be a string or null, and its id a string")
+        return name, protocol_id
+    except (ValueError, TypeError) as e: # binascii.Error and JSONDecodeError are ValueErrors
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+
+def list_sort_key(name: Optional[str], protocol_id: str) -> tuple:
+    """A protocol's position in the list order: by name with unnamed protocols last, then by id."""
+    return (name is None, name or "", protocol_id or "")
+
+def paginate_records(records: List[Any], limit: Optional[int]) -> Tuple[List[Any], Optional[str]]:
+    """
+    Trims list records (Neo4j records or snapshot cards) fetched with limit + 1 to one page; the extra
+    record only signals that a next page exists. Runs before the fields= projection, which may drop
+    the label and id the cursor is built from.
+    """
+    if limit is None or len(records) <= limit:
+        return records, None
+    last = records[limit - 1]
+    return records[:limit], encode_list_cursor(last["label"], last["id"])
+
+def protocol_cards_from_records(records) -> List[ProtocolCard]:
+    # FastAPI will automatically convert the list of dicts to List[ProtocolCard]
+    # if the keys match the model fields.
+    # .get(): projected queries (fields=) do not return device/evidence_level at all.
+    return [
+        ProtocolCard(
+            id=record["id"],
+            label=record["label"],
+            device=record.get("device"),
+            evidence_level=record.get("evidence_level")
+        ) for record in records
+    ]
+
+def protocol_card_dicts_from_records(records, fields: Tuple[str, ...] = LIST_FIELDS) -> List[dict]:
+    """Fast path: the list body's objects, with only the projected fields, straight from the records."""
+    return [{field: record.get(field) for field in fields} for record in records]
+
+async def query_protocol_cards(db: Neo4jSession, diagnosis: Optional[str], fields: Tuple[str, ...] = LIST_FIELDS,
+                               after: Optional[Tuple[str, str]] = None, limit: Optional[int] = None,
+                               as_dicts: bool = False) -> Tuple[List[Any], Optional[str]]:
+    """
+    Runs the list query and returns one page of protocols with the cursor of the next page (None on
+    the last one). `after` is the decoded (name, id) cursor (name None for an unnamed protocol, which
+    sorts last); with `limit`, limit + 1 protocols are fetched to tell whether there is a next page.
+    With `as_dicts`, the page is projected dicts instead of ProtocolCards.
+    """
     # Base query to fetch protocol details
     # Using OPTIONAL MATCH for device and evidence to ensure protocols are returned even if these are missing
     # Assuming Protocol nodes are labeled :Protocol and have 'id' and 'name' properties
@@ -72,200 +561,238 @@ async def list_protocols(diagnosis: Optional[str] = None, db: Neo4jSession = Dep
     #   (Protocol)-[:HAS_EVIDENCE]->(Evidence)
     #   (Protocol)-[:HAS_INDICATION]->(Diagnosis) where Diagnosis has 'name'
 
-    query_parts = [
-        "MATCH (p:Protocol)",
-        "OPTIONAL MATCH (p)-[:USES_STIMPARAMS]->()-[:DELIVERED_BY]->(dev:Device)",
-        "OPTIONAL MATCH (p)-[:HAS_EVIDENCE]->(e:Evidence)",
-    ]
     params = {}
-
     if diagnosis:
-        query_parts.append("MATCH (p)-[:HAS_INDICATION]->(d:Diagnosis)")
-        # Using toLower for case-insensitive matching on diagnosis name
-        query_parts.append("WHERE toLower(d.name) = toLower($diagnosis) OR toLower(d.subtype) = toLower($diagnosis)")
+        # To ensure we only get protocols that HAVE the indication if diagnosis is specified.
+        # Matching on the ETL-maintained name_norm/subtype_norm properties (instead of toLower(d.name))
+        # lets Neo4j use the diagnosis_name_norm/diagnosis_subtype_norm range indexes.
+        final_query = """
+        MATCH (p:Protocol)-[:HAS_INDICATION]->(d:Diagnosis)
+        WHERE d.name_norm = toLower(trim($diagnosis)) OR d.subtype_norm = toLower(trim($diagnosis))
+        WITH DISTINCT p
+        """ # A protocol matching both its name and subtype must still appear once
         params["diagnosis"] = diagnosis
+    else:
+        final_query = """
+        MATCH (p:Protocol)
+        """
 
-    # Collect distinct protocols with their associated, potentially multiple, devices and evidences
-    # Then, for each protocol, collect its devices and evidences into lists.
-    # This avoids issues with cartesian products from multiple OPTIONAL MATCHes if a protocol has multiple devices/evidences.
-    # However, the schema implies one device and one evidence level per protocol in the output.
-    # For simplicity in this step, we'll take the first device and first evidence found.
-    # A more robust solution might involve collecting and choosing one, or ensuring data model guarantees singularity.
-
-    # Simpler approach: get core protocol info, then device and evidence.
-    # If a protocol is linked to multiple devices or evidences, this will pick one.
-    query_parts.append(
-        "RETURN p.id AS id, p.name AS label, dev.name AS device, e.level AS evidence_level"
-    )
-
-    query = " ".join(query_parts)
-
-    results = db.run(query, params)
-
-    # Process results: due to OPTIONAL MATCH, a protocol might appear multiple times
-    # if it's linked to multiple devices or evidences. We need to consolidate.
-    # However, the target output is one device and one evidence_level per protocol.
-    # The query above will give one row per combination.
-    # Example: P1 -> D1, E1 and P1 -> D1, E2 would give two rows.
-    # We need to be careful. For now, the query is simplified and might need refinement
-    # based on actual graph structure and desired aggregation if multiple are present.
+    # The page is cut before the OPTIONAL MATCHes, so only the protocols on it are expanded
+    # A comparison with a null name is null, so unnamed protocols are handled explicitly on both sides
+    if after is not None and after[0] is None:
+        final_query += """
+        WITH p WHERE p.name IS NULL AND p.id > $after_id
+        """
+        params["after_id"] = after[1]
+    elif after is not None:
+        final_query += """
+        WITH p WHERE p.name IS NULL OR p.name > $after_name OR (p.name = $after_name AND p.id > $after_id)
+        """
+        params["after_name"], params["after_id"] = after
+    if limit is not None:
+        final_query += """
+        WITH p ORDER BY p.name IS NULL, p.name, p.id LIMIT $limit
+        """
+        params["limit"] = limit + 1
 
-    # Given the target output structure, the query should ideally return one row per protocol.
-    # Let's refine the query to achieve that, taking the first found related node.
+    # A protocol linked to several devices or evidences would otherwise appear once per combination,
+    # so the query aggregates to one row per protocol, taking the first device and evidence level found.
     # This is a common simplification if the data model isn't strictly 1-to-1 for these.
-
-    final_query = """
-    MATCH (p:Protocol)
-    OPTIONAL MATCH (p)-[:USES_STIMPARAMS]->()-[:DELIVERED_BY]->(dev:Device)
-    OPTIONAL MATCH (p)-[:HAS_EVIDENCE]->(e:Evidence)
-    WITH p, dev, e
-    """
-
-    filter_clause = ""
-    if diagnosis:
-        # This WHERE clause applies after the OPTIONAL MATCHes for device/evidence,
-        # but before the final RETURN. It filters protocols based on diagnosis.
-        # To ensure we only get protocols that HAVE the indication if diagnosis is specified:
-        final_query = """
-        MATCH (p:Protocol)-[:HAS_INDICATION]->(d:Diagnosis)
-        WHERE toLower(d.name) = toLower($diagnosis) OR (d.subtype IS NOT NULL AND toLower(d.subtype) = toLower($diagnosis))
+    # The OPTIONAL MATCHes are skipped entirely when the fields= projection does not need them.
+    return_columns = ["p.id AS id", "p.name AS label"]
+    if "device" in fields:
+        final_query += """
         OPTIONAL MATCH (p)-[:USES_STIMPARAMS]->()-[:DELIVERED_BY]->(dev:Device)
+        """
+        return_columns.append("COLLECT(DISTINCT dev.name)[0] AS device")
+    if "evidence_level" in fields:
+        final_query += """
         OPTIONAL MATCH (p)-[:HAS_EVIDENCE]->(e:Evidence)
-        WITH p, d, dev, e
-        """ # Ensure d is carried over if needed, or just p
-        params = {"diagnosis": diagnosis}
-    else:
-        params = {}
-
-    final_query += """
-    RETURN p.id AS id, p.name AS label,
-           COLLECT(DISTINCT dev.name)[0] AS device,
-           COLLECT(DISTINCT e.level)[0] AS evidence_level
-    ORDER BY p.name
-    """
+        """
+        return_columns.append("COLLECT(DISTINCT e.level)[0] AS evidence_level")
     # Using COLLECT(DISTINCT ...)[0] to pick one if multiple exist.
     # If dev or e is null for a protocol, their respective fields will be null.
 
-    records = db.run(final_query, params)
+    final_query += f"""
+    RETURN {", ".join(return_columns)}
+    ORDER BY label IS NULL, label, id
+    """
 
-    # FastAPI will automatically convert the list of dicts to List[ProtocolCard]
-    # if the keys match the model fields.
-    protocols_data = [
-        ProtocolCard(
-            id=record["id"],
-            label=record["label"],
-            device=record["device"],
-            evidence_level=record["evidence_level"]
-        ) for record in records
-    ]
-    return protocols_data
+    records, next_cursor = paginate_records(list(await run_cypher(db, final_query, params)), limit)
 
-@app.post("/api/protocol/compare", response_model=CompareResponse)
-async def compare_protocols(request_body: CompareRequest, db: Neo4jSession = Depends(get_db)):
-    if not request_body.ids:
-        # Return a CompareResponse-compatible structure
-        return CompareResponse(
-            table=TableResponse(columns=[], data=[]),
-            narrative_md="No protocol IDs provided for comparison.",
-            lit_chunks=[]
-        )
+    with phase_timer(PHASE_SECONDS, "rows"):
+        if as_dicts:
+            return protocol_card_dicts_from_records(records, fields), next_cursor
+        return protocol_cards_from_records(records), next_cursor
 
-    # Placeholder for vector service call (S-3) - This remains a placeholder for now
-    # print(f"Vector service call for IDs: {request_body.ids} - Placeholder for S-3") # Basic logging
-    lit_chunks_data = [] # Dummy data, actual data would come from vector service
+@app.get("/api/protocol/list", response_model=List[ProtocolCard])
+async def list_protocols(diagnosis: Optional[str] = None, db: Neo4jSession = Depends(get_db),
+                         if_none_match: Optional[str] = Header(None),
+                         limit: Optional[int] = Query(None, ge=1, le=LIST_MAX_LIMIT),
+                         cursor: Optional[str] = None, fields: Optional[str] = None):
+    projection = parse_list_fields(fields)
+    after = decode_list_cursor(cursor) if cursor else None
 
-    # Sort IDs for deterministic cache key
-    sorted_ids = sorted(request_body.ids)
-    ids_string = ",".join(sorted_ids)
-    cache_key = f"narrative:{hashlib.md5(ids_string.encode('utf-8')).hexdigest()}"
+    snapshot = current_snapshot()
+    generation = snapshot.generation if snapshot is not None else await graph_generation.current(db)
+    # Without a generation stamp (graph seeded before stamps existed) nothing is cached,
+    # since there would be no way to tell when the cached body goes stale.
+    cache_key = f"{generation}:{(diagnosis or '').strip().lower()}:{','.join(projection)}:{cursor or ''}:{limit or ''}" if generation else None
+    if cache_key:
+        with phase_timer(PHASE_SECONDS, "cache_get"):
+            cached = list_response_cache.get(cache_key)
+        if cached is not None:
+            etag, body, next_cursor = cached
+            return cached_json_response(body, etag, if_none_match, next_cursor)
 
-    cached_narrative = None
-    if redis_client:
-        try:
-            cached_narrative = redis_client.get(cache_key)
-            if cached_narrative:
-                print(f"Cache hit for key: {cache_key}")
-        except redis.exceptions.RedisError as e:
-            print(f"Redis GET command failed for key {cache_key}: {e}") # Log error, don't let it crash
-            # If Redis fails, proceed as if cache miss, redis_client might be set to None by a more robust health check elsewhere
-            # For now, just log and continue.
+    if snapshot is not None:
+        with phase_timer(PHASE_SECONDS, "rows"):
+            cards = snapshot.list_cards(diagnosis)
+            if after is not None:
+                cards = [card for card in cards if list_sort_key(card["label"], card["id"]) > list_sort_key(*after)]
+            cards, next_cursor = paginate_records(cards[:limit + 1] if limit is not None else cards, limit)
+            if FAST_JSON_RESPONSES:
+                protocols_data = protocol_card_dicts_from_records(cards, projection)
+            else:
+                protocols_data = [ProtocolCard(**card) for card in cards]
+    else:
+        protocols_data, next_cursor = await query_protocol_cards(db, diagnosis, projection, after, limit, as_dicts=FAST_JSON_RESPONSES)
+
+    # Rendered once, so the cached body and its ETag are exactly what clients receive
+    with phase_timer(PHASE_SECONDS, "encode"):
+        if FAST_JSON_RESPONSES:
+            body = dumps(protocols_data)
+        else:
+            include = set(projection) if projection != LIST_FIELDS else None
+            body = JSONResponse(content=jsonable_encoder(protocols_data, include=include)).body
+    etag = make_etag(body)
+    if cache_key:
+        with phase_timer(PHASE_SECONDS, "cache_set"):
+            list_response_cache.set(cache_key, (etag, body, next_cursor))
+    return cached_json_response(body, etag, if_none_match, next_cursor)
 
-    narrative_to_return = cached_narrative # Will be None if cache miss or Redis error
+# Diagnosis typeahead, backed by the full-text index created by the ETL (etl.DIAGNOSIS_FULLTEXT_INDEX)
+DIAGNOSIS_SEARCH_QUERY = """
+CALL db.index.fulltext.queryNodes('diagnosis_search', $query) YIELD node, score
+RETURN node.name AS name, node.subtype AS subtype, score
+ORDER BY score DESC, name
+LIMIT $limit
+"""
+DIAGNOSIS_SEARCH_MAX_LIMIT = 50
 
-    # Cypher query to fetch details for each protocol
-    # Relationships:
-    # (p:Protocol)-[:USES_STIMPARAMS]->(sp:StimParams)
-    # (sp:StimParams)-[:DELIVERED_BY]->(d:Device)
-    # (p:Protocol)-[:HAS_EVIDENCE]->(e:Evidence)
-    query = """
-    UNWIND $ids AS protocol_id
-    MATCH (p:Protocol {id: protocol_id})
-    OPTIONAL MATCH (p)-[:USES_STIMPARAMS]->(sp:StimParams)
-    OPTIONAL MATCH (sp)-[:DELIVERED_BY]->(dev:Device)
-    OPTIONAL MATCH (p)-[:HAS_EVIDENCE]->(e:Evidence)
-    RETURN
-        p.id AS protocol_id,
-        p.name AS protocol_name,
-        sp.pattern AS frequency,         // e.g., "10 Hz", "iTBS"
-        sp.intensity_pct AS intensity,   // e.g., 120.0
-        sp.pulses AS pulses_per_session, // e.g., 3000
-        sp.sessions AS num_sessions,     // e.g., "20-30" or 20
-        dev.name AS device_name,
-        dev.coil_type AS coil_type,
-        dev.manufacturer AS manufacturer,
-        e.level AS evidence_level,
-        e.pub_year AS publication_year,
-        e.title AS publication_title, // New
-        e.doi AS publication_doi      // New
-    """
-
-    results = db.run(query, ids=request_body.ids)
-
-    # Define table columns - this order must match the order of items appended to table_data_rows
-    table_columns_list = [
-        "Protocol Name", "Coil Type", "Frequency", "Intensity",
-        "Pulses/Session", "Sessions", "Evidence Level", "Device Name",
-        "Manufacturer", "Publication Title", "Publication Year", "DOI"
+# Characters with a meaning in Lucene query syntax; escaped so user input is matched literally
+_LUCENE_SPECIAL_CHARS = set('+-&|!(){}[]^"~*?:\\/')
+
+def build_fulltext_query(q: str) -> Optional[str]:
+    """
+    Turns free-text input into a Lucene query: every term must match, either as a prefix (typeahead)
+    or fuzzily (typos). Returns None if the input has no searchable terms.
+    """
+    terms = []
+    for raw_term in q.split():
+        term = "".join(f"\\{char}" if char in _LUCENE_SPECIAL_CHARS else char for char in raw_term)
+        if term:
+            terms.append(f"({term}* OR {term}~)")
+    return " AND ".join(terms) if terms else None
+
+@app.get("/api/diagnosis/search", response_model=List[DiagnosisMatch])
+async def search_diagnoses(q: str = "", limit: int = 10, db: Neo4jSession = Depends(get_db)):
+    query = build_fulltext_query(q)
+    if query is None:
+        return []
+    limit = max(1, min(limit, DIAGNOSIS_SEARCH_MAX_LIMIT))
+    records = await run_cypher(db, DIAGNOSIS_SEARCH_QUERY, {"query": query, "limit": limit})
+    return [
+        DiagnosisMatch(name=record["name"], subtype=record["subtype"], score=record["score"])
+        for record in records
     ]
 
-    table_data_rows = []
-    for record in results:
-        table_data_rows.append([
-            record["protocol_name"],
-            record["coil_type"],
-            record["frequency"],
-            f"{record['intensity']}%" if record['intensity'] is not None else None, # Formatting intensity
-            record["pulses_per_session"],
-            record["num_sessions"],
-            record["evidence_level"],
-            record["device_name"],
-            record["manufacturer"],
-            record["publication_title"], # New
-            record["publication_year"],
-            record["publication_doi"]    # New
-        ])
+# Cypher query to fetch details for each protocol
+# Relationships:
+# (p:Protocol)-[:USES_STIMPARAMS]->(sp:StimParams)
+# (sp:StimParams)-[:DELIVERED_BY]->(d:Device)
+# (p:Protocol)-[:HAS_EVIDENCE]->(e:Evidence)
+# One row per protocol: StimParams (with the first device delivering each) and Evidence are collected
+# with pattern comprehensions, so a protocol with 3 parameter sets and 10 evidence records is still
+# one row instead of 30 (chained OPTIONAL MATCHes return their cross product).
+COMPARE_QUERY = """
+UNWIND $ids AS protocol_id
+MATCH (p:Protocol {id: protocol_id})
+RETURN
+    p.id AS protocol_id,
+    p.name AS protocol_name,
+    [(p)-[:USES_STIMPARAMS]->(sp:StimParams) | {
+        frequency: sp.pattern,               // e.g., "10 Hz", "iTBS"
+        intensity: sp.intensity_pct,         // e.g., 120.0
+        pulses_per_session: sp.pulses,       // e.g., 3000
+        num_sessions: sp.sessions,           // e.g., "20-30" or 20
+        device: head([(sp)-[:DELIVERED_BY]->(dev:Device) | dev {.name, .coil_type, .manufacturer}])
+    }] AS stim_params,
+    [(p)-[:HAS_EVIDENCE]->(e:Evidence) | {level: e.level, year: e.pub_year, title: e.title, doi: e.doi}] AS evidence
+"""
 
-    # Prepare data for LLM
-    protocols_json_list = []
-    for row in table_data_rows:
-        protocol_dict = dict(zip(table_columns_list, row))
-        protocols_json_list.append(protocol_dict)
+# Define table columns - this order must match the order of items appended to the table rows.
+# The scalar columns describe a protocol's first StimParams and its best-ranked Evidence; "Stim Params"
+# and "Evidence" hold the full lists (see compare_row_from_record).
+COMPARE_TABLE_COLUMNS = [
+    "Protocol Name", "Coil Type", "Frequency", "Intensity",
+    "Pulses/Session", "Sessions", "Evidence Level", "Device Name",
+    "Manufacturer", "Publication Title", "Publication Year", "DOI",
+    "Stim Params", "Evidence",
+]
 
-    protocols_details_str = json.dumps(protocols_json_list, indent=2)
-    literature_abstracts_str = "\n\n".join(lit_chunks_data) if lit_chunks_data else "No specific literature abstracts provided for this comparison."
+# Evidence is listed best level first (then newest first); levels not listed here rank last
+EVIDENCE_LEVEL_RANK = {
+    "high": 0, "a": 0,
+    "moderate-high": 1,
+    "moderate": 2, "medium": 2, "b": 2,
+    "low-moderate": 3,
+    "low": 4, "c": 4,
+    "emerging": 5,
+}
 
-    if narrative_to_return is None: # Cache miss or Redis unavailable/error during GET
-        print(f"Cache miss or Redis error for key: {cache_key}. Proceeding to generate narrative.")
-        openai_api_key = os.getenv("OPENAI_API_KEY")
-        if not openai_api_key:
-            print("OPENAI_API_KEY not found. Skipping LLM narrative generation.")
-            narrative_to_return = "Narrative generation is currently unavailable (API key not configured)."
-        elif not protocols_json_list: # Don't call LLM if there's no protocol data
-            narrative_to_return = "No protocol data found to generate a comparison narrative."
-        else:
-            try:
-                client = OpenAI(api_key=openai_api_key)
-                system_prompt = """You are a neuro-psychiatry protocol analyst. Your task is to compare and contrast treatment protocols based on the provided data. Focus on:
+NARRATIVE_MODEL = "gpt-3.5-turbo"
+# Bump whenever NARRATIVE_SYSTEM_PROMPT or the user prompt template changes, so cached narratives
+# produced by the old prompt are no longer served.
+NARRATIVE_PROMPT_VERSION = "2"
+# Upper bound on the (locally estimated) prompt tokens of a narrative request; see prompt.py for what is
+# dropped to stay within it. 0 disables the budget.
+NARRATIVE_PROMPT_TOKEN_BUDGET = int(os.getenv("NARRATIVE_PROMPT_TOKEN_BUDGET", 3000))
+# Redis TTLs follow popularity (narrative_store.NarrativeTTLPolicy): a compare set requested once is
+# cached for the minimum, twice (or of unknown popularity) for NARRATIVE_CACHE_TTL_SECONDS, and every
+# further doubling of its requests adds the difference again, up to the maximum. With a memory budget,
+# Redis' used_memory is sampled and over budget the TTLs shrink and one-off sets are only cached locally.
+NARRATIVE_CACHE_TTL_SECONDS = int(os.getenv("NARRATIVE_CACHE_TTL_SECONDS", 3600)) # Cache for 1 hour
+NARRATIVE_CACHE_MIN_TTL_SECONDS = int(os.getenv("NARRATIVE_CACHE_MIN_TTL_SECONDS", 900))
+NARRATIVE_CACHE_MAX_TTL_SECONDS = int(os.getenv("NARRATIVE_CACHE_MAX_TTL_SECONDS", 7 * 24 * 3600))
+NARRATIVE_REDIS_MEMORY_BUDGET_BYTES = int(os.getenv("NARRATIVE_REDIS_MEMORY_BUDGET_BYTES", 0)) # 0: no budget
+NARRATIVE_MEMORY_CHECK_SECONDS = float(os.getenv("NARRATIVE_MEMORY_CHECK_SECONDS", 60))
+narrative_ttl_policy = NarrativeTTLPolicy(
+    base_ttl=NARRATIVE_CACHE_TTL_SECONDS,
+    min_ttl=NARRATIVE_CACHE_MIN_TTL_SECONDS,
+    max_ttl=NARRATIVE_CACHE_MAX_TTL_SECONDS,
+    memory_budget_bytes=NARRATIVE_REDIS_MEMORY_BUDGET_BYTES,
+    check_interval=NARRATIVE_MEMORY_CHECK_SECONDS,
+)
+
+# In-process tier in front of Redis: hot narratives are served without a network round trip, and
+# narratives are still cached locally while Redis is unreachable.
+narrative_local_cache = LRUCache(
+    max_entries=int(os.getenv("NARRATIVE_LOCAL_CACHE_MAX_ENTRIES", 512)),
+    max_bytes=int(os.getenv("NARRATIVE_LOCAL_CACHE_MAX_BYTES", 8 * 1024 * 1024)),
+    ttl_seconds=float(os.getenv("NARRATIVE_LOCAL_CACHE_TTL_SECONDS", 600)),
+)
+
+# Single-flight coalescing of narrative generation: concurrent misses for the same cache key share one
+# LLM call within a worker (narrative_flights), and across workers through a Redis lock with a lease.
+NARRATIVE_LOCK_LEASE_MS = int(os.getenv("NARRATIVE_LOCK_LEASE_MS", 30000))
+NARRATIVE_LOCK_POLL_SECONDS = float(os.getenv("NARRATIVE_LOCK_POLL_SECONDS", 0.1))
+narrative_flights = SingleFlight()
+# Bounds each LLM call, including ones finishing in the background after a missed deadline. Kept within
+# the lease, so a slow call does not outlive the lock that keeps other workers from repeating it.
+NARRATIVE_LLM_TIMEOUT_SECONDS = float(os.getenv("NARRATIVE_LLM_TIMEOUT_SECONDS", NARRATIVE_LOCK_LEASE_MS / 1000))
+
+NARRATIVE_SYSTEM_PROMPT = """You are a neuro-psychiatry protocol analyst. Your task is to compare and contrast treatment protocols based on the provided data. Focus on:
 1.  Coil physics and its implications (e.g., focality, depth of penetration).
 2.  Session burden on patients (e.g., frequency, duration, total number of sessions).
 3.  Strength of clinical evidence (e.g., study types, sample sizes, effect sizes if available, level of evidence).
@@ -275,43 +802,872 @@ Structure your output as three distinct paragraphs addressing these aspects.
 Conclude with a single, concise "Clinical Pearl" (1 sentence) offering a practical takeaway for a clinician choosing between these protocols.
 Format the output as Markdown.
 """
-            user_prompt = f"""Here are {len(protocols_json_list)} protocols as JSON:
-```json
-{protocols_details_str}
-```
 
-And here are {len(lit_chunks_data)} literature abstracts:
-```text
-{literature_abstracts_str}
-```
+# Fixed narratives returned instead of an LLM completion. These are never cached.
+NO_IDS_NARRATIVE = "No protocol IDs provided for comparison."
+API_KEY_MISSING_NARRATIVE = "Narrative generation is currently unavailable (API key not configured)."
+NO_PROTOCOL_DATA_NARRATIVE = "No protocol data found to generate a comparison narrative."
+NARRATIVE_ERROR = "Error generating narrative. Please try again later."
+
+def narrative_cache_key(protocols_json_list: List[dict], lit_chunks_data: List[Any]) -> str:
+    """
+    Content-addressed key: a hash of exactly what the prompt is built from (the protocol rows and
+    literature chunks) plus the prompt version, token budget and model. A different budget can trim
+    different rows or chunks, so it gets its own narratives. A reseed that changes a protocol's data
+    changes its key, while comparisons whose data is unchanged keep their cached narrative.
+    Rows are sorted so the key does not depend on the order of the requested IDs.
+    """
+    canonical_rows = sorted(json.dumps(row, sort_keys=True, default=str, separators=(",", ":")) for row in protocols_json_list)
+    canonical = json.dumps({
+        "prompt_version": NARRATIVE_PROMPT_VERSION,
+        "prompt_token_budget": NARRATIVE_PROMPT_TOKEN_BUDGET,
+        "model": NARRATIVE_MODEL,
+        "protocols": canonical_rows,
+        "lit_chunks": lit_chunks_data,
+    }, sort_keys=True, default=str, separators=(",", ":"))
+    return f"narrative:{hashlib.md5(canonical.encode('utf-8')).hexdigest()}"
+
+def evidence_rank_key(evidence: dict) -> tuple:
+    """Sort key ranking Evidence by level (EVIDENCE_LEVEL_RANK), then newest publication year."""
+    level_rank = EVIDENCE_LEVEL_RANK.get(str(evidence.get("level") or "").strip().lower(), len(EVIDENCE_LEVEL_RANK))
+    try:
+        year = int(evidence.get("year"))
+    except (TypeError, ValueError):
+        year = None
+    return (level_rank, year is None, -(year or 0), str(evidence.get("title") or ""), str(evidence.get("doi") or ""))
+
+def _canonical(value: Any) -> str:
+    return json.dumps(value, sort_keys=True, default=str, separators=(",", ":"))
+
+def compare_row_from_record(record) -> List[Any]:
+    """
+    One compare table row per protocol record (COMPARE_TABLE_COLUMNS order). StimParams are de-duplicated
+    and sorted so the row (and the narrative cache key derived from it) does not depend on graph order.
+    """
+    stim_params = []
+    for params in record["stim_params"] or []:
+        device = params.get("device") or {}
+        stim_params.append({
+            "frequency": params.get("frequency"),
+            "intensity": f"{params['intensity']}%" if params.get("intensity") is not None else None, # Formatting intensity
+            "pulses_per_session": params.get("pulses_per_session"),
+            "sessions": params.get("num_sessions"),
+            "device_name": device.get("name"),
+            "coil_type": device.get("coil_type"),
+            "manufacturer": device.get("manufacturer"),
+        })
+    stim_params = [json.loads(entry) for entry in sorted({_canonical(params) for params in stim_params})]
+    evidence = sorted(
+        {_canonical(dict(entry)): dict(entry) for entry in record["evidence"] or []}.values(),
+        key=evidence_rank_key,
+    )
+    primary = stim_params[0] if stim_params else {}
+    best = evidence[0] if evidence else {}
+    return [
+        record["protocol_name"],
+        primary.get("coil_type"),
+        primary.get("frequency"),
+        primary.get("intensity"),
+        primary.get("pulses_per_session"),
+        primary.get("sessions"),
+        best.get("level"),
+        primary.get("device_name"),
+        primary.get("manufacturer"),
+        best.get("title"), # New
+        best.get("year"),
+        best.get("doi"),   # New
+        stim_params,
+        evidence,
+    ]
+
+async def fetch_compare_rows(db: Neo4jSession, ids: List[str]) -> List[List[Any]]:
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        with phase_timer(PHASE_SECONDS, "rows"):
+            return snapshot.compare_rows(ids)
+    results = await run_cypher(db, COMPARE_QUERY, ids=ids)
+    with phase_timer(PHASE_SECONDS, "rows"):
+        return [compare_row_from_record(record) for record in results]
+
+async def fetch_compare_rows_by_id(db: Neo4jSession, ids: List[str]) -> dict:
+    """Compare table rows for each of `ids` (protocol id -> rows), fetched with a single UNWIND query."""
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        return {protocol_id: snapshot.compare_rows_by_id.get(protocol_id, []) for protocol_id in ids}
+    results = await run_cypher(db, COMPARE_QUERY, ids=ids)
+    with phase_timer(PHASE_SECONDS, "rows"):
+        rows_by_id = {protocol_id: [] for protocol_id in ids}
+        for record in results:
+            rows_by_id[record["protocol_id"]].append(compare_row_from_record(record))
+        return rows_by_id
 
-Please provide a 3-paragraph compare-and-contrast analysis focusing on coil physics, session burden, and evidence strength, followed by a 1-sentence clinical pearl.
+# --- Graph snapshot engine (optional) ---
+# When APGE_SNAPSHOT_ENABLED is set, the list and compare-table data is loaded into memory at startup
+# and served from there; Neo4j stays the source of truth and the snapshot is reloaded when the seed
+# generation changes (checked every APGE_SNAPSHOT_REFRESH_SECONDS) or after APGE_SNAPSHOT_MAX_AGE_SECONDS.
+SNAPSHOT_ENABLED = os.getenv("APGE_SNAPSHOT_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Like the list query, but unfiltered and carrying each protocol's normalized diagnosis names/subtypes
+SNAPSHOT_LIST_QUERY = """
+MATCH (p:Protocol)
+OPTIONAL MATCH (p)-[:USES_STIMPARAMS]->()-[:DELIVERED_BY]->(dev:Device)
+OPTIONAL MATCH (p)-[:HAS_EVIDENCE]->(e:Evidence)
+OPTIONAL MATCH (p)-[:HAS_INDICATION]->(d:Diagnosis)
+RETURN p.id AS id, p.name AS label,
+       COLLECT(DISTINCT dev.name)[0] AS device,
+       COLLECT(DISTINCT e.level)[0] AS evidence_level,
+       COLLECT(DISTINCT toLower(d.name)) + COLLECT(DISTINCT toLower(d.subtype)) AS diagnosis_keys
+ORDER BY label IS NULL, label, id
 """
-                chat_completion = client.chat.completions.create(
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt},
-                    ],
-                    model="gpt-3.5-turbo",
-                )
-                narrative_to_return = chat_completion.choices[0].message.content
-
-                # Cache the new narrative if successfully generated and Redis is available
-                if redis_client and narrative_to_return and \
-                   not narrative_to_return.startswith("Error") and \
-                   not narrative_to_return.startswith("Narrative generation is currently unavailable") and \
-                   not narrative_to_return.startswith("No protocol data found"):
-                    try:
-                        redis_client.set(cache_key, narrative_to_return, ex=3600) # Cache for 1 hour
-                        print(f"Cached new narrative for key: {cache_key}")
-                    except redis.exceptions.RedisError as e:
-                        print(f"Redis SET command failed for key {cache_key}: {e}") # Log error, don't let it crash
-            except Exception as e:
-                print(f"OpenAI API call failed: {e}")
-                narrative_to_return = "Error generating narrative. Please try again later."
 
+async def load_graph_generation() -> Optional[str]:
+    def load():
+        with get_driver().session() as session:
+            record = session.run(GRAPH_GENERATION_QUERY).single()
+            return record.get("generation") if record else None
+    return await asyncio.get_running_loop().run_in_executor(get_neo4j_executor(), load)
+
+async def load_graph_snapshot(generation: Optional[str]) -> GraphSnapshot:
+    def load():
+        with get_driver().session() as session:
+            list_records = list(session.run(SNAPSHOT_LIST_QUERY))
+            ids = [record["id"] for record in list_records]
+            compare_records = list(session.run(COMPARE_QUERY, ids=ids))
+        return build_snapshot(
+            generation,
+            list_records,
+            ((record["protocol_id"], compare_row_from_record(record)) for record in compare_records),
+        )
+    return await asyncio.get_running_loop().run_in_executor(get_neo4j_executor(), load)
+
+graph_snapshot_engine: Optional[SnapshotEngine] = SnapshotEngine(
+    load_generation=load_graph_generation,
+    load_snapshot=load_graph_snapshot,
+    refresh_interval_seconds=float(os.getenv("APGE_SNAPSHOT_REFRESH_SECONDS", 30)),
+    max_age_seconds=float(os.getenv("APGE_SNAPSHOT_MAX_AGE_SECONDS", 3600)),
+) if SNAPSHOT_ENABLED else None
+
+def current_snapshot() -> Optional[GraphSnapshot]:
+    """The loaded snapshot, or None if the engine is disabled or has not loaded yet (callers query Neo4j)."""
+    return graph_snapshot_engine.snapshot if graph_snapshot_engine else None
+
+def build_narrative_prompt(protocols_json_list: List[dict], lit_chunks_data: List[Any]) -> Tuple[List[dict], dict]:
+    """Chat messages for the narrative within NARRATIVE_PROMPT_TOKEN_BUDGET, and the prompt report (prompt.py)."""
+    return build_compare_prompt(NARRATIVE_SYSTEM_PROMPT, protocols_json_list, lit_chunks_data, NARRATIVE_PROMPT_TOKEN_BUDGET)
+
+def build_narrative_messages(protocols_json_list: List[dict], lit_chunks_data: List[Any]) -> List[dict]:
+    return build_narrative_prompt(protocols_json_list, lit_chunks_data)[0]
+
+def record_prompt_report(cache_key: str, report: dict):
+    NARRATIVE_PROMPT_TOKENS.observe(report["prompt_tokens"])
+    trimmed = []
+    if report["lit_chunks_dropped"]:
+        trimmed.append(f"{report['lit_chunks_dropped']} literature chunk(s)")
+    if report["fields_dropped"]:
+        trimmed.append(", ".join(report["fields_dropped"]))
+    if report["best_evidence_only"]:
+        trimmed.append("evidence beyond each protocol's best")
+    print(f"Narrative prompt for key {cache_key}: ~{report['prompt_tokens']} tokens"
+          + (f" (budget {report['token_budget']}; dropped {'; '.join(trimmed)})" if trimmed else "")
+          + ("" if report["within_budget"] else " - still over budget"))
+
+def is_cacheable_narrative(narrative: Optional[str]) -> bool:
+    return bool(narrative) and \
+        not narrative.startswith("Error") and \
+        not narrative.startswith("Narrative generation is currently unavailable") and \
+        not narrative.startswith("No protocol data found")
+
+def read_narrative_payload(cache_key: str, payload: Any) -> Optional[str]:
+    """The narrative in a Redis value, or None (a cache miss) if the value cannot be decoded."""
+    try:
+        narrative, _ = decode_narrative(payload)
+        return narrative
+    except ValueError as e:
+        print(f"Ignoring unreadable cached narrative for key {cache_key}: {e}")
+        return None
+
+# A compare set's popularity is passed as its count, or as a zero-argument coroutine function returning it
+# (PopularityBump.hits), which is only called where the count is needed: for a Redis TTL.
+HitsSource = Union[None, float, Callable[[], Awaitable[Optional[float]]]]
+
+async def resolve_hits(hits: HitsSource) -> Optional[float]:
+    return await hits() if callable(hits) else hits
+
+async def refresh_narrative_ttls(hits_by_key: dict):
+    """Re-sets the Redis TTL of narratives that were just read from their current popularity, so hot ones are extended."""
+    hits_by_key = {cache_key: await resolve_hits(hits) for cache_key, hits in hits_by_key.items()}
+    keys = [cache_key for cache_key, hits in hits_by_key.items() if hits is not None]
+    if not keys:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False) # One round trip for all keys; no MULTI needed
+        for cache_key in keys:
+            pipe.expire(cache_key, narrative_ttl_policy.ttl_for(hits_by_key[cache_key]))
+        await pipe.execute()
+    except redis.exceptions.RedisError as e:
+        print(f"Redis EXPIRE command failed for {len(keys)} narrative keys: {e}") # The entries keep their TTL
+
+async def get_cached_narrative(cache_key: str, hits: HitsSource = None) -> Optional[str]:
+    """`hits` is the compare set's popularity; a Redis hit gets its TTL refreshed from it (a local hit never reads it)."""
+    with phase_timer(PHASE_SECONDS, "cache_get"):
+        cached_narrative = await _get_cached_narrative(cache_key, hits)
+    if not cached_narrative:
+        NARRATIVE_CACHE_LOOKUPS.inc(result="miss")
+    return cached_narrative
+
+async def _get_cached_narrative(cache_key: str, hits: HitsSource = None) -> Optional[str]:
+    # Tier 1: in-process LRU
+    cached_narrative = narrative_local_cache.get(cache_key)
+    if cached_narrative is not None:
+        NARRATIVE_CACHE_LOOKUPS.inc(result="local_hit")
+        return cached_narrative
+
+    # Tier 2: Redis
+    if not redis_available():
+        return None
+    try:
+        payload = await redis_client.get(cache_key)
+        cached_narrative = read_narrative_payload(cache_key, payload) if payload else None
+        if cached_narrative:
+            print(f"Cache hit for key: {cache_key}")
+            NARRATIVE_CACHE_LOOKUPS.inc(result="redis_hit")
+            narrative_local_cache.set(cache_key, cached_narrative)
+            await refresh_narrative_ttls({cache_key: hits})
+        return cached_narrative
+    except redis.exceptions.RedisError as e:
+        print(f"Redis GET command failed for key {cache_key}: {e}") # Log error, don't let it crash
+        # If Redis fails, proceed as if cache miss
+        return None
+
+async def get_cached_narratives(cache_keys: List[str], hits_by_key: Optional[dict] = None) -> dict:
+    """
+    Batch form of get_cached_narrative: the local tier first, then one Redis MGET for the rest.
+    `hits_by_key` maps keys to their HitsSource. Returns cache key -> narrative for the keys that were found.
+    """
+    hits_by_key = hits_by_key or {}
+    found = {}
+    with phase_timer(PHASE_SECONDS, "cache_get"):
+        for cache_key in cache_keys:
+            cached_narrative = narrative_local_cache.get(cache_key)
+            if cached_narrative is not None:
+                NARRATIVE_CACHE_LOOKUPS.inc(result="local_hit")
+                found[cache_key] = cached_narrative
+        remote_keys = [cache_key for cache_key in cache_keys if cache_key not in found]
+        if redis_available() and remote_keys:
+            try:
+                redis_hits = {}
+                for cache_key, payload in zip(remote_keys, await redis_client.mget(remote_keys)):
+                    cached_narrative = read_narrative_payload(cache_key, payload) if payload else None
+                    if cached_narrative:
+                        NARRATIVE_CACHE_LOOKUPS.inc(result="redis_hit")
+                        narrative_local_cache.set(cache_key, cached_narrative)
+                        found[cache_key] = cached_narrative
+                        redis_hits[cache_key] = hits_by_key.get(cache_key)
+                await refresh_narrative_ttls(redis_hits)
+            except redis.exceptions.RedisError as e:
+                print(f"Redis MGET command failed for {len(remote_keys)} keys: {e}") # Treat as cache misses
+    NARRATIVE_CACHE_LOOKUPS.inc(len(cache_keys) - len(found), result="miss")
+    return found
+
+async def check_narrative_memory():
+    """Samples Redis' used_memory for the TTL policy, at most every NARRATIVE_MEMORY_CHECK_SECONDS."""
+    if not narrative_ttl_policy.memory_check_due():
+        return
+    try:
+        used_memory = int((await redis_client.info("memory"))["used_memory"])
+    except (redis.exceptions.RedisError, KeyError, TypeError, ValueError) as e:
+        print(f"Redis INFO memory failed: {e}")
+        used_memory = narrative_ttl_policy.used_memory_bytes # Keep the last sample until the next check
+    narrative_ttl_policy.update_memory(used_memory)
+
+def narrative_metadata(tokens: Optional[int], prompt_tokens: Optional[int] = None) -> dict:
+    """Header stored with a narrative in Redis. prompt_tokens is the local estimate (prompt.py)."""
+    return {
+        "model": NARRATIVE_MODEL,
+        "prompt_version": NARRATIVE_PROMPT_VERSION,
+        "tokens": tokens if isinstance(tokens, int) else None, # Streamed completions report no usage
+        "prompt_tokens": prompt_tokens,
+        "created_at": int(time.time()),
+    }
+
+async def cache_narrative(cache_key: str, narrative: Optional[str], hits: Optional[float] = None, tokens: Optional[int] = None,
+                          prompt_tokens: Optional[int] = None):
+    """
+    Caches a successfully generated narrative locally, and in Redis if it is available, as a compressed
+    payload whose TTL follows `hits` (the compare set's popularity). `tokens` is its completion token count
+    and `prompt_tokens` the estimated size of the prompt it was generated from.
+    """
+    if not is_cacheable_narrative(narrative):
+        return
+    with phase_timer(PHASE_SECONDS, "cache_set"):
+        narrative_local_cache.set(cache_key, narrative)
+        if not redis_available():
+            return
+        await check_narrative_memory()
+        if not narrative_ttl_policy.should_store(hits):
+            print(f"Redis is over the narrative memory budget; caching key {cache_key} locally only.")
+            return
+        payload = encode_narrative(narrative, narrative_metadata(tokens, prompt_tokens))
+        try:
+            await redis_client.set(cache_key, payload, ex=narrative_ttl_policy.ttl_for(hits))
+            NARRATIVE_STORE_BYTES.inc(len(narrative.encode("utf-8")), kind="raw")
+            NARRATIVE_STORE_BYTES.inc(len(payload), kind="stored")
+            print(f"Cached new narrative for key: {cache_key}")
+        except redis.exceptions.RedisError as e:
+            print(f"Redis SET command failed for key {cache_key}: {e}") # Log error, don't let it crash
+
+def narrative_unavailable_reason(openai_api_key: Optional[str], protocols_json_list: List[dict]) -> Optional[str]:
+    """Returns the fixed narrative to use instead of calling the LLM, or None if the LLM should be called."""
+    if not openai_api_key:
+        print("OPENAI_API_KEY not found. Skipping LLM narrative generation.")
+        return API_KEY_MISSING_NARRATIVE
+    if not protocols_json_list: # Don't call LLM if there's no protocol data
+        return NO_PROTOCOL_DATA_NARRATIVE
+    return None
+
+async def generate_narrative(cache_key: str, protocols_json_list: List[dict], lit_chunks_data: List[Any],
+                             hits: Optional[float] = None) -> str:
+    """
+    Generates a narrative with the LLM on a cache miss and caches it if it is cacheable.
+    Raises NarrativeGenerationError if the LLM call fails.
+    """
+    print(f"Cache miss or Redis error for key: {cache_key}. Proceeding to generate narrative.")
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    unavailable = narrative_unavailable_reason(openai_api_key, protocols_json_list)
+    if unavailable:
+        return unavailable
+    try:
+        client = get_openai_client(openai_api_key)
+        messages, prompt_report = build_narrative_prompt(protocols_json_list, lit_chunks_data)
+        record_prompt_report(cache_key, prompt_report)
+        with LLM_REQUESTS_IN_FLIGHT.track_inprogress(), phase_timer(PHASE_SECONDS, "llm"):
+            chat_completion = await client.chat.completions.create(
+                messages=messages,
+                model=NARRATIVE_MODEL,
+                timeout=NARRATIVE_LLM_TIMEOUT_SECONDS,
+            )
+        usage = getattr(chat_completion, "usage", None)
+        record_llm_usage(usage)
+        narrative = chat_completion.choices[0].message.content
+        await cache_narrative(cache_key, narrative, hits=hits, tokens=getattr(usage, "completion_tokens", None),
+                              prompt_tokens=prompt_report["prompt_tokens"])
+        return narrative
+    except Exception as e:
+        print(f"OpenAI API call failed: {e}")
+        raise NarrativeGenerationError(str(e)) from e
+
+async def stream_narrative(cache_key: str, protocols_json_list: List[dict], lit_chunks_data: List[Any],
+                           hits: Optional[float] = None, on_delta: Callable[[str], None] = None) -> str:
+    """
+    generate_narrative with a streamed completion: each token is passed to `on_delta` as it arrives.
+    Caches and returns the assembled narrative. Raises NarrativeGenerationError if the LLM call fails.
+    """
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    unavailable = narrative_unavailable_reason(openai_api_key, protocols_json_list)
+    if unavailable:
+        return unavailable
+    parts = []
+    try:
+        client = get_openai_client(openai_api_key)
+        messages, prompt_report = build_narrative_prompt(protocols_json_list, lit_chunks_data)
+        record_prompt_report(cache_key, prompt_report)
+        # Streamed completions do not report token usage, so only the duration is recorded
+        with LLM_REQUESTS_IN_FLIGHT.track_inprogress(), phase_timer(PHASE_SECONDS, "llm"):
+            stream = await client.chat.completions.create(
+                messages=messages,
+                model=NARRATIVE_MODEL,
+                stream=True,
+                timeout=NARRATIVE_LLM_TIMEOUT_SECONDS,
+            )
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+    except Exception as e:
+        print(f"OpenAI API streaming call failed: {e}")
+        raise NarrativeGenerationError(str(e)) from e
+    narrative = "".join(parts)
+    await cache_narrative(cache_key, narrative, hits=hits, prompt_tokens=prompt_report["prompt_tokens"])
+    return narrative
+
+async def generate_narrative_with_lease(cache_key: str, protocols_json_list: List[dict], lit_chunks_data: List[Any],
+                                        hits: Optional[float] = None, generate: Callable[..., Awaitable[str]] = None) -> str:
+    """
+    Generates the narrative while holding the `lock:<cache_key>` lease, so only one worker calls the LLM.
+    Workers that find the lease taken poll the cache until the holder's narrative appears, or take over
+    the lease once it is released or expires. `generate` (generate_narrative by default) makes the LLM call.
+    """
+    generate = generate or generate_narrative
+    if not redis_available() or narrative_unavailable_reason(os.getenv("OPENAI_API_KEY"), protocols_json_list):
+        return await generate(cache_key, protocols_json_list, lit_chunks_data, hits)
+
+    lock_key = f"lock:{cache_key}"
+    token = uuid.uuid4().hex
+    while True:
+        acquired = await acquire_lease(redis_client, lock_key, token, NARRATIVE_LOCK_LEASE_MS)
+        if acquired is None: # Redis unavailable: generate without coordination
+            return await generate(cache_key, protocols_json_list, lit_chunks_data, hits)
+        if acquired:
+            try:
+                # Another worker may have cached the narrative between our cache miss and taking the lease
+                cached_narrative = await get_cached_narrative(cache_key)
+                if cached_narrative:
+                    return cached_narrative
+                return await generate(cache_key, protocols_json_list, lit_chunks_data, hits)
+            finally:
+                await release_lease(redis_client, lock_key, token)
+
+        await asyncio.sleep(NARRATIVE_LOCK_POLL_SECONDS)
+        cached_narrative = await get_cached_narrative(cache_key)
+        if cached_narrative:
+            return cached_narrative
+
+async def generate_narrative_coalesced(cache_key: str, protocols_json_list: List[dict], lit_chunks_data: List[Any],
+                                       hits: Optional[float] = None) -> str:
+    return await narrative_flights.do(
+        cache_key, lambda: generate_narrative_with_lease(cache_key, protocols_json_list, lit_chunks_data, hits)
+    )
+
+async def stream_narrative_coalesced(cache_key: str, protocols_json_list: List[dict], lit_chunks_data: List[Any],
+                                     hits: Optional[float] = None) -> AsyncIterator[str]:
+    """
+    Narrative deltas for a streaming cache miss, coalesced like generate_narrative_coalesced: the first
+    request for a cache key streams the completion (under the Redis lease) and caches it, and concurrent
+    requests for the key, in this worker or another, get the finished narrative as a single delta.
+    Raises NarrativeGenerationError if the LLM call fails.
+    """
+    deltas = asyncio.Queue()
+    result = asyncio.ensure_future(narrative_flights.do(cache_key, lambda: generate_narrative_with_lease(
+        cache_key, protocols_json_list, lit_chunks_data, hits,
+        generate=lambda *args: stream_narrative(*args, on_delta=deltas.put_nowait))))
+    streamed = False
+    try:
+        while not result.done() or not deltas.empty():
+            if deltas.empty():
+                next_delta = asyncio.ensure_future(deltas.get())
+                await asyncio.wait({next_delta, result}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_delta.done():
+                    next_delta.cancel()
+                    continue
+                delta = next_delta.result()
+            else:
+                delta = deltas.get_nowait()
+            streamed = True
+            yield delta
+        narrative = result.result()
+        if not streamed: # Another request (or worker) generated it
+            yield narrative
+    finally:
+        # A client that disconnects stops waiting; the shared generation still finishes and caches
+        result.cancel()
+
+# --- Narrative backends ---
+# Compare requests get their narrative from `narrative_backend`: NARRATIVE_BACKEND ("llm" or "template")
+# within NARRATIVE_DEADLINE_SECONDS. When the LLM misses the deadline or fails, the template narrative
+# (built from the table rows) is returned at once and the LLM call finishes in the background, caching
+# its narrative for the next request. 0 disables the deadline.
+class LLMNarrativeBackend(NarrativeBackend):
+    name = "llm"
+
+    async def generate(self, cache_key: str, protocols: List[dict], lit_chunks: List[Any], hits: Optional[float] = None,
+                       reason: Optional[str] = None, slots: Optional[asyncio.Semaphore] = None) -> str:
+        async with slots or contextlib.nullcontext():
+            return await generate_narrative_coalesced(cache_key, protocols, lit_chunks, hits)
+
+NARRATIVE_BACKENDS = {"llm": LLMNarrativeBackend, "template": lambda: TemplateNarrativeBackend(evidence_rank_key)}
+NARRATIVE_BACKEND = os.getenv("NARRATIVE_BACKEND", "llm")
+NARRATIVE_DEADLINE_SECONDS = float(os.getenv("NARRATIVE_DEADLINE_SECONDS", 5))
+
+def build_narrative_backend(name: str = NARRATIVE_BACKEND, deadline_seconds: float = NARRATIVE_DEADLINE_SECONDS) -> NarrativeBackend:
+    if name not in NARRATIVE_BACKENDS:
+        raise ValueError(f"Unknown NARRATIVE_BACKEND {name!r}; expected one of {', '.join(NARRATIVE_BACKENDS)}")
+    backend = NARRATIVE_BACKENDS[name]()
+    if backend.name == "template": # Already instant, nothing to fall back from
+        return backend
+    return DeadlineNarrativeBackend(backend, NARRATIVE_BACKENDS["template"](), deadline_seconds,
+                                    on_fallback=lambda reason: NARRATIVE_FALLBACKS.inc(reason=reason))
+
+narrative_backend = build_narrative_backend()
+
+# --- Literature retrieval (lit_chunks) ---
+# Relevant studies from data/studies.json and research_sources/*.bib are passed to the LLM with each
+# comparison. The vector index (see retrieval.py) is loaded, or built if the sources changed, at startup;
+# until then, or if numpy is not installed, comparisons run without literature as before.
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LIT_RETRIEVAL_ENABLED = os.getenv("APGE_LIT_RETRIEVAL_ENABLED", "true").lower() in ("1", "true", "yes")
+LIT_INDEX_DIR = os.getenv("APGE_LIT_INDEX_DIR", os.path.join(PROJECT_ROOT, "data", "lit_index"))
+LIT_STUDIES_PATH = os.getenv("APGE_LIT_STUDIES_PATH", os.path.join(PROJECT_ROOT, "data", "studies.json"))
+LIT_BIB_DIR = os.getenv("APGE_LIT_BIB_DIR", os.path.join(PROJECT_ROOT, "research_sources"))
+LIT_TOP_K = int(os.getenv("APGE_LIT_TOP_K", 3))
+LIT_MIN_SCORE = float(os.getenv("APGE_LIT_MIN_SCORE", 0.1))
+
+literature_retriever = None # retrieval.LiteratureRetriever once loaded
+
+def load_literature_retriever():
+    try:
+        from .retrieval import LiteratureRetriever, load_or_build_index # numpy is only needed here
+    except ImportError as e:
+        print(f"Literature retrieval disabled: {e}")
+        return None
+    bib_paths = sorted(
+        os.path.join(LIT_BIB_DIR, name) for name in os.listdir(LIT_BIB_DIR) if name.endswith(".bib")
+    ) if os.path.isdir(LIT_BIB_DIR) else []
+    index = load_or_build_index(LIT_INDEX_DIR, LIT_STUDIES_PATH, bib_paths)
+    print(f"Loaded literature vector index: {len(index)} studies.")
+    return LiteratureRetriever(index, top_k=LIT_TOP_K, min_score=LIT_MIN_SCORE)
+
+def retrieve_lit_chunks(protocols_json_list: List[dict]) -> List[str]:
+    # A sub-millisecond in-memory search, so it runs inline rather than on an executor
+    if literature_retriever is None or not protocols_json_list:
+        return []
+    with phase_timer(PHASE_SECONDS, "retrieval"):
+        return literature_retriever.chunks_for_protocols(protocols_json_list)
+
+# --- Narrative popularity and pre-warming ---
+# Every compare request bumps its ID set in a Redis sorted set. prewarm_narratives() takes the top-K sets
+# and makes sure their narratives are cached: missing ones (new seed, expired TTL) are generated ahead of
+# the next request, and cached ones get their TTL extended so popular narratives do not expire.
+# It runs from scripts/prewarm.py, or periodically in the API when NARRATIVE_PREWARM_INTERVAL_SECONDS > 0.
+# Scores decay: every NARRATIVE_POPULARITY_DECAY_INTERVAL_SECONDS they are multiplied by
+# NARRATIVE_POPULARITY_DECAY_FACTOR, so they count recent requests and a once-hot set cools down.
+NARRATIVE_POPULARITY_KEY = "narrative:popularity"
+NARRATIVE_POPULARITY_DECAY_MARKER_KEY = "narrative:popularity:decayed" # Set for one interval by the worker that decayed
+NARRATIVE_POPULARITY_MAX_MEMBERS = int(os.getenv("NARRATIVE_POPULARITY_MAX_MEMBERS", 10000))
+NARRATIVE_POPULARITY_DECAY_FACTOR = float(os.getenv("NARRATIVE_POPULARITY_DECAY_FACTOR", 0.5))
+NARRATIVE_POPULARITY_DECAY_INTERVAL_SECONDS = float(os.getenv("NARRATIVE_POPULARITY_DECAY_INTERVAL_SECONDS", 86400)) # 0: disabled
+NARRATIVE_POPULARITY_MIN_SCORE = 0.01 # Members decayed below this are dropped
+NARRATIVE_PREWARM_TOP_K = int(os.getenv("NARRATIVE_PREWARM_TOP_K", 50))
+NARRATIVE_PREWARM_CONCURRENCY = int(os.getenv("NARRATIVE_PREWARM_CONCURRENCY", 4))
+NARRATIVE_PREWARM_INTERVAL_SECONDS = float(os.getenv("NARRATIVE_PREWARM_INTERVAL_SECONDS", 0)) # 0: disabled
+
+def popularity_member(ids: List[str]) -> str:
+    # Narrative cache keys do not depend on ID order, so neither does popularity
+    return json.dumps(sorted(set(ids)), separators=(",", ":"))
+
+async def record_compare_popularity(id_sets: List[List[str]]) -> dict:
+    """Bumps each ID set's request count; returns popularity member -> new count (empty if Redis is unavailable)."""
+    if not redis_available():
+        return {}
+    members = list(dict.fromkeys(popularity_member(ids) for ids in id_sets if ids))
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for member in members:
+            pipe.zincrby(NARRATIVE_POPULARITY_KEY, 1, member)
+        scores = await pipe.execute()
+        return {member: float(score) for member, score in zip(members, scores)}
+    except redis.exceptions.RedisError as e:
+        print(f"Redis ZINCRBY command failed for popularity tracking: {e}") # Popularity is best-effort
+        return {}
+
+pending_popularity_bumps = set() # Referenced until done, so the event loop does not drop them
+
+class PopularityBump:
+    """
+    record_compare_popularity for a request's ID sets, running in the background so a compare never waits
+    for Redis before its cache lookup: an in-process hit is answered without leaving the process.
+    `hits(ids)` waits for the bump and returns that set's new count.
+    """
+
+    def __init__(self, id_sets: List[List[str]]):
+        self.task = asyncio.ensure_future(record_compare_popularity(id_sets))
+        pending_popularity_bumps.add(self.task)
+        self.task.add_done_callback(pending_popularity_bumps.discard)
+
+    async def hits(self, ids: List[str]) -> Optional[float]:
+        # shield: a request that goes away must not cancel the bump
+        return (await asyncio.shield(self.task)).get(popularity_member(ids)) if ids else None
+
+async def decay_narrative_popularity(factor: float = NARRATIVE_POPULARITY_DECAY_FACTOR,
+                                     interval_seconds: float = NARRATIVE_POPULARITY_DECAY_INTERVAL_SECONDS) -> bool:
+    """
+    Multiplies every popularity score by `factor` and drops the members that fall below NARRATIVE_POPULARITY_MIN_SCORE.
+    A marker key makes it run at most once per `interval_seconds` across all workers. Returns whether it ran.
+    """
+    if not redis_available():
+        return False
+    try:
+        if not await redis_client.set(NARRATIVE_POPULARITY_DECAY_MARKER_KEY, "1", nx=True, ex=max(int(interval_seconds), 1)):
+            return False # Another worker decayed this interval
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zunionstore(NARRATIVE_POPULARITY_KEY, {NARRATIVE_POPULARITY_KEY: factor})
+        pipe.zremrangebyscore(NARRATIVE_POPULARITY_KEY, "-inf", f"({NARRATIVE_POPULARITY_MIN_SCORE}")
+        _, dropped = await pipe.execute()
+    except redis.exceptions.RedisError as e:
+        print(f"Could not decay narrative popularity: {e}")
+        return False
+    print(f"Narrative popularity decayed by {factor}; {dropped} cold sets dropped.")
+    return True
+
+async def run_popularity_decay_loop(interval_seconds: float):
+    while True:
+        await asyncio.sleep(interval_seconds) # Not at startup: a restart must not decay early
+        try:
+            await decay_narrative_popularity(interval_seconds=interval_seconds)
+        except Exception as e:
+            print(f"Narrative popularity decay failed: {e}")
+
+async def prewarm_narratives(top_k: int = NARRATIVE_PREWARM_TOP_K, concurrency: int = NARRATIVE_PREWARM_CONCURRENCY) -> dict:
+    """
+    Ensures the narratives of the `top_k` most requested compare sets are cached.
+    Returns counts of sets considered, already cached (TTL refreshed from their popularity), generated, and not generated.
+    """
+    stats = {"sets": 0, "cached": 0, "generated": 0, "failed": 0}
+    if not redis_available():
+        print("Redis is not available; skipping narrative pre-warm.")
+        return stats
+    try:
+        members = await redis_client.zrevrange(NARRATIVE_POPULARITY_KEY, 0, top_k - 1, withscores=True)
+        # Keep the sorted set bounded; the long tail is never pre-warmed anyway
+        await redis_client.zremrangebyrank(NARRATIVE_POPULARITY_KEY, 0, -NARRATIVE_POPULARITY_MAX_MEMBERS - 1)
+    except redis.exceptions.RedisError as e:
+        print(f"Could not read narrative popularity: {e}")
+        return stats
+    id_sets = [(json.loads(member), float(score)) for member, score in members]
+    stats["sets"] = len(id_sets)
+    if not id_sets:
+        return stats
+
+    all_ids = list(dict.fromkeys(protocol_id for ids, _ in id_sets for protocol_id in ids))
+    with get_driver().session() as session:
+        rows_by_id = await fetch_compare_rows_by_id(session, all_ids)
+
+    to_warm = {}
+    for ids, hits in id_sets:
+        protocols_json_list = [dict(zip(COMPARE_TABLE_COLUMNS, row)) for protocol_id in ids for row in rows_by_id.get(protocol_id, [])]
+        if protocols_json_list: # Protocols removed by a reseed have nothing to warm
+            lit_chunks_data = retrieve_lit_chunks(protocols_json_list)
+            to_warm[narrative_cache_key(protocols_json_list, lit_chunks_data)] = (protocols_json_list, lit_chunks_data, hits)
+
+    # Cached narratives found in Redis get their TTL extended to match their popularity
+    cached = await get_cached_narratives(list(to_warm), {cache_key: inputs[2] for cache_key, inputs in to_warm.items()})
+    stats["cached"] = len(cached)
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def warm(cache_key: str, protocols_json_list: List[dict], lit_chunks_data: List[str], hits: float):
+        async with slots:
+            try:
+                narrative = await generate_narrative_coalesced(cache_key, protocols_json_list, lit_chunks_data, hits)
+            except NarrativeGenerationError:
+                narrative = None
+        stats["generated" if is_cacheable_narrative(narrative) else "failed"] += 1
+
+    await asyncio.gather(*(warm(key, *inputs) for key, inputs in to_warm.items() if key not in cached))
+    print(f"Narrative pre-warm: {stats['sets']} popular sets, {stats['cached']} already cached, "
+          f"{stats['generated']} generated, {stats['failed']} not generated.")
+    return stats
+
+async def run_prewarm_loop(interval_seconds: float):
+    while True:
+        try:
+            await prewarm_narratives()
+        except Exception as e:
+            print(f"Narrative pre-warm failed: {e}")
+        await asyncio.sleep(interval_seconds)
+
+def compare_table_payload(columns: List[str], rows: List[List[Any]], layout: str = "rows") -> dict:
+    """
+    The `table` object of a compare body. layout=columns transposes `data` to one list per column
+    (same order as `columns`), which repeats no row structure and compresses better for wide tables.
+    """
+    if layout == "columns":
+        return {"columns": columns, "layout": "columns", "data": [list(values) for values in zip(*rows)] if rows else [[] for _ in columns]}
+    return {"columns": columns, "data": rows}
+
+def compare_payload(columns: List[str], rows: List[List[Any]], narrative_md: str, lit_chunks: List[Any], layout: str = "rows") -> dict:
+    """Fast path counterpart of CompareResponse, with the keys in the model's field order."""
+    return {"table": compare_table_payload(columns, rows, layout), "narrative_md": narrative_md, "lit_chunks": lit_chunks}
+
+def use_fast_compare_path(layout: str) -> bool:
+    return FAST_JSON_RESPONSES or layout != "rows"
+
+def fast_json_response(content: Any, accept_encoding: Optional[str]) -> Response:
+    """Encodes `content` once and compresses it if it is large enough and the client accepts gzip/br."""
+    headers = {"Vary": "Accept-Encoding"}
+    with phase_timer(PHASE_SECONDS, "encode"):
+        body = dumps(content)
+        encoding = negotiate_encoding(accept_encoding) if len(body) >= RESPONSE_COMPRESSION_MIN_BYTES else None
+        if encoding:
+            body = compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.post("/api/protocol/compare", response_model=Union[CompareResponse, CompareColumnsResponse])
+async def compare_protocols(request_body: CompareRequest, db: Neo4jSession = Depends(get_db),
+                            layout: str = Query("rows", pattern=COMPARE_LAYOUT_PATTERN),
+                            accept_encoding: Optional[str] = Header(None)):
+    fast = use_fast_compare_path(layout)
+    if not request_body.ids:
+        if fast:
+            return fast_json_response(compare_payload([], [], NO_IDS_NARRATIVE, [], layout), accept_encoding)
+        # Return a CompareResponse-compatible structure
+        return CompareResponse(
+            table=TableResponse(columns=[], data=[]),
+            narrative_md=NO_IDS_NARRATIVE,
+            lit_chunks=[]
+        )
+
+    popularity = PopularityBump([request_body.ids])
+    table_data_rows = await fetch_compare_rows(db, request_body.ids)
+
+    # Prepare data for LLM
+    protocols_json_list = [dict(zip(COMPARE_TABLE_COLUMNS, row)) for row in table_data_rows]
+    lit_chunks_data = retrieve_lit_chunks(protocols_json_list)
+
+    # The cache key is derived from the rows, so the lookup happens after the query.
+    # Nothing is cached for an empty result, so there is nothing to look up either.
+    cache_key = narrative_cache_key(protocols_json_list, lit_chunks_data)
+    hits = functools.partial(popularity.hits, request_body.ids)
+    narrative_to_return = await get_cached_narrative(cache_key, hits) if protocols_json_list else None
+
+    if narrative_to_return is None: # Cache miss or Redis unavailable/error during GET
+        narrative_to_return = await narrative_backend.generate(cache_key, protocols_json_list, lit_chunks_data, await hits())
+
+    if fast:
+        return fast_json_response(
+            compare_payload(COMPARE_TABLE_COLUMNS, table_data_rows, narrative_to_return, lit_chunks_data, layout), accept_encoding)
     return CompareResponse(
-        table=TableResponse(columns=table_columns_list, data=table_data_rows),
+        table=TableResponse(columns=COMPARE_TABLE_COLUMNS, data=table_data_rows),
         narrative_md=narrative_to_return, # Use the cached or newly generated narrative
         lit_chunks=lit_chunks_data
     )
+
+# Upper bound on the LLM calls a single batch request makes at once
+COMPARE_BATCH_LLM_CONCURRENCY = int(os.getenv("COMPARE_BATCH_LLM_CONCURRENCY", 4))
+
+@app.post("/api/protocol/compare/batch", response_model=Union[CompareBatchResponse, CompareColumnsBatchResponse])
+async def compare_protocols_batch(request_body: CompareBatchRequest, db: Neo4jSession = Depends(get_db),
+                                  layout: str = Query("rows", pattern=COMPARE_LAYOUT_PATTERN),
+                                  accept_encoding: Optional[str] = Header(None)):
+    """
+    /api/protocol/compare for many ID sets at once: the union of the IDs is fetched with one query,
+    the narratives of all sets are looked up together, and only the missing ones are generated,
+    concurrently. Each result is what /api/protocol/compare returns for that set.
+    """
+    popularity = PopularityBump(request_body.sets)
+    all_ids = list(dict.fromkeys(protocol_id for ids in request_body.sets for protocol_id in ids))
+    rows_by_id = await fetch_compare_rows_by_id(db, all_ids) if all_ids else {}
+
+    # Per set: same rows, in the same order, as the UNWIND query would return for that set alone
+    set_rows, set_protocols, set_lit_chunks, set_keys, hits_by_key = [], [], [], [], {}
+    for ids in request_body.sets:
+        table_data_rows = [row for protocol_id in ids for row in rows_by_id.get(protocol_id, [])]
+        protocols_json_list = [dict(zip(COMPARE_TABLE_COLUMNS, row)) for row in table_data_rows]
+        lit_chunks_data = retrieve_lit_chunks(protocols_json_list)
+        set_rows.append(table_data_rows)
+        set_protocols.append(protocols_json_list)
+        set_lit_chunks.append(lit_chunks_data)
+        set_keys.append(narrative_cache_key(protocols_json_list, lit_chunks_data) if ids else None)
+        if ids:
+            hits_by_key[set_keys[-1]] = functools.partial(popularity.hits, ids)
+
+    # Sets with no rows are never cached, so they are not looked up either
+    lookup_keys = list(dict.fromkeys(key for key, protocols in zip(set_keys, set_protocols) if key and protocols))
+    narratives = await get_cached_narratives(lookup_keys, hits_by_key) if lookup_keys else {}
+
+    # Identical sets share one generation; unrelated misses run concurrently, up to the LLM bound
+    missing = {
+        key: (protocols, lit_chunks_data)
+        for key, protocols, lit_chunks_data in zip(set_keys, set_protocols, set_lit_chunks)
+        if key and key not in narratives
+    }
+    llm_slots = asyncio.Semaphore(COMPARE_BATCH_LLM_CONCURRENCY)
+    missing_hits = {key: await resolve_hits(hits_by_key.get(key)) for key in missing}
+
+    # The slot is taken inside the backend, so an LLM call still running after the deadline keeps holding it
+    generated = await asyncio.gather(*(
+        narrative_backend.generate(key, protocols, lit_chunks_data, missing_hits[key], slots=llm_slots)
+        for key, (protocols, lit_chunks_data) in missing.items()
+    ))
+    narratives.update(zip(missing, generated))
+
+    if use_fast_compare_path(layout):
+        return fast_json_response({"results": [
+            compare_payload(COMPARE_TABLE_COLUMNS if key else [], table_data_rows if key else [],
+                            narratives[key] if key else NO_IDS_NARRATIVE, lit_chunks_data, layout)
+            for key, table_data_rows, lit_chunks_data in zip(set_keys, set_rows, set_lit_chunks)
+        ]}, accept_encoding)
+    return CompareBatchResponse(results=[
+        CompareResponse(
+            table=TableResponse(columns=COMPARE_TABLE_COLUMNS, data=table_data_rows) if key else TableResponse(columns=[], data=[]),
+            narrative_md=narratives[key] if key else NO_IDS_NARRATIVE,
+            lit_chunks=lit_chunks_data,
+        )
+        for key, table_data_rows, lit_chunks_data in zip(set_keys, set_rows, set_lit_chunks)
+    ])
+
+def sse_event(event: str, data: Any) -> str:
+    """Formats one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@app.post("/api/protocol/compare/stream")
+async def compare_protocols_stream(request_body: CompareRequest, db: Neo4jSession = Depends(get_db)):
+    """
+    Streaming variant of /api/protocol/compare as Server-Sent Events:
+      event: table     -> {"columns": [...], "data": [...]} as soon as the Cypher query returns
+      event: narrative -> {"delta": "..."} for each narrative token (a single event on a cache hit)
+      event: error     -> {"message": "..."} if the LLM call fails mid-stream
+      event: done      -> {"narrative_md": "...", "lit_chunks": [...]} with the assembled narrative
+    The assembled narrative is cached under the same key as the non-streaming endpoint. Concurrent misses
+    for the same key share one LLM call (stream_narrative_coalesced).
+    """
+    ids = request_body.ids
+
+    # The table is built before the response starts, so the DB session is not needed while streaming
+    if ids:
+        popularity = PopularityBump([ids])
+        table_data_rows = await fetch_compare_rows(db, ids)
+        table_columns = COMPARE_TABLE_COLUMNS
+        protocols_json_list = [dict(zip(table_columns, row)) for row in table_data_rows]
+        lit_chunks_data = retrieve_lit_chunks(protocols_json_list)
+        cache_key = narrative_cache_key(protocols_json_list, lit_chunks_data)
+        cached_narrative = await get_cached_narrative(cache_key, functools.partial(popularity.hits, ids)) if protocols_json_list else None
+        hits = await popularity.hits(ids) if cached_narrative is None else None # Only a generated narrative's TTL needs it
+    else:
+        cache_key, cached_narrative, table_data_rows, table_columns, protocols_json_list = None, NO_IDS_NARRATIVE, [], [], []
+        hits = None
+        lit_chunks_data = []
+
+    async def event_stream():
+        yield sse_event("table", {"columns": table_columns, "data": table_data_rows})
+
+        narrative = cached_narrative
+        if narrative is None:
+            print(f"Cache miss or Redis error for key: {cache_key}. Proceeding to stream narrative.")
+            openai_api_key = os.getenv("OPENAI_API_KEY")
+            narrative = narrative_unavailable_reason(openai_api_key, protocols_json_list)
+
+        if narrative is not None:
+            yield sse_event("narrative", {"delta": narrative})
+        else:
+            parts = []
+            try:
+                async for delta in stream_narrative_coalesced(cache_key, protocols_json_list, lit_chunks_data, hits):
+                    parts.append(delta)
+                    yield sse_event("narrative", {"delta": delta})
+                narrative = "".join(parts)
+            except NarrativeGenerationError:
+                narrative = NARRATIVE_ERROR
+                yield sse_event("error", {"message": narrative})
+
+        yield sse_event("done", {"narrative_md": narrative, "lit_chunks": lit_chunks_data})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return {
+        "narrative_local": narrative_local_cache.stats(),
+        "redis_enabled": redis_available(),
+        "redis_circuit": redis_breaker.state if redis_client else None,
+        "narrative_redis": {
+            **narrative_ttl_policy.stats(),
+            "bytes_raw": NARRATIVE_STORE_BYTES.value(kind="raw"),
+            "bytes_stored": NARRATIVE_STORE_BYTES.value(kind="stored"),
+        },
+    }
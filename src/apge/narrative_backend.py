@@ -0,0 +1,201 @@
+"""
+Narrative backends, and the deadline that bounds how long a compare request waits for one.
+
+A backend turns compare rows (dicts keyed by the compare columns) and literature chunks into a Markdown
+narrative. `TemplateNarrativeBackend` builds one locally from the rows, instantly and deterministically;
+main.py's LLM backend asks the OpenAI API. `DeadlineNarrativeBackend` gives its primary backend a
+deadline and answers with the fallback when the primary misses it or fails. A late primary keeps
+running in the background, so its narrative still reaches the cache for the next request.
+"""
+import abc
+import asyncio
+import re
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Closing note of a template narrative, by the reason the template answered (no note when it is the backend)
+TEMPLATE_NOTES = {
+    "deadline": ("_Summary built from the comparison table only: the detailed analysis was not ready in time. "
+                 "Request the comparison again shortly for the full narrative._"),
+    "error": ("_Summary built from the comparison table only: the detailed analysis could not be generated. "
+              "Please try again later._"),
+}
+
+_RANGE = re.compile(r"^\s*(\d+)\s*(?:-|\u2013|to)\s*(\d+)\s*$")
+
+
+class NarrativeGenerationError(Exception):
+    """Raised by a backend that could not produce a narrative (e.g. the LLM call failed)."""
+
+
+class NarrativeBackend(abc.ABC):
+    name = "base"
+
+    @abc.abstractmethod
+    async def generate(self, cache_key: str, protocols: List[Dict[str, Any]], lit_chunks: List[str],
+                       hits: Optional[float] = None, reason: Optional[str] = None,
+                       slots: Optional[asyncio.Semaphore] = None) -> str:
+        """
+        The narrative for `protocols`. `cache_key` and `hits` let a backend cache what it generates,
+        `reason` is why a fallback backend is answering, and a backend that calls out holds one of
+        `slots` (if given) for as long as the call runs.
+        """
+
+
+def _names(protocols: List[Dict[str, Any]]) -> List[str]:
+    return [str(protocol.get("Protocol Name") or f"Protocol {number}") for number, protocol in enumerate(protocols, 1)]
+
+
+def _join(items: List[str]) -> str:
+    return items[0] if len(items) == 1 else ", ".join(items[:-1]) + " and " + items[-1]
+
+
+def _count_range(value: Any) -> Optional[Tuple[int, int]]:
+    """(low, high) for a count such as 30, "30" or "20-30"; None if missing or not a count."""
+    if isinstance(value, int):
+        return value, value
+    text = str(value or "").strip()
+    if text.isdigit():
+        return int(text), int(text)
+    match = _RANGE.match(text)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def _format_range(low: int, high: int) -> str:
+    return f"{low:,}" if low == high else f"{low:,}-{high:,}"
+
+
+def _coil_paragraph(protocols: List[Dict[str, Any]], names: List[str]) -> str:
+    by_coil: Dict[str, List[str]] = {}
+    for name, protocol in zip(names, protocols):
+        by_coil.setdefault(protocol.get("Coil Type") or "an unreported coil type", []).append(name)
+    if len(by_coil) == 1:
+        coil = next(iter(by_coil))
+        subject = "The protocol uses" if len(names) == 1 else f"All {len(names)} protocols use"
+        return f"**Coil.** {subject} {coil}."
+    return "**Coil.** " + "; ".join(f"{_join(group)}: {coil}" for coil, group in by_coil.items()) + "."
+
+
+def _session_paragraph(protocols: List[Dict[str, Any]], names: List[str]) -> str:
+    lines, burden = [], []
+    for name, protocol in zip(names, protocols):
+        raw_sessions, raw_pulses = protocol.get("Sessions"), protocol.get("Pulses/Session")
+        sessions, pulses = _count_range(raw_sessions), _count_range(raw_pulses)
+        if sessions is not None:
+            parts = [f"{_format_range(*sessions)} sessions"]
+        else: # Unparsed values are reported as given
+            parts = [f"{raw_sessions} sessions" if raw_sessions not in (None, "") else "sessions not reported"]
+        if pulses is not None:
+            parts.append(f"{_format_range(*pulses)} pulses per session")
+        elif raw_pulses not in (None, ""):
+            parts.append(f"{raw_pulses} pulses per session")
+        if protocol.get("Frequency"):
+            parts.append(f"at {protocol['Frequency']}")
+        if sessions is not None and pulses is not None:
+            parts.append(f"{_format_range(sessions[0] * pulses[0], sessions[1] * pulses[1])} pulses in total")
+        lines.append(f"{name}: {', '.join(parts)}")
+        if sessions is not None:
+            burden.append((sessions, name))
+    paragraph = "**Session burden.** " + "; ".join(lines) + "."
+    if len(burden) > 1 and min(burden)[0] < max(burden)[0]: # Ranges compare by their lower, then upper bound
+        paragraph += f" {min(burden)[1]} needs the fewest sessions."
+    return paragraph
+
+
+class TemplateNarrativeBackend(NarrativeBackend):
+    """
+    Deterministic narrative from the table rows: coil type, session burden and evidence level, with a
+    closing note when it stands in for another backend. `evidence_rank` sorts Evidence entries best first
+    (lower is better).
+    """
+    name = "template"
+
+    def __init__(self, evidence_rank: Callable[[Dict[str, Any]], Any]):
+        self.evidence_rank = evidence_rank
+
+    def best_evidence(self, protocol: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        evidence = [entry for entry in protocol.get("Evidence") or [] if entry.get("level")]
+        if not evidence and protocol.get("Evidence Level"):
+            evidence = [{"level": protocol["Evidence Level"], "year": protocol.get("Publication Year")}]
+        return min(evidence, key=self.evidence_rank) if evidence else None
+
+    def _evidence_paragraph(self, protocols: List[Dict[str, Any]], names: List[str]) -> str:
+        lines, ranked = [], []
+        for name, protocol in zip(names, protocols):
+            best = self.best_evidence(protocol)
+            if best is None:
+                lines.append(f"{name}: no evidence level reported")
+                continue
+            year = f" ({best['year']})" if best.get("year") else ""
+            lines.append(f"{name}: {best['level']}{year}")
+            ranked.append((self.evidence_rank(best), name))
+        paragraph = "**Evidence.** " + "; ".join(lines) + "."
+        if len(protocols) > 1 and ranked:
+            paragraph += f" The strongest reported evidence is for {min(ranked)[1]}."
+        return paragraph
+
+    def render(self, protocols: List[Dict[str, Any]], reason: Optional[str] = None) -> str:
+        names = _names(protocols)
+        paragraphs = [
+            _coil_paragraph(protocols, names),
+            _session_paragraph(protocols, names),
+            self._evidence_paragraph(protocols, names),
+        ]
+        if reason in TEMPLATE_NOTES:
+            paragraphs.append(TEMPLATE_NOTES[reason])
+        return "\n\n".join(paragraphs)
+
+    async def generate(self, cache_key: str, protocols: List[Dict[str, Any]], lit_chunks: List[str],
+                       hits: Optional[float] = None, reason: Optional[str] = None,
+                       slots: Optional[asyncio.Semaphore] = None) -> str:
+        return self.render(protocols, reason)
+
+
+class DeadlineNarrativeBackend(NarrativeBackend):
+    """
+    Waits up to `deadline_seconds` for `primary`, then answers with `fallback` (also used when the primary
+    raises). The primary's call is not cancelled at the deadline: it finishes in the background (tracked
+    in `pending`), still holding its slot, and caches its narrative as usual. Time spent waiting for a
+    slot counts towards the deadline. A deadline of 0 waits for the primary indefinitely.
+    `on_fallback(reason)` is called with "deadline" or "error" whenever the fallback answers.
+    """
+
+    def __init__(self, primary: NarrativeBackend, fallback: NarrativeBackend, deadline_seconds: float,
+                 on_fallback: Optional[Callable[[str], None]] = None):
+        self.primary = primary
+        self.fallback = fallback
+        self.deadline_seconds = deadline_seconds
+        self.on_fallback = on_fallback
+        self.pending = set()
+
+    @property
+    def name(self) -> str:
+        return f"{self.primary.name}+{self.fallback.name}"
+
+    async def generate(self, cache_key: str, protocols: List[Dict[str, Any]], lit_chunks: List[str],
+                       hits: Optional[float] = None, reason: Optional[str] = None,
+                       slots: Optional[asyncio.Semaphore] = None) -> str:
+        task = asyncio.ensure_future(self.primary.generate(cache_key, protocols, lit_chunks, hits, slots=slots))
+        try:
+            # shield: the deadline stops the wait, not the generation
+            return await asyncio.wait_for(asyncio.shield(task), self.deadline_seconds or None)
+        except asyncio.TimeoutError:
+            print(f"Narrative for key {cache_key} missed the {self.deadline_seconds}s deadline; "
+                  f"answering with the {self.fallback.name} narrative and finishing it in the background.")
+            self.pending.add(task)
+            task.add_done_callback(self._finished_in_background)
+            reason = "deadline"
+        except NarrativeGenerationError as e:
+            print(f"Narrative for key {cache_key} failed ({e}); answering with the {self.fallback.name} narrative.")
+            reason = "error"
+        if self.on_fallback:
+            self.on_fallback(reason)
+        return await self.fallback.generate(cache_key, protocols, lit_chunks, hits, reason=reason)
+
+    def _finished_in_background(self, task: asyncio.Task):
+        self.pending.discard(task)
+        if not task.cancelled() and task.exception() is not None: # Retrieved, so asyncio does not warn about it
+            print(f"Background narrative generation failed: {task.exception()}")
+
+    def cancel_pending(self):
+        for task in list(self.pending):
+            task.cancel()
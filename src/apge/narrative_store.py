@@ -0,0 +1,109 @@
+"""
+How narratives are stored in Redis: a compressed payload with a metadata header, and a TTL that follows
+the popularity of the compare set within a memory budget.
+
+Payload layout: MAGIC, the header length (uint16, big-endian), the header as compact JSON (codec, model,
+prompt_version, tokens, created_at), then the Markdown narrative, zlib-compressed unless that would not
+make it smaller. Values without MAGIC are plain narratives written before the payload format existed
+and are still served.
+"""
+import json
+import math
+import struct
+import time
+import zlib
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# A leading NUL byte never starts a plain (UTF-8 Markdown) narrative
+PAYLOAD_MAGIC = b"\x00N1"
+_HEADER_LENGTH = struct.Struct(">H")
+ZLIB_LEVEL = 6
+
+
+def encode_narrative(narrative: str, metadata: Dict[str, Any]) -> bytes:
+    raw = narrative.encode("utf-8")
+    compressed = zlib.compress(raw, ZLIB_LEVEL)
+    codec, body = ("zlib", compressed) if len(compressed) < len(raw) else ("raw", raw)
+    header = json.dumps({"codec": codec, **metadata}, separators=(",", ":")).encode("utf-8")
+    return PAYLOAD_MAGIC + _HEADER_LENGTH.pack(len(header)) + header + body
+
+
+def decode_narrative(payload: Any) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Returns (narrative, metadata); metadata is None for plain values. Raises ValueError if the payload is corrupt."""
+    if isinstance(payload, str):
+        return payload, None
+    if not payload.startswith(PAYLOAD_MAGIC):
+        return payload.decode("utf-8"), None
+    try:
+        start = len(PAYLOAD_MAGIC) + _HEADER_LENGTH.size
+        (header_length,) = _HEADER_LENGTH.unpack_from(payload, len(PAYLOAD_MAGIC))
+        metadata = json.loads(payload[start:start + header_length])
+        body = payload[start + header_length:]
+        codec = metadata.pop("codec")
+        if codec == "zlib":
+            body = zlib.decompress(body)
+        elif codec != "raw":
+            raise ValueError(f"Unknown narrative codec: {codec}")
+        return body.decode("utf-8"), metadata
+    except (struct.error, zlib.error, KeyError, TypeError) as e:
+        raise ValueError(f"Corrupt narrative payload: {e}") from e
+
+
+class NarrativeTTLPolicy:
+    """
+    TTLs from request counts ("hits", the compare set's popularity score).
+
+    A set requested once is kept for `min_ttl` seconds; each doubling of its hits adds
+    `base_ttl - min_ttl` (so 2 hits get `base_ttl`), up to `max_ttl`. Unknown popularity gets `base_ttl`.
+    With a `memory_budget_bytes`, Redis memory use is sampled at most every `check_interval` seconds;
+    over budget, the popularity bonus is scaled down by budget / used and sets requested only once
+    are not written to Redis at all, so cold entries go first and hot ones keep the longest TTLs.
+    """
+
+    def __init__(self, base_ttl: int, min_ttl: int, max_ttl: int, memory_budget_bytes: int = 0,
+                 check_interval: float = 60, clock: Callable[[], float] = time.monotonic):
+        if not 0 < min_ttl <= base_ttl <= max_ttl:
+            raise ValueError(f"TTLs must satisfy 0 < min <= base <= max, got {min_ttl}, {base_ttl}, {max_ttl}")
+        self.base_ttl = base_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.memory_budget_bytes = memory_budget_bytes
+        self.check_interval = check_interval
+        self._clock = clock
+        self._checked_at = None
+        self.used_memory_bytes = None
+
+    @property
+    def pressure(self) -> float:
+        """1.0 within budget, budget / used above it."""
+        if not self.memory_budget_bytes or not self.used_memory_bytes or self.used_memory_bytes <= self.memory_budget_bytes:
+            return 1.0
+        return self.memory_budget_bytes / self.used_memory_bytes
+
+    @property
+    def over_budget(self) -> bool:
+        return self.pressure < 1.0
+
+    def ttl_for(self, hits: Optional[float]) -> int:
+        doublings = 1.0 if hits is None else math.log2(max(hits, 1.0)) # Unknown popularity: base_ttl
+        ttl = self.min_ttl + (self.base_ttl - self.min_ttl) * doublings * self.pressure
+        return int(min(ttl, self.max_ttl))
+
+    def should_store(self, hits: Optional[float]) -> bool:
+        return not (self.over_budget and hits is not None and hits <= 1)
+
+    def memory_check_due(self) -> bool:
+        if not self.memory_budget_bytes:
+            return False
+        return self._checked_at is None or self._clock() - self._checked_at >= self.check_interval
+
+    def update_memory(self, used_memory_bytes: int):
+        self.used_memory_bytes = used_memory_bytes
+        self._checked_at = self._clock()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "memory_budget_bytes": self.memory_budget_bytes or None,
+            "used_memory_bytes": self.used_memory_bytes,
+            "ttl_pressure": round(self.pressure, 3),
+        }
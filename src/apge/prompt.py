@@ -0,0 +1,179 @@
+"""
+Compact, token-budgeted prompts for compare narratives.
+
+Protocols are sent as pipe-separated tables, each with its header written once. A protocol row references
+stimulation parameter sets (S1, S2, ...), which reference devices (D1, ...), and evidence records (E1, ...),
+so a device or study shared by several protocols is listed once. Cells without a value are left blank and
+columns without any value are left out.
+
+Tokens are estimated locally (no tokenizer download). When a prompt is over its budget, literature chunks
+are dropped least relevant first, then LOW_PRIORITY_FIELDS one at a time, then every evidence record
+but each protocol's best. The protocols themselves are never dropped.
+"""
+import json
+import math
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+STIM_FIELDS = ("frequency", "intensity", "pulses_per_session", "sessions")
+DEVICE_FIELDS = ("device_name", "coil_type", "manufacturer")
+EVIDENCE_FIELDS = ("level", "year", "title", "doi")
+
+# Table headers in the prompt, per field
+_HEADERS = {
+    "pulses_per_session": "pulses/session", "device_name": "name", "coil_type": "coil type",
+}
+
+# Dropped in this order when the prompt is over budget: the least useful to the comparison first
+LOW_PRIORITY_FIELDS = (("evidence", "doi"), ("devices", "manufacturer"), ("evidence", "title"))
+
+# Compare table columns a row falls back to when it has no Stim Params / Evidence lists
+_SCALAR_STIM_COLUMNS = {
+    "frequency": "Frequency", "intensity": "Intensity", "pulses_per_session": "Pulses/Session",
+    "sessions": "Sessions", "device_name": "Device Name", "coil_type": "Coil Type", "manufacturer": "Manufacturer",
+}
+_SCALAR_EVIDENCE_COLUMNS = {"level": "Evidence Level", "year": "Publication Year", "title": "Publication Title", "doi": "DOI"}
+
+NO_LITERATURE_TEXT = "No specific literature abstracts provided for this comparison."
+
+_WORD = re.compile(r"[^\W\d_]+|\d+|[^\w\s]|_")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Local token estimate for BPE tokenizers: about four letters per token for words, up to three digits
+    per token for numbers, one per punctuation mark. It errs on the high side for English prose, so a
+    prompt within the estimated budget is within the real one too.
+    """
+    tokens = 0
+    for piece in _WORD.findall(text):
+        if piece[0].isdigit():
+            tokens += math.ceil(len(piece) / 3)
+        elif piece[0].isalpha():
+            tokens += max(1, math.ceil(len(piece) / 4))
+        else:
+            tokens += 1
+    return tokens
+
+
+def estimate_message_tokens(messages: List[Dict[str, str]]) -> int:
+    # Chat formatting adds a few tokens per message and for the reply's priming
+    return sum(estimate_tokens(message["content"]) + 4 for message in messages) + 3
+
+
+def _cell(value: Any) -> str:
+    if value is None:
+        return ""
+    return " ".join(str(value).replace("|", "/").split())
+
+
+def _table(title: str, headers: List[str], rows: List[List[Any]]) -> str:
+    """One table; the first (id) column is always kept, the others only if some row has a value."""
+    keep = [i for i in range(len(headers)) if i == 0 or any(row[i] not in (None, "") for row in rows)]
+    lines = [f"{title}: " + " | ".join(headers[i] for i in keep)]
+    lines.extend(" | ".join(_cell(row[i]) for i in keep) for row in rows)
+    return "\n".join(lines)
+
+
+def _entries(protocol: Dict[str, Any], list_column: str, scalar_columns: Dict[str, str]) -> List[Dict[str, Any]]:
+    entries = protocol.get(list_column)
+    if entries:
+        return entries
+    scalar = {field: protocol.get(column) for field, column in scalar_columns.items()}
+    return [scalar] if any(value is not None for value in scalar.values()) else []
+
+
+class _Labels:
+    """Assigns labels (S1, S2, ...) to distinct values in first-seen order."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.rows: Dict[str, List[Any]] = {}
+
+    def label(self, values: List[Any]) -> str:
+        key = json.dumps(values, default=str)
+        if key not in self.rows:
+            self.rows[key] = [f"{self.prefix}{len(self.rows) + 1}", *values]
+        return self.rows[key][0]
+
+
+def encode_protocols(protocols: List[Dict[str, Any]], dropped_fields: Tuple[Tuple[str, str], ...] = (),
+                     best_evidence_only: bool = False) -> str:
+    """Encodes compare table rows (dicts keyed by the compare columns) as the prompt's protocol tables."""
+    def value(table: str, field: str, entry: Dict[str, Any]) -> Any:
+        return None if (table, field) in dropped_fields else entry.get(field)
+
+    devices, stim_sets, evidence = _Labels("D"), _Labels("S"), _Labels("E")
+    protocol_rows = []
+    for number, protocol in enumerate(protocols, 1):
+        stim_labels = []
+        for params in _entries(protocol, "Stim Params", _SCALAR_STIM_COLUMNS):
+            device = [value("devices", field, params) for field in DEVICE_FIELDS]
+            device_label = devices.label(device) if any(field is not None for field in device) else None
+            stim_labels.append(stim_sets.label([value("stim", field, params) for field in STIM_FIELDS] + [device_label]))
+        records = _entries(protocol, "Evidence", _SCALAR_EVIDENCE_COLUMNS)
+        if best_evidence_only:
+            records = records[:1] # Evidence lists are ranked best first
+        evidence_labels = [evidence.label([value("evidence", field, record) for field in EVIDENCE_FIELDS]) for record in records]
+        protocol_rows.append([f"P{number}", protocol.get("Protocol Name"), " ".join(stim_labels), " ".join(evidence_labels)])
+
+    tables = [_table("Protocols", ["id", "name", "stimulation", "evidence"], protocol_rows)]
+    for title, labels, fields in (("Stimulation", stim_sets, STIM_FIELDS + ("device",)),
+                                  ("Devices", devices, DEVICE_FIELDS),
+                                  ("Evidence", evidence, EVIDENCE_FIELDS)):
+        if labels.rows:
+            tables.append(_table(title, ["id"] + [_HEADERS.get(field, field) for field in fields], list(labels.rows.values())))
+    return "\n\n".join(tables)
+
+
+def build_user_prompt(protocols: List[Dict[str, Any]], lit_chunks: List[str], protocols_text: str) -> str:
+    literature_text = "\n\n".join(lit_chunks) if lit_chunks else NO_LITERATURE_TEXT
+    return f"""Here are {len(protocols)} protocols as pipe-separated tables (header row first, blank cells are not reported). Protocols reference stimulation parameter sets (S), which reference devices (D), and evidence records (E) by id:
+```text
+{protocols_text}
+```
+
+And here are {len(lit_chunks)} literature abstracts:
+```text
+{literature_text}
+```
+
+Please provide a 3-paragraph compare-and-contrast analysis focusing on coil physics, session burden, and evidence strength, followed by a 1-sentence clinical pearl.
+"""
+
+
+def build_compare_prompt(system_prompt: str, protocols: List[Dict[str, Any]], lit_chunks: List[str],
+                         token_budget: Optional[int] = None) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    """
+    Chat messages for a compare narrative, shrunk to `token_budget` estimated tokens if one is given.
+    Returns (messages, report) where the report has the estimated prompt_tokens and what was dropped.
+    """
+    retrieved, lit_chunks = len(lit_chunks), list(lit_chunks)
+    dropped_fields: Tuple[Tuple[str, str], ...] = ()
+    best_evidence_only = False
+    while True:
+        protocols_text = encode_protocols(protocols, dropped_fields, best_evidence_only)
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": build_user_prompt(protocols, lit_chunks, protocols_text)},
+        ]
+        prompt_tokens = estimate_message_tokens(messages)
+        if not token_budget or prompt_tokens <= token_budget:
+            break
+        if lit_chunks:
+            lit_chunks.pop() # Chunks are ordered most relevant first
+        elif len(dropped_fields) < len(LOW_PRIORITY_FIELDS):
+            dropped_fields = LOW_PRIORITY_FIELDS[:len(dropped_fields) + 1]
+        elif not best_evidence_only:
+            best_evidence_only = True
+        else:
+            break # Nothing left to drop but the protocols themselves
+    return messages, {
+        "prompt_tokens": prompt_tokens,
+        "token_budget": token_budget or None,
+        "within_budget": not token_budget or prompt_tokens <= token_budget,
+        "lit_chunks_used": len(lit_chunks),
+        "lit_chunks_dropped": retrieved - len(lit_chunks),
+        "fields_dropped": [f"{table}.{field}" for table, field in dropped_fields],
+        "best_evidence_only": best_evidence_only,
+    }
@@ -0,0 +1,206 @@
+"""
+Local literature retrieval for the compare narrative (lit_chunks).
+
+Studies from data/studies.json and research_sources/*.bib are merged by DOI, turned into one text chunk
+each and embedded into a float32 matrix stored on disk (vectors.f32) next to an ID sidecar (index.json).
+The matrix is memory-mapped read-only, so workers share the OS page cache instead of each holding a copy,
+and a query is a single BLAS matrix-vector product over the normalized rows (cosine similarity).
+
+The default embedder is a hashing bag-of-words model (no model download, no network). Anything with
+`name`, `dim` and `embed(texts) -> float32 array` can replace it; the index is rebuilt when the
+embedder or the source files change.
+"""
+import hashlib
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from .literature import merge_literature_records
+
+INDEX_VECTORS_FILE = "vectors.f32"
+INDEX_SIDECAR_FILE = "index.json"
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+# Too common in this corpus to tell studies apart
+_STOPWORDS = frozenset("a an and as at by for from in of on or the to with using via".split())
+
+
+class HashingEmbedder:
+    """
+    Feature-hashed unigrams and bigrams with sublinear term frequency, L2-normalized.
+    Deterministic across processes (blake2b, not Python's salted hash()).
+    """
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+        self.name = f"hashing-v1-{dim}"
+
+    def _features(self, text: str) -> List[str]:
+        tokens = [token for token in _TOKEN.findall(text.lower()) if token not in _STOPWORDS]
+        return tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts: Dict[int, float] = {}
+            for feature in self._features(text):
+                digest = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                bucket = digest % self.dim
+                sign = 1.0 if (digest >> 63) & 1 else -1.0 # Signed hashing keeps collisions unbiased
+                counts[bucket] = counts.get(bucket, 0.0) + sign
+            for bucket, count in counts.items():
+                vectors[row, bucket] = np.sign(count) * (1.0 + np.log(abs(count))) if count else 0.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+def load_literature_documents(studies_path: Optional[str], bib_paths: Iterable[str]) -> List[Dict[str, Any]]:
+    """
+    Merges the studies export and BibTeX files into one document per study (literature.merge_literature_records),
+    keyed by normalized DOI (study id or citation key if there is none). Returns [{"id", "chunk", "text"}] in first-seen order, where `chunk`
+    is passed to the LLM and `text` is embedded.
+    """
+    studies, _ = merge_literature_records(studies_path, bib_paths)
+    return [{"id": key, "chunk": format_chunk(study), "text": embedding_text(study)} for key, study in studies.items()]
+
+
+def embedding_text(study: Dict[str, Any]) -> str:
+    """What a study is about; authors and DOIs would only add noise to the similarity."""
+    return " ".join(str(study[field]) for field in ("title", "journal", "protocol", "main_finding") if study.get(field))
+
+
+def format_chunk(study: Dict[str, Any]) -> str:
+    """The text passed to the LLM as a literature abstract."""
+    venue = ", ".join(str(part) for part in (study.get("journal"), study.get("year")) if part)
+    lines = [f"{study.get('title') or 'Untitled'}" + (f" ({venue})" if venue else "")]
+    if study.get("authors"):
+        lines.append(f"Authors: {study['authors']}")
+    if study.get("n"):
+        lines.append(f"Sample size: {study['n']}")
+    if study.get("protocol"):
+        lines.append(f"Protocol: {study['protocol']}")
+    if study.get("main_finding"):
+        lines.append(f"Main finding: {study['main_finding']}")
+    if study.get("doi"):
+        lines.append(f"DOI: {study['doi']}")
+    return "\n".join(lines)
+
+
+# Bump when load_literature_documents/format_chunk/embedding_text change, so existing indexes are rebuilt
+DOCUMENT_FORMAT_VERSION = "2"
+
+
+def sources_fingerprint(paths: Iterable[Optional[str]], embedder_name: str) -> str:
+    digest = hashlib.sha256(f"{DOCUMENT_FORMAT_VERSION}:{embedder_name}".encode("utf-8"))
+    for path in paths:
+        if path and os.path.exists(path):
+            with open(path, "rb") as source:
+                digest.update(source.read())
+    return digest.hexdigest()
+
+
+class VectorIndex:
+    """Memory-mapped, row-normalized float32 matrix with an ID/chunk sidecar."""
+
+    def __init__(self, vectors: np.ndarray, ids: List[str], chunks: List[str], metadata: Dict[str, Any]):
+        self.vectors = vectors
+        self.ids = ids
+        self.chunks = chunks
+        self.metadata = metadata
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, directory: str, documents: List[Dict[str, Any]], embedder, fingerprint: str) -> "VectorIndex":
+        os.makedirs(directory, exist_ok=True)
+        vectors = embedder.embed([document["text"] for document in documents]) if documents \
+            else np.zeros((0, embedder.dim), dtype=np.float32)
+        metadata = {
+            "embedder": embedder.name, "dim": embedder.dim, "count": len(documents), "fingerprint": fingerprint,
+            "ids": [document["id"] for document in documents], "chunks": [document["chunk"] for document in documents],
+        }
+        # Both files are written aside and renamed into place, vectors first: a sidecar on disk always
+        # describes a complete matrix, and processes that still map the old matrix keep a valid file.
+        # The temp names are per process, so API workers building the same index at once never write
+        # into each other's file; the renames are atomic and every worker writes identical contents.
+        temp_suffix = f".{os.getpid()}.tmp"
+        vectors_path = os.path.join(directory, INDEX_VECTORS_FILE)
+        vectors.astype(np.float32).tofile(vectors_path + temp_suffix)
+        os.replace(vectors_path + temp_suffix, vectors_path)
+        sidecar_path = os.path.join(directory, INDEX_SIDECAR_FILE)
+        with open(sidecar_path + temp_suffix, "w", encoding="utf-8") as sidecar:
+            json.dump(metadata, sidecar)
+        os.replace(sidecar_path + temp_suffix, sidecar_path)
+        return cls.load(directory)
+
+    @classmethod
+    def load(cls, directory: str) -> "VectorIndex":
+        with open(os.path.join(directory, INDEX_SIDECAR_FILE), encoding="utf-8") as sidecar:
+            metadata = json.load(sidecar)
+        count, dim = metadata["count"], metadata["dim"]
+        if count:
+            vectors = np.memmap(os.path.join(directory, INDEX_VECTORS_FILE), dtype=np.float32, mode="r", shape=(count, dim))
+        else:
+            vectors = np.zeros((0, dim), dtype=np.float32) # np.memmap cannot map an empty file
+        return cls(vectors, metadata.pop("ids"), metadata.pop("chunks"), metadata)
+
+    def search(self, query_vectors: np.ndarray, k: int, min_score: float = 0.0) -> List[tuple]:
+        """
+        Top-k rows by cosine similarity, scoring each row by its best match over the query vectors.
+        Returns [(id, chunk, score)] best first.
+        """
+        if not len(self) or k <= 0 or not len(query_vectors):
+            return []
+        scores = (query_vectors @ self.vectors.T).max(axis=0) # One BLAS call: (queries x dim) @ (dim x rows)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(self.ids[i], self.chunks[i], float(scores[i])) for i in top if scores[i] > min_score]
+
+
+def load_or_build_index(directory: str, studies_path: Optional[str], bib_paths: List[str], embedder=None) -> VectorIndex:
+    """Loads the index in `directory`, rebuilding it first if the sources or the embedder changed."""
+    embedder = embedder or HashingEmbedder()
+    fingerprint = sources_fingerprint([studies_path, *bib_paths], embedder.name)
+    try:
+        index = VectorIndex.load(directory)
+        if index.metadata.get("fingerprint") == fingerprint:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass # Missing or unreadable: rebuild
+    documents = load_literature_documents(studies_path, bib_paths)
+    print(f"Building literature vector index ({len(documents)} documents) in {directory}.")
+    return VectorIndex.build(directory, documents, embedder, fingerprint)
+
+
+class LiteratureRetriever:
+    # Compare table columns that describe what a protocol is (name usually carries the target, e.g.
+    # "Left DLPFC 10Hz"; Frequency is the stimulation pattern, e.g. "iTBS")
+    QUERY_COLUMNS = ("Protocol Name", "Frequency", "Coil Type", "Publication Title")
+
+    def __init__(self, index: VectorIndex, embedder=None, top_k: int = 3, min_score: float = 0.1):
+        self.index = index
+        self.embedder = embedder or HashingEmbedder(index.metadata["dim"])
+        self.top_k = top_k
+        self.min_score = min_score
+
+    def query_texts(self, protocols_json_list: List[dict]) -> List[str]:
+        texts = []
+        for protocol in protocols_json_list:
+            text = " ".join(str(protocol[column]) for column in self.QUERY_COLUMNS if protocol.get(column))
+            if text and text not in texts:
+                texts.append(text)
+        return texts
+
+    def chunks_for_protocols(self, protocols_json_list: List[dict]) -> List[str]:
+        """Literature chunks relevant to any of the compared protocols, most relevant first."""
+        texts = self.query_texts(protocols_json_list)
+        if not texts:
+            return []
+        hits = self.index.search(self.embedder.embed(texts), self.top_k, self.min_score)
+        return [chunk for _, chunk, _ in hits]
@@ -0,0 +1,63 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import redis
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single execution.
+
+    The first caller for a key starts `fn()` as a task; callers arriving while it is still running
+    await the same task instead of starting their own. The key is forgotten as soon as the task
+    finishes, so later calls run `fn()` again (results are expected to be cached elsewhere).
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda finished: self._forget(key, finished))
+        # shield: a cancelled caller must not cancel the generation other callers are waiting on
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, finished: asyncio.Task):
+        if self._inflight.get(key) is finished:
+            del self._inflight[key]
+
+
+# Deletes the lock only if it still holds our token, so an expired lease re-acquired by another
+# worker is never released by the original holder.
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+async def acquire_lease(redis_client, lock_key: str, token: str, lease_ms: int) -> Optional[bool]:
+    """
+    Tries to take a cross-worker lock with `SET lock_key token NX PX lease_ms`.
+    Returns True if acquired, False if another worker holds it, None if Redis is unavailable.
+    """
+    try:
+        return bool(await redis_client.set(lock_key, token, nx=True, px=lease_ms))
+    except redis.exceptions.RedisError as e:
+        print(f"Redis lock acquisition failed for key {lock_key}: {e}")
+        return None
+
+
+async def release_lease(redis_client, lock_key: str, token: str):
+    try:
+        await redis_client.eval(_RELEASE_LEASE_SCRIPT, 1, lock_key, token)
+    except redis.exceptions.RedisError as e:
+        # The lease expires on its own; just log
+        print(f"Redis lock release failed for key {lock_key}: {e}")
@@ -0,0 +1,128 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+
+def normalize_diagnosis(diagnosis: Optional[str]) -> str:
+    return (diagnosis or "").strip().lower()
+
+
+@dataclass(frozen=True)
+class GraphSnapshot:
+    """
+    Immutable, in-memory copy of the data behind the read endpoints.
+
+    cards:               ProtocolCard dicts for every protocol, ordered by protocol name
+    cards_by_diagnosis:  normalized Diagnosis name/subtype -> cards of the protocols indicated for it
+    compare_rows_by_id:  protocol id -> its compare table rows (COMPARE_TABLE_COLUMNS order)
+    """
+    generation: Optional[str]
+    cards: List[Dict[str, Any]] = field(default_factory=list)
+    cards_by_diagnosis: Dict[str, List[Dict[str, Any]]] = field(default_factory=dict)
+    compare_rows_by_id: Dict[str, List[List[Any]]] = field(default_factory=dict)
+    loaded_at: float = field(default_factory=time.monotonic)
+
+    def list_cards(self, diagnosis: Optional[str] = None) -> List[Dict[str, Any]]:
+        if not diagnosis:
+            return self.cards
+        return self.cards_by_diagnosis.get(normalize_diagnosis(diagnosis), [])
+
+    def compare_rows(self, ids: Iterable[str]) -> List[List[Any]]:
+        # Same semantics as the UNWIND compare query: request order, unknown ids yield no rows
+        return [row for protocol_id in ids for row in self.compare_rows_by_id.get(protocol_id, [])]
+
+
+def build_snapshot(generation: Optional[str], list_records: Iterable[Any],
+                   compare_rows: Iterable[tuple]) -> GraphSnapshot:
+    """
+    Builds a GraphSnapshot from the snapshot list query records (id, label, device, evidence_level,
+    diagnosis_keys) and (protocol_id, row) pairs for the compare table.
+    """
+    cards = []
+    cards_by_diagnosis: Dict[str, List[Dict[str, Any]]] = {}
+    for record in list_records:
+        card = {
+            "id": record["id"],
+            "label": record["label"],
+            "device": record["device"],
+            "evidence_level": record["evidence_level"],
+        }
+        cards.append(card)
+        for diagnosis_key in {normalize_diagnosis(key) for key in record["diagnosis_keys"] or [] if key}:
+            cards_by_diagnosis.setdefault(diagnosis_key, []).append(card)
+
+    compare_rows_by_id: Dict[str, List[List[Any]]] = {}
+    for protocol_id, row in compare_rows:
+        compare_rows_by_id.setdefault(protocol_id, []).append(row)
+
+    return GraphSnapshot(
+        generation=generation,
+        cards=cards,
+        cards_by_diagnosis=cards_by_diagnosis,
+        compare_rows_by_id=compare_rows_by_id,
+    )
+
+
+class SnapshotEngine:
+    """
+    Keeps a GraphSnapshot current. `refresh()` reloads when the graph generation stamp changed, when
+    there is no stamp to compare, or when the snapshot is older than `max_age_seconds`; the new
+    snapshot replaces the old one in a single reference swap, so readers never see a partial load.
+    `start()` runs `refresh()` every `refresh_interval_seconds` in the background.
+    """
+
+    def __init__(self, load_generation: Callable[[], Awaitable[Optional[str]]],
+                 load_snapshot: Callable[[Optional[str]], Awaitable[GraphSnapshot]],
+                 refresh_interval_seconds: float = 30, max_age_seconds: float = 3600):
+        self._load_generation = load_generation
+        self._load_snapshot = load_snapshot
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.max_age_seconds = max_age_seconds
+        self.snapshot: Optional[GraphSnapshot] = None
+        self._refresh_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def is_stale(self, generation: Optional[str]) -> bool:
+        snapshot = self.snapshot
+        return (
+            snapshot is None
+            or generation is None
+            or snapshot.generation != generation
+            or time.monotonic() - snapshot.loaded_at >= self.max_age_seconds
+        )
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Reloads the snapshot if it is stale (or `force`). Returns True if a new snapshot was loaded."""
+        async with self._refresh_lock:
+            generation = await self._load_generation()
+            if not force and not self.is_stale(generation):
+                return False
+            started = time.perf_counter()
+            snapshot = await self._load_snapshot(generation)
+            self.snapshot = snapshot
+            print(f"Loaded graph snapshot (generation {generation}): {len(snapshot.cards)} protocols "
+                  f"in {time.perf_counter() - started:.3f}s.")
+            return True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                # Keep serving the previous snapshot; Neo4j may just be briefly unavailable
+                print(f"Graph snapshot refresh failed: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -1,10 +1,14 @@
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import MagicMock, patch
+from unittest.mock import AsyncMock, MagicMock, patch
 
 # Adjust the import path according to your project structure
 # This assumes your tests are in src/apge/tests and main.py is in src/apge
+from src.apge import main as apge_main
 from src.apge.main import app, get_db
+from src.apge.narrative_backend import TEMPLATE_NOTES
+from src.apge.narrative_store import decode_narrative, encode_narrative
 
 # Initialize TestClient
 client = TestClient(app)
@@ -34,6 +38,50 @@ MOCK_PROTOCOL_DATA_DEPRESSION = [
     MockNeo4jRecord({"id": "p1", "label": "Protocol Alpha MDD", "device": "Device X", "evidence_level": "High"}),
 ]
 
+# AsyncOpenAI class mock whose instances expose an awaitable chat.completions.create
+def make_async_openai_mock():
+    mock_openai_class = MagicMock()
+    mock_openai_class.return_value.chat.completions.create = AsyncMock()
+    return mock_openai_class
+
+class FakeRedisPipeline:
+    """Queues commands on the mocked client and awaits them in order on execute(), like a non-transactional pipeline."""
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append(getattr(self.client, name)(*args, **kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await command for command in commands]
+
+# redis_client mock whose pipeline() queues onto the client's own command mocks, so assertions on them still hold
+def make_redis_mock():
+    mock_redis = AsyncMock()
+    mock_redis.pipeline = MagicMock(side_effect=lambda **kwargs: FakeRedisPipeline(mock_redis))
+    return mock_redis
+
+def reset_shared_state():
+    # The app reuses one AsyncOpenAI client; drop it so each test sees its own patched class
+    apge_main._openai_client = None
+    apge_main._openai_client_api_key = None
+    # Narratives cached in-process by one test must not turn into cache hits in the next
+    apge_main.narrative_local_cache.clear()
+    apge_main.narrative_local_cache.reset_stats()
+    apge_main.list_response_cache.clear()
+    apge_main.graph_generation.reset()
+
+@pytest.fixture(autouse=True)
+def isolated_app_state():
+    reset_shared_state()
+    yield
+    reset_shared_state()
+
 @pytest.fixture
 def mock_db_session():
     mock_session = MagicMock()
@@ -106,19 +154,54 @@ def test_list_protocols_with_diagnosis(mock_db_session):
 import os
 import json
 import hashlib
+import time
 import redis # For redis.exceptions.RedisError
-from unittest.mock import ANY # For asserting some arguments generally
+from unittest.mock import ANY, call # For asserting some arguments generally
 
 # --- Tests for LLM and Redis Caching in POST /api/protocol/compare ---
 
-# Helper to generate cache key consistently
-def generate_expected_cache_key(ids: list[str]) -> str:
-    sorted_ids = sorted(ids)
-    ids_string = ",".join(sorted_ids)
-    return f"narrative:{hashlib.md5(ids_string.encode('utf-8')).hexdigest()}"
-
-@patch('src.apge.main.redis_client', new_callable=MagicMock)
-@patch('src.apge.main.OpenAI')
+# Redis SET calls that wrote a narrative, ignoring the single-flight lock (lock:<cache_key>) writes,
+# with the stored payload decoded back to the narrative
+def narrative_set_calls(mock_redis) -> list:
+    return [call(c.args[0], decode_narrative(c.args[1])[0], **c.kwargs)
+            for c in mock_redis.set.call_args_list if not c.args[0].startswith("lock:")]
+
+# TTL of a narrative whose compare set was requested once (the mocked ZINCRBY reports a count of 1)
+FIRST_REQUEST_TTL = apge_main.NARRATIVE_CACHE_MIN_TTL_SECONDS
+
+# Helper to generate the content-addressed cache key for the narrative of these Neo4j records
+def generate_expected_cache_key(records: list, lit_chunks: list = None) -> str:
+    rows = []
+    for record in records:
+        fields = record.fields # The flat fields the record was built from (see compare_record)
+        intensity = f"{fields['intensity']}%" if fields["intensity"] is not None else None
+        stim_params = {
+            "frequency": fields["frequency"], "intensity": intensity,
+            "pulses_per_session": fields["pulses_per_session"], "sessions": fields["num_sessions"],
+            "device_name": fields["device_name"], "coil_type": fields["coil_type"], "manufacturer": fields["manufacturer"],
+        }
+        evidence = {"level": fields["evidence_level"], "year": fields["publication_year"],
+                    "title": fields["publication_title"], "doi": fields["publication_doi"]}
+        rows.append({
+            "Protocol Name": fields["protocol_name"], "Coil Type": fields["coil_type"],
+            "Frequency": fields["frequency"], "Intensity": intensity,
+            "Pulses/Session": fields["pulses_per_session"], "Sessions": fields["num_sessions"],
+            "Evidence Level": fields["evidence_level"], "Device Name": fields["device_name"],
+            "Manufacturer": fields["manufacturer"], "Publication Title": fields["publication_title"],
+            "Publication Year": fields["publication_year"], "DOI": fields["publication_doi"],
+            "Stim Params": [stim_params], "Evidence": [evidence],
+        })
+    canonical = json.dumps({
+        "prompt_version": apge_main.NARRATIVE_PROMPT_VERSION,
+        "prompt_token_budget": apge_main.NARRATIVE_PROMPT_TOKEN_BUDGET,
+        "model": "gpt-3.5-turbo",
+        "protocols": sorted(json.dumps(row, sort_keys=True, separators=(",", ":")) for row in rows),
+        "lit_chunks": lit_chunks or [],
+    }, sort_keys=True, separators=(",", ":"))
+    return f"narrative:{hashlib.md5(canonical.encode('utf-8')).hexdigest()}"
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
 @patch('src.apge.main.os.getenv') # To control OPENAI_API_KEY
 def test_compare_llm_prompt_generation_and_success(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     # Setup: API Key is present, Cache miss, LLM success
@@ -146,28 +229,27 @@ def test_compare_llm_prompt_generation_and_success(mock_getenv, MockOpenAI, mock
     # Check system prompt
     assert "You are a neuro-psychiatry protocol analyst." in messages[0]['content']
 
-    # Check user prompt for new fields
-    user_prompt_json_str_start_index = messages[1]['content'].find('```json\n') + len('```json\n')
-    user_prompt_json_str_end_index = messages[1]['content'].find('\n```', user_prompt_json_str_start_index)
-    user_prompt_json_str = messages[1]['content'][user_prompt_json_str_start_index:user_prompt_json_str_end_index]
-
-    user_prompt_data = json.loads(user_prompt_json_str)
-    assert len(user_prompt_data) == 1 # Based on MOCK_PROTOCOL_DETAIL_P1
-    assert user_prompt_data[0]['Protocol Name'] == MOCK_PROTOCOL_DETAIL_P1['protocol_name']
-    assert user_prompt_data[0]['Publication Title'] == MOCK_PROTOCOL_DETAIL_P1['publication_title']
-    assert user_prompt_data[0]['DOI'] == MOCK_PROTOCOL_DETAIL_P1['publication_doi']
-    assert user_prompt_data[0]['Publication Year'] == MOCK_PROTOCOL_DETAIL_P1['publication_year']
-    assert "literature abstracts" in messages[1]['content']
+    # Check user prompt for new fields: compact tables (prompt.py), one protocol row and one evidence row
+    user_prompt = messages[1]['content']
+    assert "Here are 1 protocols as pipe-separated tables" in user_prompt
+    protocol_rows = [line for line in user_prompt.splitlines() if line.startswith("P1 | ")]
+    assert protocol_rows == [f"P1 | {MOCK_PROTOCOL_DETAIL_P1.fields['protocol_name']} | S1 | E1"]
+    evidence_rows = [line for line in user_prompt.splitlines() if line.startswith("E1 | ")]
+    assert len(evidence_rows) == 1
+    for field in ("publication_title", "publication_doi", "publication_year"):
+        assert str(MOCK_PROTOCOL_DETAIL_P1.fields[field]) in evidence_rows[0]
+    assert "literature abstracts" in user_prompt
+    assert "null" not in user_prompt and '"Protocol Name"' not in user_prompt
 
     # Assert caching behavior
-    expected_key = generate_expected_cache_key(["p1"])
-    mock_redis.get.assert_called_once_with(expected_key)
-    mock_redis.set.assert_called_once_with(expected_key, "Test LLM narrative", ex=3600)
+    expected_key = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1])
+    assert mock_redis.get.call_args_list == [call(expected_key)] * 2 # Lookup, then re-check after taking the lock
+    assert narrative_set_calls(mock_redis) == [call(expected_key, "Test LLM narrative", ex=FIRST_REQUEST_TTL)]
 
     app.dependency_overrides = {}
 
-@patch('src.apge.main.redis_client', new_callable=MagicMock)
-@patch('src.apge.main.OpenAI')
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
 @patch('src.apge.main.os.getenv')
 def test_compare_llm_api_error(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     mock_getenv.return_value = "fake_openai_key"
@@ -178,16 +260,20 @@ def test_compare_llm_api_error(mock_getenv, MockOpenAI, mock_redis, mock_db_sess
     mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
     app.dependency_overrides[get_db] = lambda: mock_db_session
 
+    fallbacks_before = apge_main.NARRATIVE_FALLBACKS.value(reason="error")
     payload = {"ids": ["p1"]}
     response = client.post("/api/protocol/compare", json=payload)
     assert response.status_code == 200
     data = response.json()
-    assert data["narrative_md"] == "Error generating narrative. Please try again later."
-    mock_redis.set.assert_not_called() # Error narrative should not be cached
+    # The template narrative built from the table answers instead of an error message
+    assert data["narrative_md"].startswith(f"**Coil.** The protocol uses {MOCK_PROTOCOL_DETAIL_P1.fields['coil_type']}.")
+    assert data["narrative_md"].endswith(TEMPLATE_NOTES["error"])
+    assert apge_main.NARRATIVE_FALLBACKS.value(reason="error") == fallbacks_before + 1
+    assert narrative_set_calls(mock_redis) == [] # The template narrative is not cached
     app.dependency_overrides = {}
 
-@patch('src.apge.main.redis_client', new_callable=MagicMock)
-@patch('src.apge.main.OpenAI')
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
 @patch('src.apge.main.os.getenv')
 def test_compare_missing_openai_key(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     mock_getenv.return_value = None # Simulate API key is MISSING
@@ -206,8 +292,8 @@ def test_compare_missing_openai_key(mock_getenv, MockOpenAI, mock_redis, mock_db
     mock_redis.set.assert_not_called() # This specific error narrative should not be cached
     app.dependency_overrides = {}
 
-@patch('src.apge.main.redis_client', new_callable=MagicMock)
-@patch('src.apge.main.OpenAI') # Still need to mock OpenAI though it shouldn't be called
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock) # Still need to mock OpenAI though it shouldn't be called
 @patch('src.apge.main.os.getenv')
 def test_compare_cache_hit(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     mock_getenv.return_value = "fake_openai_key" # API key available but shouldn't be used
@@ -224,14 +310,14 @@ def test_compare_cache_hit(mock_getenv, MockOpenAI, mock_redis, mock_db_session)
     data = response.json()
 
     assert data["narrative_md"] == cached_narrative_content
-    expected_key = generate_expected_cache_key(["p1"])
+    expected_key = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1])
     mock_redis.get.assert_called_once_with(expected_key)
     mock_llm_instance.chat.completions.create.assert_not_called()
     mock_redis.set.assert_not_called()
     app.dependency_overrides = {}
 
-@patch('src.apge.main.redis_client', new_callable=MagicMock)
-@patch('src.apge.main.OpenAI')
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
 @patch('src.apge.main.os.getenv')
 def test_compare_redis_get_failure(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     mock_getenv.return_value = "fake_openai_key"
@@ -249,12 +335,12 @@ def test_compare_redis_get_failure(mock_getenv, MockOpenAI, mock_redis, mock_db_
 
     assert data["narrative_md"] == "Fresh narrative after Redis GET fail"
     mock_llm_instance.chat.completions.create.assert_called_once() # Fallback to LLM
-    expected_key = generate_expected_cache_key(["p1"])
-    mock_redis.set.assert_called_once_with(expected_key, "Fresh narrative after Redis GET fail", ex=3600) # Attempt to cache new
+    expected_key = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1])
+    assert narrative_set_calls(mock_redis) == [call(expected_key, "Fresh narrative after Redis GET fail", ex=FIRST_REQUEST_TTL)] # Attempt to cache new
     app.dependency_overrides = {}
 
-@patch('src.apge.main.redis_client', new_callable=MagicMock)
-@patch('src.apge.main.OpenAI')
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
 @patch('src.apge.main.os.getenv')
 def test_compare_redis_set_failure(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     mock_getenv.return_value = "fake_openai_key"
@@ -274,12 +360,12 @@ def test_compare_redis_set_failure(mock_getenv, MockOpenAI, mock_redis, mock_db_
 
     assert data["narrative_md"] == llm_generated_narrative # User gets narrative despite cache SET fail
     mock_llm_instance.chat.completions.create.assert_called_once()
-    expected_key = generate_expected_cache_key(["p1"])
-    mock_redis.set.assert_called_once_with(expected_key, llm_generated_narrative, ex=3600)
+    expected_key = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1])
+    assert narrative_set_calls(mock_redis) == [call(expected_key, llm_generated_narrative, ex=FIRST_REQUEST_TTL)]
     app.dependency_overrides = {}
 
-@patch('src.apge.main.redis_client', new_callable=MagicMock)
-@patch('src.apge.main.OpenAI')
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
 @patch('src.apge.main.os.getenv')
 def test_compare_caching_skipped_for_error_narratives(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     mock_getenv.return_value = "fake_openai_key"
@@ -308,13 +394,13 @@ def test_compare_caching_skipped_for_error_narratives(mock_getenv, MockOpenAI, m
         assert data["narrative_md"] == error_narrative
 
         mock_llm_instance.chat.completions.create.assert_called() # LLM was called
-        mock_redis.set.assert_not_called() # Crucial: error narrative was NOT cached
+        assert narrative_set_calls(mock_redis) == [] # Crucial: error narrative was NOT cached
         mock_llm_instance.chat.completions.create.reset_mock() # Reset for next iteration
 
     app.dependency_overrides = {}
 
-@patch('src.apge.main.redis_client', new_callable=MagicMock)
-@patch('src.apge.main.OpenAI')
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
 @patch('src.apge.main.os.getenv')
 def test_compare_no_protocol_data_no_llm_call_no_caching(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     mock_getenv.return_value = "fake_openai_key" # API key available
@@ -333,14 +419,30 @@ def test_compare_no_protocol_data_no_llm_call_no_caching(mock_getenv, MockOpenAI
     mock_llm_instance.chat.completions.create.assert_not_called() # LLM not called if no protocol data
     mock_redis.set.assert_not_called() # Nothing to cache
 
-    # GET should still be called to check cache first
-    expected_key = generate_expected_cache_key(["p1", "p2"])
-    mock_redis.get.assert_called_once_with(expected_key)
+    # The cache key is derived from the protocol rows, so with no rows there is nothing to look up
+    mock_redis.get.assert_not_called()
 
     app.dependency_overrides = {}
 
 # --- Mock data for compare_protocols endpoint ---
-MOCK_PROTOCOL_DETAIL_P1 = MockNeo4jRecord({
+def compare_record(fields: dict) -> MockNeo4jRecord:
+    """COMPARE_QUERY record (one row per protocol) for a protocol with one StimParams/Device and one Evidence."""
+    device = None
+    if fields["device_name"] is not None:
+        device = {"name": fields["device_name"], "coil_type": fields["coil_type"], "manufacturer": fields["manufacturer"]}
+    record = MockNeo4jRecord({
+        "protocol_id": fields["protocol_id"], "protocol_name": fields["protocol_name"],
+        "stim_params": [{
+            "frequency": fields["frequency"], "intensity": fields["intensity"],
+            "pulses_per_session": fields["pulses_per_session"], "num_sessions": fields["num_sessions"], "device": device,
+        }],
+        "evidence": [{"level": fields["evidence_level"], "year": fields["publication_year"],
+                      "title": fields["publication_title"], "doi": fields["publication_doi"]}],
+    })
+    record.fields = fields
+    return record
+
+MOCK_PROTOCOL_DETAIL_P1 = compare_record({
     "protocol_id": "p1", "protocol_name": "Protocol Alpha",
     "frequency": "10 Hz", "intensity": 120.0, "pulses_per_session": 3000, "num_sessions": "20",
     "device_name": "Device X", "coil_type": "Figure-8", "manufacturer": "Mfg X",
@@ -348,7 +450,7 @@ MOCK_PROTOCOL_DETAIL_P1 = MockNeo4jRecord({
     "publication_title": "Efficacy of Alpha Protocol", "publication_year": 2022, "publication_doi": "10.1234/alpha.2022"
 })
 
-MOCK_PROTOCOL_DETAIL_P2 = MockNeo4jRecord({
+MOCK_PROTOCOL_DETAIL_P2 = compare_record({
     "protocol_id": "p2", "protocol_name": "Protocol Beta",
     "frequency": "iTBS", "intensity": 110.0, "pulses_per_session": 1800, "num_sessions": "30",
     "device_name": "Device Y", "coil_type": "H-Coil", "manufacturer": "Mfg Y",
@@ -356,7 +458,7 @@ MOCK_PROTOCOL_DETAIL_P2 = MockNeo4jRecord({
     "publication_title": "Beta Protocol for TRD", "publication_year": 2021, "publication_doi": "10.5678/beta.2021"
 })
 
-MOCK_PROTOCOL_DETAIL_P_INCOMPLETE = MockNeo4jRecord({ # For testing missing data
+MOCK_PROTOCOL_DETAIL_P_INCOMPLETE = compare_record({ # For testing missing data
     "protocol_id": "p3_incomplete", "protocol_name": "Protocol Gamma Incomplete",
     "frequency": "1 Hz", "intensity": 100.0, "pulses_per_session": 600, "num_sessions": "10",
     "device_name": None, "coil_type": None, "manufacturer": None, # Missing device
@@ -367,15 +469,16 @@ MOCK_PROTOCOL_DETAIL_P_INCOMPLETE = MockNeo4jRecord({ # For testing missing data
 EXPECTED_COMPARE_COLUMNS = [
     "Protocol Name", "Coil Type", "Frequency", "Intensity",
     "Pulses/Session", "Sessions", "Evidence Level", "Device Name",
-    "Manufacturer", "Publication Title", "Publication Year", "DOI"
+    "Manufacturer", "Publication Title", "Publication Year", "DOI",
+    "Stim Params", "Evidence",
 ]
 
 # --- Tests for POST /api/protocol/compare ---
 
 # This test now implicitly tests the old "LLM-generated narrative will be here in S-3"
 # because the LLM tests are separate. We focus on table structure here.
-@patch('src.apge.main.redis_client', new_callable=MagicMock) # Mock redis to prevent actual calls
-@patch('src.apge.main.OpenAI') # Mock OpenAI to prevent actual calls
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock) # Mock redis to prevent actual calls
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock) # Mock OpenAI to prevent actual calls
 @patch('src.apge.main.os.getenv')
 def test_compare_protocols_table_structure_valid_ids(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
     # Simulate that LLM/Redis part works but returns a known placeholder for this specific test
@@ -399,18 +502,18 @@ def test_compare_protocols_table_structure_valid_ids(mock_getenv, MockOpenAI, mo
 
     # Check first row data consistency for new fields
     row1_data = dict(zip(data["table"]["columns"], data["table"]["data"][0]))
-    assert row1_data["Protocol Name"] == MOCK_PROTOCOL_DETAIL_P1["protocol_name"]
-    assert row1_data["Coil Type"] == MOCK_PROTOCOL_DETAIL_P1["coil_type"]
-    assert row1_data["Intensity"] == f"{MOCK_PROTOCOL_DETAIL_P1['intensity']}%"
-    assert row1_data["Publication Title"] == MOCK_PROTOCOL_DETAIL_P1["publication_title"]
-    assert row1_data["Publication Year"] == MOCK_PROTOCOL_DETAIL_P1["publication_year"]
-    assert row1_data["DOI"] == MOCK_PROTOCOL_DETAIL_P1["publication_doi"]
+    assert row1_data["Protocol Name"] == MOCK_PROTOCOL_DETAIL_P1.fields["protocol_name"]
+    assert row1_data["Coil Type"] == MOCK_PROTOCOL_DETAIL_P1.fields["coil_type"]
+    assert row1_data["Intensity"] == f"{MOCK_PROTOCOL_DETAIL_P1.fields['intensity']}%"
+    assert row1_data["Publication Title"] == MOCK_PROTOCOL_DETAIL_P1.fields["publication_title"]
+    assert row1_data["Publication Year"] == MOCK_PROTOCOL_DETAIL_P1.fields["publication_year"]
+    assert row1_data["DOI"] == MOCK_PROTOCOL_DETAIL_P1.fields["publication_doi"]
 
     # Check second row data consistency for new fields
     row2_data = dict(zip(data["table"]["columns"], data["table"]["data"][1]))
-    assert row2_data["Protocol Name"] == MOCK_PROTOCOL_DETAIL_P2["protocol_name"]
-    assert row2_data["Publication Title"] == MOCK_PROTOCOL_DETAIL_P2["publication_title"]
-    assert row2_data["DOI"] == MOCK_PROTOCOL_DETAIL_P2["publication_doi"]
+    assert row2_data["Protocol Name"] == MOCK_PROTOCOL_DETAIL_P2.fields["protocol_name"]
+    assert row2_data["Publication Title"] == MOCK_PROTOCOL_DETAIL_P2.fields["publication_title"]
+    assert row2_data["DOI"] == MOCK_PROTOCOL_DETAIL_P2.fields["publication_doi"]
 
     assert data["narrative_md"] == "Narrative for table test" # From mock LLM for this test
     assert "lit_chunks" in data
@@ -419,9 +522,41 @@ def test_compare_protocols_table_structure_valid_ids(mock_getenv, MockOpenAI, mo
 
     app.dependency_overrides = {}
 
+def test_compare_row_aggregates_stim_params_and_ranks_evidence():
+    record = MockNeo4jRecord({
+        "protocol_id": "p1", "protocol_name": "Protocol Alpha",
+        "stim_params": [
+            {"frequency": "iTBS", "intensity": 110.0, "pulses_per_session": 600, "num_sessions": 30, "device": None},
+            {"frequency": "10 Hz", "intensity": 120.0, "pulses_per_session": 3000, "num_sessions": 20,
+             "device": {"name": "Device X", "coil_type": "Figure-8", "manufacturer": "Mfg X"}},
+            {"frequency": "iTBS", "intensity": 110.0, "pulses_per_session": 600, "num_sessions": 30, "device": None},
+        ],
+        "evidence": [
+            {"level": "Emerging", "year": 2024, "title": "Pilot", "doi": "10.1/pilot"},
+            {"level": "High", "year": 2010, "title": "Older RCT", "doi": "10.1/old"},
+            {"level": "Unrated", "year": None, "title": "Case report", "doi": None},
+            {"level": "high", "year": 2018, "title": "Newer RCT", "doi": "10.1/new"},
+        ],
+    })
+
+    row = dict(zip(apge_main.COMPARE_TABLE_COLUMNS, apge_main.compare_row_from_record(record)))
+
+    assert [params["frequency"] for params in row["Stim Params"]] == ["10 Hz", "iTBS"] # Sorted, duplicate dropped
+    assert row["Stim Params"][0]["intensity"] == "120.0%" and row["Stim Params"][1]["device_name"] is None
+    assert [evidence["title"] for evidence in row["Evidence"]] == ["Newer RCT", "Older RCT", "Pilot", "Case report"]
+    # Scalar columns summarize the first StimParams and the best evidence
+    assert (row["Frequency"], row["Coil Type"], row["Sessions"]) == ("10 Hz", "Figure-8", 20)
+    assert (row["Evidence Level"], row["Publication Year"], row["DOI"]) == ("high", 2018, "10.1/new")
+
+def test_compare_query_returns_one_row_per_protocol():
+    # Chained OPTIONAL MATCHes multiply rows; the aggregated query only unwinds the requested IDs
+    query = apge_main.COMPARE_QUERY
+    assert "OPTIONAL MATCH" not in query
+    assert "AS stim_params" in query and "AS evidence" in query
+
 @patch('src.apge.main.os.getenv') # Keep mocks for other tests that don't focus on table structure
-@patch('src.apge.main.OpenAI')
-@patch('src.apge.main.redis_client')
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
 def test_compare_protocols_empty_id_list(mock_redis, MockOpenAI, mock_getenv, mock_db_session):
     # No need to mock getenv, OpenAI, redis_client here as the function should return early
     app.dependency_overrides[get_db] = lambda: mock_db_session
@@ -441,8 +576,8 @@ def test_compare_protocols_empty_id_list(mock_redis, MockOpenAI, mock_getenv, mo
     app.dependency_overrides = {}
 
 @patch('src.apge.main.os.getenv')
-@patch('src.apge.main.OpenAI')
-@patch('src.apge.main.redis_client')
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
 def test_compare_protocols_non_existent_ids(mock_redis, MockOpenAI, mock_getenv, mock_db_session):
     mock_getenv.return_value = "fake_key_for_table_test"
     mock_redis.get.return_value = None
@@ -473,8 +608,8 @@ def test_compare_protocols_non_existent_ids(mock_redis, MockOpenAI, mock_getenv,
     app.dependency_overrides = {}
 
 @patch('src.apge.main.os.getenv')
-@patch('src.apge.main.OpenAI')
-@patch('src.apge.main.redis_client')
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
 def test_compare_protocols_with_incomplete_data(mock_redis, MockOpenAI, mock_getenv, mock_db_session):
     mock_getenv.return_value = "fake_key_for_table_test"
     mock_redis.get.return_value = None
@@ -496,9 +631,9 @@ def test_compare_protocols_with_incomplete_data(mock_redis, MockOpenAI, mock_get
     # Check that None values are handled correctly (example: device_name is index 7)
     assert data["table"]["data"][0][7] is None # Device Name should be None
     assert data["table"]["data"][0][1] is None # Coil Type
-    assert data["table"]["data"][0][10] is None # Reference/DOI
+    assert data["table"]["data"][0][11] is None # Reference/DOI
 
-    assert data["narrative_md"] == "LLM-generated narrative will be here in S-3."
+    assert data["narrative_md"] == "Narrative for incomplete data test"
 
     mock_db_session.run.assert_called_once_with(ANY, ids=payload["ids"])
 
@@ -537,3 +672,1125 @@ def test_list_protocols_with_diagnosis_no_match(mock_db_session):
     assert params.get("diagnosis") == diagnosis_query
 
     app.dependency_overrides = {}
+
+def test_cypher_runs_on_neo4j_executor(mock_db_session):
+    import threading
+    query_threads = []
+
+    def fake_run(query, *args, **kwargs):
+        if "MATCH (p:Protocol" in query: # Ignore the graph generation lookup
+            query_threads.append(threading.current_thread().name)
+        return MOCK_PROTOCOL_DATA_FULL
+    mock_db_session.run.side_effect = fake_run
+
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.get("/api/protocol/list")
+
+    assert response.status_code == 200
+    assert len(response.json()) == len(MOCK_PROTOCOL_DATA_FULL)
+    # Exactly one round trip, made from the dedicated executor rather than the event loop thread
+    assert len(query_threads) == 1
+    assert query_threads[0].startswith("neo4j")
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_reuses_shared_openai_client(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = None
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="Shared client narrative"))])
+
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    for records in ([MOCK_PROTOCOL_DETAIL_P1], [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]):
+        mock_db_session.run.return_value = records # Different data, so the second call is a cache miss too
+        response = client.post("/api/protocol/compare", json={"ids": [r["protocol_id"] for r in records]})
+        assert response.status_code == 200
+        assert response.json()["narrative_md"] == "Shared client narrative"
+
+    MockOpenAI.assert_called_once_with(api_key="fake_openai_key") # Constructed once, then reused
+    assert MockOpenAI.return_value.chat.completions.create.await_count == 2
+
+    app.dependency_overrides = {}
+
+# --- Tests for POST /api/protocol/compare/stream (Server-Sent Events) ---
+
+def parse_sse_events(body: str) -> list:
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+def make_stream_chunks(deltas):
+    async def stream():
+        for delta in deltas:
+            yield MagicMock(choices=[MagicMock(delta=MagicMock(content=delta))])
+    return stream()
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_stream_sends_table_then_narrative_tokens(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = None # Cache miss
+    mock_llm_create = MockOpenAI.return_value.chat.completions.create
+    mock_llm_create.return_value = make_stream_chunks(["Streamed ", "narrative", None])
+
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.post("/api/protocol/compare/stream", json={"ids": ["p1", "p2"]})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse_events(response.text)
+
+    assert events[0][0] == "table"
+    assert events[0][1]["columns"] == EXPECTED_COMPARE_COLUMNS
+    assert len(events[0][1]["data"]) == 2
+    assert [data["delta"] for name, data in events if name == "narrative"] == ["Streamed ", "narrative"]
+    assert events[-1] == ("done", {"narrative_md": "Streamed narrative", "lit_chunks": []})
+
+    assert mock_llm_create.call_args.kwargs["stream"] is True
+    expected_key = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2])
+    assert narrative_set_calls(mock_redis) == [call(expected_key, "Streamed narrative", ex=FIRST_REQUEST_TTL)]
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_stream_cache_hit_and_llm_error(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_llm_create = MockOpenAI.return_value.chat.completions.create
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    # Cache hit: the whole cached narrative arrives as one event, no LLM call
+    mock_redis.get.return_value = "Cached streamed narrative"
+    events = parse_sse_events(client.post("/api/protocol/compare/stream", json={"ids": ["p1"]}).text)
+    assert [name for name, _ in events] == ["table", "narrative", "done"]
+    assert events[-1][1]["narrative_md"] == "Cached streamed narrative"
+    mock_llm_create.assert_not_called()
+
+    # Cache miss with a failing LLM: error event, nothing cached
+    apge_main.narrative_local_cache.clear() # Drop the copy the hit above stored in-process
+    mock_redis.get.return_value = None
+    mock_llm_create.side_effect = Exception("LLM API Down")
+    events = parse_sse_events(client.post("/api/protocol/compare/stream", json={"ids": ["p1"]}).text)
+    assert [name for name, _ in events] == ["table", "error", "done"]
+    assert events[-1][1]["narrative_md"] == "Error generating narrative. Please try again later."
+    assert narrative_set_calls(mock_redis) == [] # Only the lease was taken
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', None)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_concurrent_stream_misses_share_one_llm_call(mock_getenv, MockOpenAI):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_llm_create = MockOpenAI.return_value.chat.completions.create
+
+    async def slow_stream(**kwargs):
+        await asyncio.sleep(0.05) # Long enough for the other requests to join
+        return make_stream_chunks(["Streamed ", "narrative"])
+
+    mock_llm_create.side_effect = slow_stream
+    protocols_json_list = [{"Protocol Name": "Protocol Alpha"}]
+
+    async def collect():
+        return [delta async for delta in apge_main.stream_narrative_coalesced("narrative:stream", protocols_json_list, [])]
+
+    async def scenario():
+        return await asyncio.gather(collect(), collect(), collect())
+
+    leader, *followers = asyncio.run(scenario())
+    assert leader == ["Streamed ", "narrative"] # Token by token
+    assert followers == [["Streamed narrative"]] * 2 # The finished narrative, as one delta
+    mock_llm_create.assert_called_once()
+    assert mock_llm_create.call_args.kwargs["timeout"] == apge_main.NARRATIVE_LLM_TIMEOUT_SECONDS
+    assert apge_main.narrative_local_cache.get("narrative:stream") == "Streamed narrative"
+
+@patch('src.apge.main.NARRATIVE_LOCK_POLL_SECONDS', 0)
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_waits_for_narrative_from_lease_holder(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    # Another worker holds the lease: miss, then miss while polling, then its narrative appears
+    mock_redis.get.side_effect = [None, None, "Narrative from other worker"]
+    mock_redis.set.return_value = None # SET NX fails while the lease is held
+
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.post("/api/protocol/compare", json={"ids": ["p1"]})
+
+    assert response.status_code == 200
+    assert response.json()["narrative_md"] == "Narrative from other worker"
+    MockOpenAI.return_value.chat.completions.create.assert_not_called()
+    assert narrative_set_calls(mock_redis) == []
+    lock_calls = mock_redis.set.call_args_list
+    assert lock_calls[0].args[0] == "lock:" + generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1])
+    assert lock_calls[0].kwargs["nx"] is True
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_hot_narrative_served_from_local_cache(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Narrative from Redis"
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    for _ in range(3):
+        response = client.post("/api/protocol/compare", json={"ids": ["p1"]})
+        assert response.json()["narrative_md"] == "Narrative from Redis"
+
+    mock_redis.get.assert_called_once() # Only the first request left the process
+    stats = client.get("/api/cache/stats").json()["narrative_local"]
+    assert stats["hits"] == 2
+    assert stats["misses"] == 1
+    assert stats["entries"] == 1
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', None) # Redis unreachable at startup
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_caches_locally_when_redis_is_down(mock_getenv, MockOpenAI, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_llm_create = MockOpenAI.return_value.chat.completions.create
+    mock_llm_create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="Local-only narrative"))])
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    for _ in range(2):
+        response = client.post("/api/protocol/compare", json={"ids": ["p1"]})
+        assert response.json()["narrative_md"] == "Local-only narrative"
+
+    mock_llm_create.assert_called_once()
+    assert client.get("/api/cache/stats").json()["redis_enabled"] is False
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_skips_redis_while_circuit_is_open(mock_getenv, MockOpenAI, mock_db_session):
+    from src.apge.breaker import CircuitBreaker, CircuitBreakerRedis
+
+    mock_getenv.return_value = "fake_openai_key"
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(
+        choices=[MagicMock(message=MagicMock(content="Narrative during outage"))])
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    raw_redis = AsyncMock()
+    breaker = CircuitBreaker("Redis")
+    breaker.trip()
+
+    with patch('src.apge.main.redis_breaker', breaker), \
+         patch('src.apge.main.redis_client', CircuitBreakerRedis(raw_redis, breaker)):
+        response = client.post("/api/protocol/compare", json={"ids": ["p2"]})
+        stats = client.get("/api/cache/stats").json()
+
+    assert response.json()["narrative_md"] == "Narrative during outage"
+    assert raw_redis.mock_calls == [] # No GET, lock, SET or popularity round trips while open
+    assert stats["redis_enabled"] is False and stats["redis_circuit"] == "open"
+
+    apge_main.narrative_local_cache.clear()
+    app.dependency_overrides = {}
+
+# --- Tests for cached /api/protocol/list responses (ETag / 304) ---
+
+def make_list_run_mock(mock_db_session, generation, protocols):
+    """Answers the graph generation lookup with `generation` and the list query with `protocols`."""
+    def fake_run(query, *args, **kwargs):
+        if "APGEGraphMeta" in query:
+            return [MockNeo4jRecord({"generation": generation})] if generation else []
+        return protocols
+    mock_db_session.run.side_effect = fake_run
+
+def list_query_count(mock_db_session) -> int:
+    return sum(1 for c in mock_db_session.run.call_args_list if "MATCH (p:Protocol" in c.args[0])
+
+def test_list_protocols_cached_per_generation_with_etag(mock_db_session):
+    make_list_run_mock(mock_db_session, "gen-1", MOCK_PROTOCOL_DATA_FULL)
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    first = client.get("/api/protocol/list?diagnosis=Depression")
+    assert first.status_code == 200
+    etag = first.headers["etag"]
+    assert etag.startswith('"') and etag.endswith('"')
+    assert first.headers["cache-control"] == apge_main.LIST_CACHE_CONTROL
+
+    # Same normalized diagnosis: served from cache, no list query
+    second = client.get("/api/protocol/list?diagnosis=%20depression%20")
+    assert second.status_code == 200
+    assert second.content == first.content
+    assert second.headers["etag"] == etag
+    assert list_query_count(mock_db_session) == 1
+
+    # Conditional request: 304 with no body
+    not_modified = client.get("/api/protocol/list?diagnosis=Depression", headers={"If-None-Match": f'W/{etag}, "other"'})
+    assert not_modified.status_code == 304
+    assert not_modified.content == b""
+    assert not_modified.headers["etag"] == etag
+    assert list_query_count(mock_db_session) == 1
+
+    app.dependency_overrides = {}
+
+def test_list_protocols_cache_invalidated_by_new_generation(mock_db_session):
+    make_list_run_mock(mock_db_session, "gen-1", MOCK_PROTOCOL_DATA_FULL)
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    etag = client.get("/api/protocol/list").headers["etag"]
+
+    # The seeder stamps a new generation and the data changes
+    make_list_run_mock(mock_db_session, "gen-2", MOCK_PROTOCOL_DATA_DEPRESSION)
+    apge_main.graph_generation.reset() # Skip the generation re-check interval
+    response = client.get("/api/protocol/list", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert len(response.json()) == len(MOCK_PROTOCOL_DATA_DEPRESSION)
+    assert response.headers["etag"] != etag
+    assert list_query_count(mock_db_session) == 2
+
+    app.dependency_overrides = {}
+
+def test_list_protocols_not_cached_without_generation(mock_db_session):
+    make_list_run_mock(mock_db_session, None, MOCK_PROTOCOL_DATA_FULL)
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    etag = client.get("/api/protocol/list").headers["etag"]
+    assert client.get("/api/protocol/list", headers={"If-None-Match": etag}).status_code == 304
+    assert list_query_count(mock_db_session) == 2 # Queried again, only the body was saved
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_cache_key_follows_protocol_data(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Cached narrative"
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    # Key is independent of ID order...
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]})
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P2, MOCK_PROTOCOL_DETAIL_P1]
+    apge_main.narrative_local_cache.clear()
+    client.post("/api/protocol/compare", json={"ids": ["p2", "p1"]})
+    first_key, second_key = [c.args[0] for c in mock_redis.get.call_args_list]
+    assert first_key == second_key == generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2])
+
+    # ...but changes when a reseed changes the protocol's StimParams
+    reseeded_p1 = compare_record({**MOCK_PROTOCOL_DETAIL_P1.fields, "pulses_per_session": 1800})
+    mock_db_session.run.return_value = [reseeded_p1, MOCK_PROTOCOL_DETAIL_P2]
+    client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]})
+    assert mock_redis.get.call_args.args[0] != first_key
+
+    # ...and when the prompt version is bumped
+    with patch('src.apge.main.NARRATIVE_PROMPT_VERSION', apge_main.NARRATIVE_PROMPT_VERSION + "-next"):
+        mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+        client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]})
+    assert mock_redis.get.call_args.args[0] != first_key
+
+    app.dependency_overrides = {}
+
+# --- Tests for serving reads from the in-memory graph snapshot ---
+
+def make_snapshot_engine():
+    from src.apge.snapshot import SnapshotEngine, build_snapshot
+    engine = SnapshotEngine(load_generation=AsyncMock(), load_snapshot=AsyncMock())
+    engine.snapshot = build_snapshot(
+        "gen-snap",
+        [{"id": "p1", "label": "Protocol Alpha", "device": "Device X", "evidence_level": "High",
+          "diagnosis_keys": ["depression"]},
+         {"id": "p2", "label": "Protocol Beta", "device": "Device Y", "evidence_level": "Medium",
+          "diagnosis_keys": []}],
+        [(record["protocol_id"], apge_main.compare_row_from_record(record))
+         for record in (MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2)],
+    )
+    return engine
+
+@patch('src.apge.main.graph_snapshot_engine', new_callable=make_snapshot_engine)
+def test_list_protocols_served_from_snapshot(mock_engine, mock_db_session):
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    all_protocols = client.get("/api/protocol/list").json()
+    depression = client.get("/api/protocol/list?diagnosis=Depression").json()
+
+    assert [p["id"] for p in all_protocols] == ["p1", "p2"]
+    assert depression == [{"id": "p1", "label": "Protocol Alpha", "device": "Device X", "evidence_level": "High"}]
+    mock_db_session.run.assert_not_called()
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.graph_snapshot_engine', new_callable=make_snapshot_engine)
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_table_served_from_snapshot(mock_getenv, MockOpenAI, mock_redis, mock_engine, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Cached narrative"
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    data = client.post("/api/protocol/compare", json={"ids": ["p2", "p1"]}).json()
+
+    assert [row[0] for row in data["table"]["data"]] == ["Protocol Beta", "Protocol Alpha"]
+    assert data["narrative_md"] == "Cached narrative"
+    mock_db_session.run.assert_not_called()
+    # Same content-addressed key as when the rows come from Neo4j
+    mock_redis.get.assert_called_once_with(generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]))
+
+    app.dependency_overrides = {}
+
+
+# --- Tests for indexed diagnosis lookups and /api/diagnosis/search ---
+
+def test_list_protocols_diagnosis_filter_uses_normalized_properties(mock_db_session):
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    client.get("/api/protocol/list?diagnosis=Depression")
+
+    query_string = mock_db_session.run.call_args[0][0]
+    assert "d.name_norm = toLower(trim($diagnosis))" in query_string
+    assert "toLower(d.name)" not in query_string # Would bypass the range index
+
+    app.dependency_overrides = {}
+
+def test_search_diagnoses_queries_fulltext_index(mock_db_session):
+    mock_db_session.run.return_value = [
+        MockNeo4jRecord({"name": "Major Depressive Disorder", "subtype": None, "score": 2.5}),
+        MockNeo4jRecord({"name": "Major Depressive Disorder", "subtype": "Treatment-Resistant", "score": 1.25}),
+    ]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.get("/api/diagnosis/search?q=major dep&limit=500")
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {"name": "Major Depressive Disorder", "subtype": None, "score": 2.5},
+        {"name": "Major Depressive Disorder", "subtype": "Treatment-Resistant", "score": 1.25},
+    ]
+    query_string, params = mock_db_session.run.call_args[0]
+    assert "db.index.fulltext.queryNodes('diagnosis_search'" in query_string
+    assert params == {"query": "(major* OR major~) AND (dep* OR dep~)", "limit": apge_main.DIAGNOSIS_SEARCH_MAX_LIMIT}
+
+    app.dependency_overrides = {}
+
+def test_search_diagnoses_blank_query_skips_neo4j(mock_db_session):
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.get("/api/diagnosis/search?q=%20%20")
+
+    assert response.status_code == 200
+    assert response.json() == []
+    mock_db_session.run.assert_not_called()
+
+    app.dependency_overrides = {}
+
+def test_build_fulltext_query_escapes_lucene_syntax():
+    assert apge_main.build_fulltext_query("OCD") == "(OCD* OR OCD~)"
+    assert apge_main.build_fulltext_query("a+b:") == r"(a\+b\:* OR a\+b\:~)"
+    assert apge_main.build_fulltext_query("") is None
+
+
+# --- Tests for /metrics and Server-Timing ---
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_reports_phase_timings_and_metrics(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = None
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(
+        choices=[MagicMock(message=MagicMock(content="Metrics narrative"))],
+        usage=MagicMock(prompt_tokens=120, completion_tokens=80),
+    )
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    prompt_tokens_before = apge_main.LLM_TOKENS_TOTAL.value(kind="prompt")
+    llm_calls_before = apge_main.PHASE_SECONDS.count(phase="llm")
+
+    response = client.post("/api/protocol/compare", json={"ids": ["p1"]})
+
+    phases = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+    assert phases[-1] == "total"
+    assert {"cypher", "rows", "cache_get", "cache_set", "llm"} <= set(phases)
+    assert apge_main.LLM_TOKENS_TOTAL.value(kind="prompt") == prompt_tokens_before + 120
+    assert apge_main.PHASE_SECONDS.count(phase="llm") == llm_calls_before + 1
+
+    metrics_response = client.get("/metrics")
+    assert metrics_response.status_code == 200
+    assert metrics_response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = metrics_response.text
+    assert 'apge_phase_duration_seconds_count{phase="llm"}' in text
+    assert 'apge_http_request_duration_seconds_count{method="POST",route="/api/protocol/compare"}' in text
+    assert 'apge_llm_tokens_total{kind="completion"}' in text
+    assert "apge_narrative_cache_hit_ratio" in text
+    assert "apge_http_requests_in_flight 1.0" in text # The /metrics request itself
+    assert "apge_llm_requests_in_flight 0.0" in text
+
+    app.dependency_overrides = {}
+
+
+# --- Tests for keyset pagination and fields= projection on /api/protocol/list ---
+
+def test_list_protocols_keyset_pagination(mock_db_session):
+    # The query returns limit + 1 rows when there is a next page
+    mock_db_session.run.return_value = MOCK_PROTOCOL_DATA_FULL
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    first_page = client.get("/api/protocol/list?limit=2")
+
+    assert [p["id"] for p in first_page.json()] == ["p1", "p2"]
+    query_string, params = mock_db_session.run.call_args[0]
+    assert "LIMIT $limit" in query_string
+    assert query_string.index("LIMIT $limit") < query_string.index("OPTIONAL MATCH") # Page cut before expanding
+    assert params == {"limit": 3}
+    cursor = first_page.headers[apge_main.NEXT_CURSOR_HEADER]
+    assert apge_main.decode_list_cursor(cursor) == ("Protocol Beta", "p2")
+
+    mock_db_session.run.return_value = MOCK_PROTOCOL_DATA_FULL[2:]
+    last_page = client.get(f"/api/protocol/list?limit=2&cursor={cursor}")
+
+    assert [p["id"] for p in last_page.json()] == ["p3"]
+    assert apge_main.NEXT_CURSOR_HEADER not in last_page.headers
+    params = mock_db_session.run.call_args[0][1]
+    assert params == {"after_name": "Protocol Beta", "after_id": "p2", "limit": 3}
+
+    app.dependency_overrides = {}
+
+def test_list_protocols_pages_past_unnamed_protocols(mock_db_session):
+    mock_db_session.run.return_value = [
+        MockNeo4jRecord({"id": "p1", "label": "Protocol Alpha"}),
+        MockNeo4jRecord({"id": "p7", "label": None}), # Unnamed protocols sort last
+        MockNeo4jRecord({"id": "p8", "label": None}),
+    ]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    first_page = client.get("/api/protocol/list?limit=2&fields=id,label")
+    query_string = mock_db_session.run.call_args[0][0]
+    assert "ORDER BY p.name IS NULL, p.name, p.id" in query_string
+    cursor = first_page.headers[apge_main.NEXT_CURSOR_HEADER]
+    assert apge_main.decode_list_cursor(cursor) == (None, "p7")
+
+    mock_db_session.run.return_value = [MockNeo4jRecord({"id": "p8", "label": None})]
+    last_page = client.get(f"/api/protocol/list?limit=2&fields=id,label&cursor={cursor}")
+
+    assert last_page.status_code == 200
+    assert last_page.json() == [{"id": "p8", "label": None}]
+    query_string, params = mock_db_session.run.call_args[0]
+    assert "p.name IS NULL AND p.id > $after_id" in query_string
+    assert params == {"after_id": "p7", "limit": 3}
+
+    app.dependency_overrides = {}
+
+def test_list_protocols_rejects_invalid_pagination_params(mock_db_session):
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    assert client.get("/api/protocol/list?cursor=not-a-cursor").status_code == 400
+    assert client.get("/api/protocol/list?limit=0").status_code == 422
+    assert client.get(f"/api/protocol/list?limit={apge_main.LIST_MAX_LIMIT + 1}").status_code == 422
+    assert client.get("/api/protocol/list?fields=id,secret").status_code == 400
+    mock_db_session.run.assert_not_called()
+
+    app.dependency_overrides = {}
+
+def test_list_protocols_fields_projection_skips_optional_matches(mock_db_session):
+    mock_db_session.run.return_value = [
+        MockNeo4jRecord({"id": "p1", "label": "Protocol Alpha"}),
+        MockNeo4jRecord({"id": "p2", "label": "Protocol Beta"}),
+    ]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.get("/api/protocol/list?diagnosis=Depression&fields=label,id")
+
+    assert response.json() == [{"id": "p1", "label": "Protocol Alpha"}, {"id": "p2", "label": "Protocol Beta"}]
+    query_string = mock_db_session.run.call_args[0][0]
+    assert "OPTIONAL MATCH" not in query_string
+    assert "WITH DISTINCT p" in query_string
+
+    app.dependency_overrides = {}
+
+@pytest.mark.parametrize("fast_json", [False, True])
+@patch('src.apge.main.graph_snapshot_engine', new_callable=make_snapshot_engine)
+def test_list_protocols_paginates_snapshot(mock_engine, mock_db_session, fast_json):
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    with patch('src.apge.main.FAST_JSON_RESPONSES', fast_json):
+        first_page = client.get("/api/protocol/list?limit=1&fields=id")
+        cursor = first_page.headers[apge_main.NEXT_CURSOR_HEADER]
+        second_page = client.get(f"/api/protocol/list?limit=1&fields=id&cursor={cursor}")
+
+    assert first_page.json() == [{"id": "p1"}]
+    assert second_page.json() == [{"id": "p2"}]
+    assert apge_main.NEXT_CURSOR_HEADER not in second_page.headers
+    mock_db_session.run.assert_not_called()
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.graph_snapshot_engine', new_callable=make_snapshot_engine)
+def test_list_protocols_paginates_snapshot_past_unnamed_protocols(mock_engine, mock_db_session):
+    from src.apge.snapshot import build_snapshot
+    mock_engine.snapshot = build_snapshot("gen-snap", [
+        {"id": "p1", "label": "Protocol Alpha", "device": None, "evidence_level": None, "diagnosis_keys": []},
+        {"id": "p7", "label": None, "device": None, "evidence_level": None, "diagnosis_keys": []},
+        {"id": "p8", "label": None, "device": None, "evidence_level": None, "diagnosis_keys": []},
+    ], [])
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    ids, cursor = [], None
+    for _ in range(3):
+        page = client.get("/api/protocol/list?limit=1&fields=id" + (f"&cursor={cursor}" if cursor else ""))
+        assert page.status_code == 200
+        ids += [p["id"] for p in page.json()]
+        cursor = page.headers.get(apge_main.NEXT_CURSOR_HEADER)
+
+    assert ids == ["p1", "p7", "p8"] and cursor is None
+
+    app.dependency_overrides = {}
+
+
+# --- Tests for POST /api/protocol/compare/batch ---
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_batch_one_query_one_mget_generates_only_misses(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    key_p1 = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1])
+    key_p2 = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P2])
+    key_both = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2])
+    mock_redis.mget.return_value = ["Cached p1 narrative", None, None]
+    mock_redis.get.return_value = None # Re-check after taking the generation lease
+    MockOpenAI.return_value.chat.completions.create.side_effect = [
+        MagicMock(choices=[MagicMock(message=MagicMock(content="Generated narrative A"))]),
+        MagicMock(choices=[MagicMock(message=MagicMock(content="Generated narrative B"))]),
+    ]
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.post("/api/protocol/compare/batch", json={"sets": [["p1"], ["p1", "p2"], ["p2", "p1"], ["p2"], []]})
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert len(results) == 5
+
+    # One UNWIND query for the union of the IDs
+    mock_db_session.run.assert_called_once()
+    assert mock_db_session.run.call_args.kwargs == {"ids": ["p1", "p2"]}
+    # One MGET for the distinct keys; ["p1", "p2"] and ["p2", "p1"] share a key
+    mock_redis.mget.assert_called_once_with([key_p1, key_both, key_p2])
+    assert MockOpenAI.return_value.chat.completions.create.call_count == 2
+
+    assert results[0]["narrative_md"] == "Cached p1 narrative"
+    assert [row[0] for row in results[1]["table"]["data"]] == ["Protocol Alpha", "Protocol Beta"]
+    assert [row[0] for row in results[2]["table"]["data"]] == ["Protocol Beta", "Protocol Alpha"] # Request order
+    assert results[1]["narrative_md"] == results[2]["narrative_md"]
+    assert {results[1]["narrative_md"], results[3]["narrative_md"]} == {"Generated narrative A", "Generated narrative B"}
+    assert results[4] == {"table": {"columns": [], "data": []}, "narrative_md": apge_main.NO_IDS_NARRATIVE, "lit_chunks": []}
+    assert sorted(c.args[0] for c in narrative_set_calls(mock_redis)) == sorted([key_both, key_p2])
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_batch_matches_single_compare(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Cached narrative"
+    mock_redis.mget.side_effect = redis.exceptions.RedisError("Redis down") # Falls back to generating
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="Cached narrative"))])
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    single = client.post("/api/protocol/compare", json={"ids": ["p1", "missing"]}).json()
+    apge_main.narrative_local_cache.clear()
+    batch = client.post("/api/protocol/compare/batch", json={"sets": [["p1", "missing"]]}).json()
+
+    assert batch["results"] == [single]
+
+    app.dependency_overrides = {}
+
+def test_compare_batch_rejects_too_many_sets(mock_db_session):
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.post("/api/protocol/compare/batch", json={"sets": [["p1"]] * (apge_main.COMPARE_BATCH_MAX_SETS + 1)})
+
+    assert response.status_code == 422
+    mock_db_session.run.assert_not_called()
+
+    app.dependency_overrides = {}
+
+
+# --- Tests for compare popularity tracking and narrative pre-warming ---
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_records_set_popularity(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Cached narrative"
+    mock_redis.mget.return_value = ["Cached narrative"]
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    client.post("/api/protocol/compare", json={"ids": ["p2", "p1"]})
+    client.post("/api/protocol/compare/batch", json={"sets": [["p1", "p2"], ["p1", "p2"], []]})
+
+    assert mock_redis.zincrby.call_args_list == [call(apge_main.NARRATIVE_POPULARITY_KEY, 1, '["p1","p2"]')] * 2
+    assert call(transaction=False) in mock_redis.pipeline.call_args_list # Pipelined: one round trip per request
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+def test_local_hit_does_not_wait_for_popularity(mock_redis, mock_db_session):
+    async def slow_zincrby(*args):
+        await asyncio.sleep(5)
+        return 1.0
+    mock_redis.zincrby.side_effect = slow_zincrby
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    apge_main.narrative_local_cache.set(generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1]), "Local narrative")
+
+    started = time.perf_counter()
+    response = client.post("/api/protocol/compare", json={"ids": ["p1"]})
+
+    assert response.json()["narrative_md"] == "Local narrative"
+    assert time.perf_counter() - started < 2 # The bump is still running; the response did not wait for it
+    mock_redis.get.assert_not_called()
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_ignores_popularity_failures(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Cached narrative"
+    mock_redis.zincrby.side_effect = redis.exceptions.RedisError("Redis down")
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    response = client.post("/api/protocol/compare", json={"ids": ["p1"]})
+
+    assert response.status_code == 200
+    assert response.json()["narrative_md"] == "Cached narrative"
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.driver')
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_prewarm_generates_missing_and_extends_cached_narratives(mock_getenv, MockOpenAI, mock_redis, mock_driver, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_driver.session.return_value.__enter__.return_value = mock_db_session
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    # Most popular first; "gone" was removed by a reseed
+    mock_redis.zrevrange.return_value = [(b'["p1","p2"]', 40.0), (b'["p1"]', 8.0), (b'["gone"]', 2.0)]
+    mock_redis.mget.return_value = [None, encode_narrative("Cached p1 narrative", {"model": "m"})]
+    mock_redis.get.return_value = None
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="Warm narrative"))])
+    key_both = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2])
+    key_p1 = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1])
+
+    stats = asyncio.run(apge_main.prewarm_narratives(top_k=3, concurrency=2))
+
+    assert stats == {"sets": 3, "cached": 1, "generated": 1, "failed": 0}
+    mock_redis.zrevrange.assert_called_once_with(apge_main.NARRATIVE_POPULARITY_KEY, 0, 2, withscores=True)
+    mock_db_session.run.assert_called_once()
+    assert mock_db_session.run.call_args.kwargs == {"ids": ["p1", "p2", "gone"]}
+    mock_redis.mget.assert_called_once_with([key_both, key_p1])
+    # TTLs follow popularity: 8 requests -> 3 doublings, 40 requests -> log2(40) doublings
+    mock_redis.expire.assert_called_once_with(key_p1, apge_main.narrative_ttl_policy.ttl_for(8.0))
+    assert narrative_set_calls(mock_redis) == [call(key_both, "Warm narrative", ex=apge_main.narrative_ttl_policy.ttl_for(40.0))]
+    assert apge_main.narrative_ttl_policy.ttl_for(40.0) > apge_main.narrative_ttl_policy.ttl_for(8.0) > apge_main.NARRATIVE_CACHE_TTL_SECONDS
+
+@patch('src.apge.main.redis_client', None)
+def test_prewarm_skipped_without_redis():
+    assert asyncio.run(apge_main.prewarm_narratives()) == {"sets": 0, "cached": 0, "generated": 0, "failed": 0}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+def test_popularity_decays_once_per_interval(mock_redis):
+    mock_redis.set.side_effect = [True, None] # The second worker finds the marker already set
+    mock_redis.zremrangebyscore.return_value = 3
+
+    assert asyncio.run(apge_main.decay_narrative_popularity(factor=0.5, interval_seconds=3600)) is True
+    assert asyncio.run(apge_main.decay_narrative_popularity(factor=0.5, interval_seconds=3600)) is False
+
+    assert mock_redis.set.call_args_list == [call(apge_main.NARRATIVE_POPULARITY_DECAY_MARKER_KEY, "1", nx=True, ex=3600)] * 2
+    mock_redis.zunionstore.assert_called_once_with(apge_main.NARRATIVE_POPULARITY_KEY, {apge_main.NARRATIVE_POPULARITY_KEY: 0.5})
+    mock_redis.zremrangebyscore.assert_called_once_with(
+        apge_main.NARRATIVE_POPULARITY_KEY, "-inf", f"({apge_main.NARRATIVE_POPULARITY_MIN_SCORE}")
+
+
+# --- Tests for literature retrieval in compare ---
+
+class FakeLiteratureRetriever:
+    def __init__(self):
+        self.queries = []
+
+    def chunks_for_protocols(self, protocols_json_list):
+        self.queries.append([protocol["Protocol Name"] for protocol in protocols_json_list])
+        return [f"Study about {protocol['Protocol Name']}" for protocol in protocols_json_list]
+
+@patch('src.apge.main.literature_retriever', new_callable=FakeLiteratureRetriever)
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_passes_retrieved_literature_to_prompt_and_cache_key(mock_getenv, MockOpenAI, mock_redis, mock_retriever, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = None
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="Narrative with literature"))])
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    data = client.post("/api/protocol/compare", json={"ids": ["p1"]}).json()
+
+    assert data["lit_chunks"] == ["Study about Protocol Alpha"]
+    assert mock_retriever.queries == [["Protocol Alpha"]]
+    messages = MockOpenAI.return_value.chat.completions.create.call_args.kwargs["messages"]
+    assert "here are 1 literature abstracts" in messages[1]["content"]
+    assert "Study about Protocol Alpha" in messages[1]["content"]
+    expected_key = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1], ["Study about Protocol Alpha"])
+    assert narrative_set_calls(mock_redis) == [call(expected_key, "Narrative with literature", ex=FIRST_REQUEST_TTL)]
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.LIT_BIB_DIR', os.path.join(os.path.dirname(apge_main.PROJECT_ROOT), "missing"))
+def test_load_literature_retriever_from_repository_sources(tmp_path):
+    pytest.importorskip("numpy")
+    with patch('src.apge.main.LIT_INDEX_DIR', str(tmp_path / "lit_index")):
+        retriever = apge_main.load_literature_retriever()
+    assert len(retriever.index) == 12 # data/studies.json alone
+    assert (tmp_path / "lit_index" / "vectors.f32").exists()
+
+# --- Tests for lifespan startup and /ready ---
+
+def make_startup_driver(connectivity_failures: int = 0):
+    driver = MagicMock()
+    driver.verify_connectivity.side_effect = [Exception("Neo4j unavailable")] * connectivity_failures + [None] * 10
+    return driver
+
+def startup_patches(driver):
+    return [
+        patch('src.apge.main.driver', driver),
+        patch('src.apge.main.redis_client', make_redis_mock()),
+        patch('src.apge.main.graph_snapshot_engine', None),
+        patch('src.apge.main.LIT_RETRIEVAL_ENABLED', False),
+    ]
+
+def test_lifespan_warms_pools_and_reports_startup_timings():
+    driver = make_startup_driver()
+    patches = startup_patches(driver)
+    for p in patches:
+        p.start()
+    try:
+        with TestClient(app) as startup_client:
+            response = startup_client.get("/ready")
+    finally:
+        for p in reversed(patches):
+            p.stop()
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["status"] == "ready"
+    assert body["checks"]["neo4j"] is True and body["checks"]["redis"] == "closed"
+    assert {"neo4j", "redis", "total"} <= set(body["startup_ms"])
+    # Each warm connection is held by its own open transaction
+    assert driver.session.return_value.begin_transaction.call_count == apge_main.NEO4J_WARM_CONNECTIONS
+
+def test_lifespan_can_run_twice_in_one_process(mock_db_session):
+    mock_db_session.run.return_value = MOCK_PROTOCOL_DATA_FULL
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    statuses = []
+    for _ in range(2): # e.g. scripts/prewarm.py after the app, or consecutive test clients
+        patches = startup_patches(make_startup_driver())
+        for p in patches:
+            p.start()
+        try:
+            with TestClient(app) as startup_client:
+                statuses.append(startup_client.get("/api/protocol/list").status_code)
+            # Shut down and reset, so the next lifespan creates its own
+            assert apge_main.neo4j_executor is None and apge_main.redis_client is None and apge_main.driver is None
+        finally:
+            for p in reversed(patches):
+                p.stop()
+
+    assert statuses == [200, 200]
+
+    app.dependency_overrides = {}
+
+def test_ready_is_unavailable_until_neo4j_is_reachable():
+    patches = startup_patches(make_startup_driver(connectivity_failures=2)) # Startup check and first probe fail
+    for p in patches:
+        p.start()
+    try:
+        with TestClient(app) as startup_client:
+            first = startup_client.get("/ready")
+            second = startup_client.get("/ready")
+    finally:
+        for p in reversed(patches):
+            p.stop()
+
+    assert first.status_code == 503 and first.json()["checks"]["neo4j"] is False
+    assert second.status_code == 200
+
+def test_import_defers_clients_and_openai_sdk():
+    import subprocess
+    import sys
+    code = ("import sys; from src.apge import main; "
+            "print(main.driver is None, main.redis_client is None, main.neo4j_executor is None, 'openai' in sys.modules)")
+    output = subprocess.run([sys.executable, "-c", code], cwd=apge_main.PROJECT_ROOT,
+                            capture_output=True, text=True, check=True).stdout.split()
+    assert output[-4:] == ["True", "True", "True", "False"]
+
+# --- Tests for the fast response path (FAST_JSON_RESPONSES, layout=columns, compression) ---
+
+def test_fast_list_bodies_are_byte_identical(mock_db_session):
+    mock_db_session.run.return_value = MOCK_PROTOCOL_DATA_FULL
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    urls = ["/api/protocol/list", "/api/protocol/list?fields=label,id", "/api/protocol/list?limit=2",
+            "/api/protocol/list?limit=2&fields=id"] # The cursor needs the label the projection drops
+
+    def responses():
+        apge_main.list_response_cache.clear()
+        return [client.get(url) for url in urls]
+
+    default = responses()
+    with patch('src.apge.main.FAST_JSON_RESPONSES', True):
+        fast = responses()
+
+    for default_response, fast_response in zip(default, fast):
+        assert fast_response.content == default_response.content
+        assert fast_response.headers["ETag"] == default_response.headers["ETag"]
+        assert fast_response.headers.get(apge_main.NEXT_CURSOR_HEADER) == default_response.headers.get(apge_main.NEXT_CURSOR_HEADER)
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_fast_compare_bodies_are_byte_identical(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Narrative with ünïcode and \"quotes\""
+    mock_redis.mget.return_value = ["Narrative with ünïcode and \"quotes\""]
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    requests = [("/api/protocol/compare", {"ids": ["p1", "p2"]}), ("/api/protocol/compare", {"ids": []}),
+                ("/api/protocol/compare/batch", {"sets": [["p1", "p2"], []]})]
+
+    default = [client.post(url, json=payload, headers={"Accept-Encoding": "identity"}) for url, payload in requests]
+    with patch('src.apge.main.FAST_JSON_RESPONSES', True):
+        fast = [client.post(url, json=payload, headers={"Accept-Encoding": "identity"}) for url, payload in requests]
+
+    for default_response, fast_response in zip(default, fast):
+        assert fast_response.status_code == 200
+        assert fast_response.content == default_response.content
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_column_layout_and_compression(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Cached narrative"
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    rows = client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]}).json()
+    with patch('src.apge.main.RESPONSE_COMPRESSION_MIN_BYTES', 1):
+        response = client.post("/api/protocol/compare?layout=columns", json={"ids": ["p1", "p2"]},
+                               headers={"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip" and response.headers["Vary"] == "Accept-Encoding"
+    table = response.json()["table"] # Decompressed by the test client
+    assert table["layout"] == "columns" and table["columns"] == EXPECTED_COMPARE_COLUMNS
+    assert [list(row) for row in zip(*table["data"])] == rows["table"]["data"]
+    assert response.json()["narrative_md"] == rows["narrative_md"]
+
+    small = client.post("/api/protocol/compare?layout=columns", json={"ids": ["p1", "p2"]}, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in small.headers # Below RESPONSE_COMPRESSION_MIN_BYTES
+    assert client.post("/api/protocol/compare?layout=diagonal", json={"ids": ["p1"]}).status_code == 422
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.serialization.orjson', None)
+@patch('src.apge.serialization.brotli', None)
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_fast_compare_path_without_optional_encoders(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    # Without orjson and brotli installed: stdlib JSON with identical bytes, gzip instead of br
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = "Narrative with ünïcode"
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+
+    default = client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]}, headers={"Accept-Encoding": "identity"})
+    with patch('src.apge.main.FAST_JSON_RESPONSES', True), patch('src.apge.main.RESPONSE_COMPRESSION_MIN_BYTES', 1):
+        fast = client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]}, headers={"Accept-Encoding": "identity"})
+        compressed = client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]}, headers={"Accept-Encoding": "br, gzip"})
+
+    assert fast.content == default.content
+    assert compressed.headers["Content-Encoding"] == "gzip" and compressed.json() == default.json()
+
+    app.dependency_overrides = {}
+
+def test_openapi_describes_both_compare_layouts():
+    schema = app.openapi()
+    for path, models in (("/api/protocol/compare", {"CompareResponse", "CompareColumnsResponse"}),
+                         ("/api/protocol/compare/batch", {"CompareBatchResponse", "CompareColumnsBatchResponse"})):
+        response_schema = schema["paths"][path]["post"]["responses"]["200"]["content"]["application/json"]["schema"]
+        assert {option["$ref"].rsplit("/", 1)[-1] for option in response_schema["anyOf"]} == models
+    columns_table = schema["components"]["schemas"]["ColumnsTableResponse"]
+    assert columns_table["properties"]["layout"]["const"] == "columns" and "layout" in columns_table["required"]
+
+# --- Tests for compressed narrative storage and popularity-aware TTLs ---
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_stores_compressed_payload_and_extends_hot_entries(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    long_narrative = "Figure-8 coils are focal; H-coils reach deeper. " * 60
+    mock_redis.get.return_value = None
+    mock_redis.zincrby.return_value = 16.0
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(
+        choices=[MagicMock(message=MagicMock(content=long_narrative))],
+        usage=MagicMock(prompt_tokens=300, completion_tokens=150),
+    )
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    expected_key = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1])
+    hot_ttl = apge_main.narrative_ttl_policy.ttl_for(16.0)
+
+    client.post("/api/protocol/compare", json={"ids": ["p1"]})
+
+    (stored_key, payload), kwargs = mock_redis.set.call_args_list[-1]
+    narrative, metadata = decode_narrative(payload)
+    assert stored_key == expected_key and narrative == long_narrative
+    assert len(payload) < len(long_narrative) / 4
+    assert metadata["tokens"] == 150 and metadata["model"] == apge_main.NARRATIVE_MODEL
+    assert metadata["prompt_version"] == apge_main.NARRATIVE_PROMPT_VERSION and metadata["created_at"] > 0
+    assert kwargs == {"ex": hot_ttl}
+
+    # Served from Redis on another worker: the hit extends the TTL to the set's current popularity
+    apge_main.narrative_local_cache.clear()
+    mock_redis.get.return_value = payload
+    mock_redis.zincrby.return_value = 64.0
+    response = client.post("/api/protocol/compare", json={"ids": ["p1"]})
+
+    assert response.json()["narrative_md"] == long_narrative
+    mock_redis.expire.assert_called_once_with(expected_key, apge_main.narrative_ttl_policy.ttl_for(64.0))
+
+    app.dependency_overrides = {}
+
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_over_memory_budget_keeps_one_off_narratives_local(mock_getenv, MockOpenAI, mock_redis, mock_db_session):
+    from src.apge.narrative_store import NarrativeTTLPolicy
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = None
+    mock_redis.zincrby.return_value = 1.0
+    mock_redis.info.return_value = {"used_memory": 4096}
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="One-off narrative"))])
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    policy = NarrativeTTLPolicy(base_ttl=3600, min_ttl=900, max_ttl=86400, memory_budget_bytes=1024)
+
+    with patch('src.apge.main.narrative_ttl_policy', policy):
+        first = client.post("/api/protocol/compare", json={"ids": ["p1"]})
+        apge_main.narrative_local_cache.clear()
+        mock_redis.zincrby.return_value = 2.0 # Requested again: worth a (shortened) Redis entry
+        client.post("/api/protocol/compare", json={"ids": ["p1"]})
+        stats = client.get("/api/cache/stats").json()["narrative_redis"]
+
+    assert first.json()["narrative_md"] == "One-off narrative"
+    mock_redis.info.assert_called_once_with("memory") # Sampled once per check interval
+    assert narrative_set_calls(mock_redis) == [
+        call(generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1]), "One-off narrative", ex=900 + 2700 // 4)]
+    assert stats["ttl_pressure"] == 0.25 and stats["used_memory_bytes"] == 4096
+    assert stats["bytes_stored"] > 0
+
+    app.dependency_overrides = {}
+
+# --- Tests for the token-budgeted narrative prompt ---
+
+class RankedLiteratureRetriever:
+    def chunks_for_protocols(self, protocols_json_list):
+        return ["Relevant study", "Marginal study " * 200] # Most relevant first
+
+@patch('src.apge.main.literature_retriever', new_callable=RankedLiteratureRetriever)
+@patch('src.apge.main.redis_client', new_callable=make_redis_mock)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_reports_prompt_tokens_and_enforces_budget(mock_getenv, MockOpenAI, mock_redis, mock_retriever, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+    mock_redis.get.return_value = None
+    MockOpenAI.return_value.chat.completions.create.return_value = MagicMock(choices=[MagicMock(message=MagicMock(content="Budgeted narrative"))])
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    observations_before = apge_main.NARRATIVE_PROMPT_TOKENS.count()
+
+    with patch('src.apge.main.NARRATIVE_PROMPT_TOKEN_BUDGET', 1000):
+        response = client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]})
+
+    assert response.json()["narrative_md"] == "Budgeted narrative"
+    messages = MockOpenAI.return_value.chat.completions.create.call_args.kwargs["messages"]
+    assert "Relevant study" in messages[1]["content"] and "Marginal study" not in messages[1]["content"]
+    assert apge_main.NARRATIVE_PROMPT_TOKENS.count() == observations_before + 1
+    _, metadata = decode_narrative(mock_redis.set.call_args_list[-1].args[1])
+    assert 0 < metadata["prompt_tokens"] <= 1000
+    # Narratives built under another budget are not reused
+    with patch('src.apge.main.NARRATIVE_PROMPT_TOKEN_BUDGET', 1000):
+        budgeted_key = generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2], mock_retriever.chunks_for_protocols([]))
+    assert mock_redis.set.call_args_list[-1].args[0] == budgeted_key
+    assert budgeted_key != generate_expected_cache_key([MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2], mock_retriever.chunks_for_protocols([]))
+
+    app.dependency_overrides = {}
+
+# --- Tests for the narrative deadline ---
+
+@patch('src.apge.main.redis_client', None)
+@patch('src.apge.main.AsyncOpenAI', new_callable=make_async_openai_mock)
+@patch('src.apge.main.os.getenv')
+def test_compare_answers_with_template_when_llm_misses_deadline(mock_getenv, MockOpenAI, mock_db_session):
+    mock_getenv.return_value = "fake_openai_key"
+
+    async def slow_completion(**kwargs):
+        await asyncio.sleep(1)
+        return MagicMock(choices=[MagicMock(message=MagicMock(content="Late LLM narrative"))])
+
+    MockOpenAI.return_value.chat.completions.create.side_effect = slow_completion
+    mock_db_session.run.return_value = [MOCK_PROTOCOL_DETAIL_P1, MOCK_PROTOCOL_DETAIL_P2]
+    app.dependency_overrides[get_db] = lambda: mock_db_session
+    fallbacks_before = apge_main.NARRATIVE_FALLBACKS.value(reason="deadline")
+
+    with patch.object(apge_main.narrative_backend, "deadline_seconds", 0.05):
+        started = time.perf_counter()
+        response = client.post("/api/protocol/compare", json={"ids": ["p1", "p2"]})
+        elapsed = time.perf_counter() - started
+
+    narrative = response.json()["narrative_md"]
+    assert response.status_code == 200 and elapsed < 0.5
+    assert "Protocol Alpha: Figure-8; Protocol Beta: H-Coil" in narrative
+    assert "The strongest reported evidence is for Protocol Alpha." in narrative
+    assert apge_main.NARRATIVE_FALLBACKS.value(reason="deadline") == fallbacks_before + 1
+    assert MockOpenAI.return_value.chat.completions.create.call_args.kwargs["timeout"] == apge_main.NARRATIVE_LLM_TIMEOUT_SECONDS
+
+    app.dependency_overrides = {}
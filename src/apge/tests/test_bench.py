@@ -0,0 +1,21 @@
+import json
+
+from scripts import bench
+
+def test_quick_benchmark_run_writes_comparable_json(tmp_path, capsys):
+    base_path = tmp_path / "base.json"
+    assert bench.main(["--quick", "--output", str(base_path)]) == 0
+
+    report = json.loads(base_path.read_text())
+    assert set(report["meta"]) == {"commit", "timestamp", "python", "platform"}
+    assert {result["benchmark"] for result in report["results"].values()} == {name for name, _, _ in bench.BENCHMARKS}
+    assert all(result["size"] == bench.QUICK_SIZES and result["min_s"] > 0 for result in report["results"].values())
+
+    # A head that is 10x slower on one benchmark fails the comparison
+    head = json.loads(base_path.read_text())
+    head["results"]["list_cards[10]"]["median_s"] *= 10
+    head_path = tmp_path / "head.json"
+    head_path.write_text(json.dumps(head))
+    assert bench.main(["--compare", str(base_path), str(base_path)]) == 0
+    assert bench.main(["--compare", str(base_path), str(head_path), "--threshold", "50"]) == 1
+    assert "list_cards[10]" in capsys.readouterr().out
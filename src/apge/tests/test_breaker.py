@@ -0,0 +1,105 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+import redis
+
+from src.apge.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakerRedis, CircuitOpenError
+
+def test_breaker_opens_after_consecutive_failures_only():
+    breaker = CircuitBreaker("Redis", failure_threshold=3)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success() # Resets the run
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow_request()
+    assert breaker.times_opened == 1
+
+def test_open_circuit_fails_fast_without_calling_redis():
+    client = AsyncMock()
+    client.get.side_effect = redis.exceptions.ConnectionError("Connection refused")
+    breaker = CircuitBreaker("Redis", failure_threshold=2)
+    wrapped = CircuitBreakerRedis(client, breaker)
+
+    async def scenario():
+        for _ in range(2):
+            with pytest.raises(redis.exceptions.ConnectionError):
+                await wrapped.get("k")
+        with pytest.raises(CircuitOpenError):
+            await wrapped.get("k")
+        with pytest.raises(redis.exceptions.RedisError): # Existing handlers catch it as a Redis error
+            await wrapped.set("k", "v")
+
+    asyncio.run(scenario())
+    assert breaker.state == OPEN
+    assert client.get.await_count == 2 # The third call never reached the client
+    client.set.assert_not_awaited()
+
+def test_command_errors_do_not_open_the_circuit():
+    client = AsyncMock()
+    client.zincrby.side_effect = redis.exceptions.ResponseError("WRONGTYPE")
+    breaker = CircuitBreaker("Redis", failure_threshold=1)
+
+    with pytest.raises(redis.exceptions.ResponseError):
+        asyncio.run(CircuitBreakerRedis(client, breaker).zincrby("popularity", 1, "m"))
+    assert breaker.state == CLOSED
+
+def test_half_open_probe_restores_or_reopens():
+    breaker = CircuitBreaker("Redis", failure_threshold=1)
+    breaker.trip()
+    states = []
+
+    async def failing_ping():
+        states.append(breaker.state)
+        raise redis.exceptions.ConnectionError("still down")
+
+    assert asyncio.run(breaker.probe(failing_ping)) is False
+    assert states == [HALF_OPEN] and breaker.state == OPEN
+
+    assert asyncio.run(breaker.probe(AsyncMock(return_value=True))) is True
+    assert breaker.state == CLOSED and breaker.allow_request()
+
+def test_probe_loop_recovers_without_restart():
+    breaker = CircuitBreaker("Redis")
+    breaker.trip()
+    ping = AsyncMock(side_effect=[redis.exceptions.ConnectionError("down"), True])
+
+    async def scenario():
+        task = asyncio.create_task(breaker.run_probe_loop(ping, 0.001))
+        for _ in range(100):
+            await asyncio.sleep(0.005)
+            if breaker.is_closed:
+                break
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert breaker.is_closed
+    assert ping.await_count == 2
+
+def test_pipeline_execute_goes_through_the_breaker():
+    client = MagicMock()
+    client.pipeline.return_value.execute = AsyncMock(side_effect=redis.exceptions.ConnectionError("Connection refused"))
+    breaker = CircuitBreaker("Redis", failure_threshold=1)
+    pipe = CircuitBreakerRedis(client, breaker).pipeline(transaction=False)
+    pipe.zincrby("popularity", 1, "m") # Queued on the real pipeline, no I/O
+
+    with pytest.raises(redis.exceptions.ConnectionError):
+        asyncio.run(pipe.execute())
+    assert breaker.state == OPEN
+    client.pipeline.assert_called_once_with(transaction=False)
+    client.pipeline.return_value.zincrby.assert_called_once_with("popularity", 1, "m")
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(pipe.execute())
+    assert client.pipeline.return_value.execute.await_count == 1 # The second execute never reached Redis
+
+def test_reset_closes_the_circuit_and_forgets_failures():
+    breaker = CircuitBreaker("Redis", failure_threshold=2)
+    breaker.record_failure()
+    breaker.trip()
+    breaker.reset()
+    assert breaker.state == CLOSED and breaker.consecutive_failures == 0 and breaker.opened_at is None
+    breaker.record_failure()
+    assert breaker.state == CLOSED # The earlier failure no longer counts
@@ -0,0 +1,47 @@
+from src.apge.cache import LRUCache
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_lru_evicts_least_recently_used_by_entry_count():
+    cache = LRUCache(max_entries=2, max_bytes=10_000, ttl_seconds=60)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    assert cache.get("a") == "1" # "a" is now most recently used
+    cache.set("c", "3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
+    assert cache.evictions == 1
+
+def test_lru_evicts_by_bytes_and_rejects_oversized_values():
+    cache = LRUCache(max_entries=100, max_bytes=20, ttl_seconds=60)
+    cache.set("k1", "x" * 8) # 10 bytes
+    cache.set("k2", "x" * 8) # 10 bytes
+    cache.set("k3", "x" * 8) # Evicts k1
+    assert cache.get("k1") is None
+    assert cache.size_bytes == 20
+
+    cache.set("big", "x" * 100)
+    assert cache.get("big") is None
+    assert len(cache) == 2
+
+def test_lru_expires_entries_after_ttl():
+    clock = FakeClock()
+    cache = LRUCache(ttl_seconds=10, clock=clock)
+    cache.set("k", "v")
+    clock.now = 9.9
+    assert cache.get("k") == "v"
+    clock.now = 10.0
+    assert cache.get("k") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["expirations"] == 1
+    assert stats["entries"] == 0
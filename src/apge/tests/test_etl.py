@@ -0,0 +1,246 @@
+import copy
+import json
+import pytest
+from unittest.mock import MagicMock
+
+from src.apge.etl import (
+    GraphDAO, collect_bulk_rows, literature_evidence_props, parse_intensity_pct, NODE_PRIMARY_KEYS, RELATIONSHIP_SPECS,
+)
+from src.apge.graph_schema import SCHEMA_VERSION
+
+# Small protocols.yaml-shaped fixture: two symptoms share the same target and StimParams
+MOCK_PROTOCOL_DB = {
+    "Major Depressive Disorder": {
+        "Anhedonia": {
+            "target": "Left DLPFC", "frequency": "10 Hz", "intensity": "120% MT", "pulses": 3000,
+            "sessions": "20-30", "evidence": "High", "notes": "Strong evidence",
+            "references": ["George et al., 2010", "Blumberger et al., 2018"],
+        },
+        "Low Mood": {
+            "target": "Left DLPFC", "frequency": "10 Hz", "intensity": "120% MT", "pulses": 3000,
+            "sessions": "20-30", "evidence": "High", "notes": "Strong evidence",
+            "references": ["George et al., 2010"],
+        },
+    },
+    "OCD": {
+        "Compulsions": {
+            "target": "dACC", "frequency": "20 Hz", "intensity": "100% MT", "pulses": 2000,
+            "sessions": 29, "evidence": "Moderate", "references": [],
+        },
+    },
+}
+
+# Fake driver whose session records every execute_write call instead of talking to Neo4j
+class FakeSession:
+    def __init__(self):
+        self.writes = []
+        self.read_responder = lambda query: [] # Maps a read query to the records it returns
+
+    def execute_write(self, fn, *args, **kwargs):
+        self.writes.append((fn, args, kwargs))
+
+    def execute_read(self, fn, query, *args, **kwargs):
+        return self.read_responder(query)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+@pytest.fixture
+def fake_driver():
+    driver = MagicMock()
+    driver.session.return_value = FakeSession()
+    return driver
+
+def test_parse_intensity_pct():
+    assert parse_intensity_pct("120% MT") == 120.0
+    assert parse_intensity_pct("80% AMT") == 80.0
+    assert parse_intensity_pct(None) == 0.0
+
+def test_collect_bulk_rows_deduplicates_nodes_and_relationships():
+    node_rows, rel_rows = collect_bulk_rows(MOCK_PROTOCOL_DB)
+
+    assert [row["name"] for row in node_rows["Diagnosis"]] == ["Major Depressive Disorder", "OCD"]
+    assert [row["name_norm"] for row in node_rows["Diagnosis"]] == ["major depressive disorder", "ocd"]
+    assert len(node_rows["Symptom"]) == 3
+    assert sorted(row["region"] for row in node_rows["Target"]) == ["Left DLPFC", "dACC"]
+    assert len(node_rows["StimParams"]) == 2 # Anhedonia and Low Mood share StimParams
+    assert len(node_rows["Evidence"]) == 2 # ...and Evidence, whose id includes the (shared) first reference
+    assert node_rows["Evidence"][0]["references"] == ["George et al., 2010"] # Later entries win
+    for rows in node_rows.values():
+        assert all("schema_version" not in row for row in rows)
+
+    targeted_by = rel_rows[("Symptom", "TARGETED_BY", "Target")]
+    assert {"from_val": "Low Mood", "to_val": "Left DLPFC"} in targeted_by
+    assert len(rel_rows[("Target", "USUALLY_TREATED_WITH", "StimParams")]) == 2
+
+def test_process_database_bulk_batches_unwind_writes(fake_driver):
+    dao = GraphDAO(fake_driver)
+    stats = dao.process_database_bulk(MOCK_PROTOCOL_DB, batch_size=2)
+
+    session = fake_driver.session.return_value
+    queries = [args[0] for _, args, _ in session.writes]
+    params = [args[1] for _, args, _ in session.writes]
+
+    assert all(query.startswith("UNWIND $rows AS row") for query in queries)
+    assert all(len(p["rows"]) <= 2 for p in params)
+    assert stats["nodes"] == 2 + 3 + 2 + 2 + 2
+    assert stats["relationships"] == sum(len(rows) for rows in collect_bulk_rows(MOCK_PROTOCOL_DB)[1].values())
+    assert stats["transactions"] == len(session.writes)
+
+    # Every node write happens before the first relationship write
+    first_rel_index = next(i for i, q in enumerate(queries) if "MERGE (a)-" in q)
+    assert all("MERGE (n:" in q for q in queries[:first_rel_index])
+    assert all(p["schema_version"] == SCHEMA_VERSION for p in params[:first_rel_index])
+    assert len({q for q in queries[first_rel_index:]}) == len(RELATIONSHIP_SPECS)
+
+def test_process_database_bulk_rejects_invalid_batch_size(fake_driver):
+    with pytest.raises(ValueError):
+        GraphDAO(fake_driver).process_database_bulk(MOCK_PROTOCOL_DB, batch_size=0)
+
+def existing_graph_responder(db_dict):
+    """Answers sync_database's read queries as if `db_dict` had already been loaded."""
+    node_rows, rel_rows = collect_bulk_rows(db_dict)
+
+    def respond(query):
+        for (from_label, rel_type, to_label), rows in rel_rows.items():
+            if f"(a:{from_label})-[:{rel_type}]->(b:{to_label})" in query:
+                return rows
+        for label, rows in node_rows.items():
+            if query.startswith(f"MATCH (n:{label})"):
+                return [{"key": row[NODE_PRIMARY_KEYS[label]], "content_hash": row["content_hash"]} for row in rows]
+        return []
+    return respond
+
+def test_sync_database_no_changes_writes_nothing(fake_driver):
+    session = fake_driver.session.return_value
+    session.read_responder = existing_graph_responder(MOCK_PROTOCOL_DB)
+
+    stats = GraphDAO(fake_driver).sync_database(MOCK_PROTOCOL_DB)
+
+    assert session.writes == []
+    assert stats["nodes_unchanged"] == 11
+    assert stats["nodes_created"] == stats["nodes_updated"] == stats["nodes_deleted"] == 0
+    assert stats["relationships_created"] == stats["relationships_deleted"] == 0
+
+def test_sync_database_only_touches_changed_nodes(fake_driver):
+    session = fake_driver.session.return_value
+    session.read_responder = existing_graph_responder(MOCK_PROTOCOL_DB)
+
+    edited_db = copy.deepcopy(MOCK_PROTOCOL_DB)
+    edited_db["OCD"]["Compulsions"]["notes"] = "Updated notes" # One-line edit: only the Evidence node changes
+    del edited_db["Major Depressive Disorder"]["Low Mood"] # Removes a Symptom and its relationships
+
+    stats = GraphDAO(fake_driver).sync_database(edited_db)
+
+    assert stats["nodes_created"] == 0
+    # Compulsions' Evidence, plus the Evidence node Low Mood shared with Anhedonia (Anhedonia's references now win)
+    assert stats["nodes_updated"] == 2
+    assert stats["nodes_deleted"] == 1
+    assert stats["relationships_created"] == 0
+    assert stats["relationships_deleted"] == 0 # Low Mood's relationships go with DETACH DELETE
+
+    written = [(args[0], args[1]) for _, args, _ in session.writes]
+    evidence_upserts = [params["rows"] for query, params in written if query.startswith("UNWIND $rows AS row MERGE (n:Evidence")]
+    assert len(evidence_upserts) == 1
+    assert "Updated notes" in [row["notes"] for row in evidence_upserts[0]]
+    deletes = [params["keys"] for query, params in written if "DETACH DELETE" in query]
+    assert deletes == [["Low Mood"]]
+
+def test_bump_graph_generation_writes_unique_stamp(fake_driver):
+    dao = GraphDAO(fake_driver)
+    first = dao.bump_graph_generation()
+    second = dao.bump_graph_generation()
+
+    assert first != second
+    session = fake_driver.session.return_value
+    query, params = session.writes[-1][1]
+    assert "MERGE (m:APGEGraphMeta" in query
+    assert "schema_version" not in query # Must survive clear_apge_graph
+    assert params == {"generation": second}
+
+def test_apply_schema_constraints_creates_lookup_indexes(fake_driver):
+    GraphDAO(fake_driver).apply_schema_constraints()
+
+    queries = [args[0] for _, args, _ in fake_driver.session.return_value.writes]
+    assert "CREATE INDEX diagnosis_name_norm IF NOT EXISTS FOR (d:Diagnosis) ON (d.name_norm)" in queries
+    assert "CREATE INDEX diagnosis_subtype_norm IF NOT EXISTS FOR (d:Diagnosis) ON (d.subtype_norm)" in queries
+    assert any(q.startswith("CREATE FULLTEXT INDEX diagnosis_search") for q in queries)
+
+LITERATURE_STUDIES = [
+    {"id": "10.1000/abc", "title": "Accelerated iTBS", "year": 2024, "n": 20,
+     "protocol": "Information not available in BibTeX", "main_finding": "Remission in 60%", "doi": "10.1000/ABC"},
+    {"id": "10.1000/def", "title": "fNIRS-guided rTMS", "year": 2023, "n": None, "doi": "10.1000/def"},
+]
+LITERATURE_BIBTEX = """@article{Smith2024,
+  title  = {Accelerated {iTBS}},
+  author = {Smith, Jane and Doe, John},
+  year   = {2024},
+  doi    = {https://doi.org/10.1000/abc}
+}
+@misc{NoDoi2022, title = {Unkeyed preprint}, year = {2022}}
+@article{Lee2021, title = {Closed-loop TMS}, author = {Lee, Kim}, year = {2021}, doi = {10.1000/GHI}}
+"""
+
+@pytest.fixture
+def literature_files(tmp_path):
+    studies_path = tmp_path / "studies.json"
+    studies_path.write_text(json.dumps(LITERATURE_STUDIES))
+    bib_path = tmp_path / "refs.bib"
+    bib_path.write_text(LITERATURE_BIBTEX)
+    return str(studies_path), [str(bib_path)]
+
+def test_ingest_literature_merges_duplicate_dois_and_batches_upserts(fake_driver, literature_files):
+    studies_path, bib_paths = literature_files
+    stats = GraphDAO(fake_driver).ingest_literature(studies_path, bib_paths, batch_size=2)
+
+    assert stats == {"records": 4, "duplicates": 1, "created": 3, "updated": 0, "unchanged": 0, "transactions": 2}
+    writes = fake_driver.session.return_value.writes
+    queries = {args[0] for _, args, _ in writes}
+    assert queries == {"UNWIND $rows AS row MERGE (e:Evidence {doi: row.doi}) SET e += row, e.schema_version = $schema_version"}
+    rows = [row for _, args, _ in writes for row in args[1]["rows"]]
+    assert [row["doi"] for row in rows] == ["10.1000/abc", "10.1000/def", "10.1000/ghi"]
+    # studies.json and the BibTeX entry for the same (differently written) DOI became one node
+    assert rows[0]["references"] == ["Smith, Jane", "Doe, John"]
+    assert rows[0]["n_participants"] == 20 and rows[0]["pub_year"] == 2024
+    assert rows[0]["notes"] == "Main finding: Remission in 60%" # Placeholder protocol dropped
+    assert all("schema_version" not in row for row in rows)
+
+def test_ingest_literature_skips_unchanged_entries(fake_driver, literature_files):
+    studies_path, bib_paths = literature_files
+    dao = GraphDAO(fake_driver)
+    session = fake_driver.session.return_value
+    dao.ingest_literature(studies_path, bib_paths)
+    stored = {row["doi"]: row["content_hash"] for _, args, _ in session.writes for row in args[1]["rows"]}
+    stored["10.1000/def"] = "stale"
+    session.writes.clear()
+    session.read_responder = lambda query: (
+        [{"key": doi, "content_hash": content_hash} for doi, content_hash in stored.items()]
+        if query.startswith("MATCH (e:Evidence) WHERE e.doi IS NOT NULL") else []
+    )
+
+    stats = dao.ingest_literature(studies_path, bib_paths)
+
+    assert (stats["created"], stats["updated"], stats["unchanged"]) == (0, 1, 2)
+    assert [row["doi"] for _, args, _ in session.writes for row in args[1]["rows"]] == ["10.1000/def"]
+
+def test_literature_evidence_props_is_stable():
+    record = {"title": "T", "year": "2020", "authors": "A and B", "doi": "doi:10.1/X"}
+    props = literature_evidence_props(record)
+    assert props["doi"] == "10.1/x" and props["pub_year"] == 2020 and props["level"] == "Literature"
+    assert literature_evidence_props(dict(record))["content_hash"] == props["content_hash"]
+
+def test_clear_apge_graph_keeps_literature_evidence(fake_driver):
+    GraphDAO(fake_driver).clear_apge_graph()
+
+    (query,) = [args[0] for _, args, _ in fake_driver.session.return_value.writes]
+    assert query == ("MATCH (n) WHERE n.schema_version IS NOT NULL "
+                     "AND NOT (n:Evidence AND n.doi IS NOT NULL AND n.unique_id IS NULL) DETACH DELETE n")
+
+def test_apply_schema_constraints_adds_evidence_doi_constraint(fake_driver):
+    GraphDAO(fake_driver).apply_schema_constraints()
+
+    queries = [args[0] for _, args, _ in fake_driver.session.return_value.writes]
+    assert "CREATE CONSTRAINT IF NOT EXISTS FOR (e:Evidence) REQUIRE e.doi IS UNIQUE" in queries
@@ -0,0 +1,66 @@
+import io
+
+from src.apge.literature import iter_bibtex_entries, iter_json_array, iter_study_records, merge_literature_records, normalize_doi
+
+BIBTEX = """% Exported references
+@comment{ignored, not an entry}
+
+@article{Smith2024,
+  title        = {Accelerated {iTBS} for
+                  treatment-resistant depression},
+  author       = {Smith, Jane and Doe, John},
+  year         = 2024,
+  doi          = {https://doi.org/10.1000/ABC.123}
+}
+@inproceedings{Lee2023, title = "Closed-loop {TMS}", booktitle = {Proc. SMC}}
+"""
+
+def test_iter_bibtex_entries_streams_entries():
+    entries = list(iter_bibtex_entries(io.StringIO(BIBTEX)))
+
+    assert [entry["citation_key"] for entry in entries] == ["Smith2024", "Lee2023"]
+    smith, lee = entries
+    assert smith["entry_type"] == "article"
+    assert smith["title"] == "Accelerated iTBS for treatment-resistant depression" # Unwrapped, braces dropped
+    assert smith["year"] == "2024"
+    assert lee == {"title": "Closed-loop TMS", "booktitle": "Proc. SMC", "entry_type": "inproceedings", "citation_key": "Lee2023"}
+
+def test_normalize_doi():
+    assert normalize_doi("https://doi.org/10.1000/ABC.123 ") == "10.1000/abc.123"
+    assert normalize_doi("doi:10.1000/x") == "10.1000/x"
+    assert normalize_doi("") is None
+    assert normalize_doi(None) is None
+
+def test_iter_study_records_drops_placeholders():
+    records = list(iter_study_records(io.StringIO(
+        '[{"id": "10.1/x", "protocol": "Information not available in BibTeX", "n": 20}]'
+    )))
+    assert records == [{"id": "10.1/x", "protocol": None, "n": 20}]
+
+def test_iter_json_array_decodes_across_chunk_boundaries():
+    source = '[ {"title": "A, [b]", "n": 12345}, 678, "x" ,\n {"nested": [1, {"k": null}]} ]'
+    expected = [{"title": "A, [b]", "n": 12345}, 678, "x", {"nested": [1, {"k": None}]}]
+    for chunk_size in (1, 2, 5, 1024): # Numbers and strings split mid-token must still decode whole
+        assert list(iter_json_array(io.StringIO(source), chunk_size=chunk_size)) == expected
+    assert list(iter_json_array(io.StringIO(" [ ] "))) == []
+
+def test_iter_json_array_decodes_numbers_and_literals_split_across_chunks():
+    source = "[ 12345 , 6.5e10 , -0.25E-3, true,null ,false]"
+    expected = [12345, 6.5e10, -0.25e-3, True, None, False]
+    for chunk_size in range(1, 9): # Every split of "6.5e10" ("6." | "5e10", "6.5e" | "10", ...) included
+        assert list(iter_json_array(io.StringIO(source), chunk_size=chunk_size)) == expected
+
+def test_merge_literature_records_merges_by_doi_and_keeps_unkeyed_studies(tmp_path):
+    studies_path = tmp_path / "studies.json"
+    studies_path.write_text('[{"id": "10.1/ABC", "title": "From studies", "n": 20, "protocol": "Information not available in BibTeX"},'
+                            ' {"id": "local-1", "title": "No DOI"}]')
+    bib_path = tmp_path / "refs.bib"
+    bib_path.write_text("@article{Smith2024, title = {From BibTeX}, author = {Smith, Jane}, doi = {https://doi.org/10.1/abc}}\n"
+                        "@misc{Park2022, title = {Preprint}}\n")
+
+    records, sources = merge_literature_records(str(studies_path), [str(bib_path), str(tmp_path / "missing.bib")])
+
+    assert list(records) == ["10.1/abc", "local-1", "Park2022"]
+    assert records["10.1/abc"] == {"id": "10.1/ABC", "title": "From studies", "n": 20, "authors": "Smith, Jane", "doi": "10.1/abc"}
+    assert records["local-1"]["doi"] is None and records["Park2022"]["doi"] is None
+    assert sources == {"10.1/abc": 2, "local-1": 1, "Park2022": 1}
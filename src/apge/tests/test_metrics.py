@@ -0,0 +1,66 @@
+import pytest
+
+from src.apge.metrics import (MetricsRegistry, end_request_phases, phase_timer, server_timing_header,
+                              start_request_phases)
+
+def test_histogram_renders_cumulative_buckets():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("apge_test_seconds", "Test histogram.", ["phase"], buckets=(0.1, 1.0))
+    histogram.observe(0.05, phase="cypher")
+    histogram.observe(0.5, phase="cypher")
+    histogram.observe(5, phase="cypher")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE apge_test_seconds histogram" in lines
+    assert 'apge_test_seconds_bucket{phase="cypher",le="0.1"} 1' in lines
+    assert 'apge_test_seconds_bucket{phase="cypher",le="1.0"} 2' in lines
+    assert 'apge_test_seconds_bucket{phase="cypher",le="+Inf"} 3' in lines
+    assert 'apge_test_seconds_sum{phase="cypher"} 5.55' in lines
+    assert 'apge_test_seconds_count{phase="cypher"} 3' in lines
+
+def test_counter_and_gauges():
+    registry = MetricsRegistry()
+    counter = registry.counter("apge_test_total", "Test counter.", ["kind"])
+    counter.inc(3, kind="prompt")
+    with pytest.raises(ValueError):
+        counter.inc(-1, kind="prompt")
+    with pytest.raises(ValueError):
+        counter.inc(kind="prompt", extra="x") # Unknown label
+    in_flight = registry.gauge("apge_test_in_flight", "Test gauge.")
+    computed = registry.gauge("apge_test_ratio", "Computed gauge.")
+    computed.set_function(lambda: 0.25)
+
+    with in_flight.track_inprogress():
+        assert in_flight.value() == 1
+    text = registry.render()
+    assert 'apge_test_total{kind="prompt"} 3.0' in text
+    assert "apge_test_in_flight 0.0" in text
+    assert "apge_test_ratio 0.25" in text
+
+def test_phase_timer_accumulates_into_current_request():
+    registry = MetricsRegistry()
+    histogram = registry.histogram("apge_test_phase_seconds", "Test.", ["phase"])
+
+    with phase_timer(histogram, "cypher"): # Outside a request: histogram only
+        pass
+    phases, token = start_request_phases()
+    with phase_timer(histogram, "cypher"):
+        pass
+    with phase_timer(histogram, "cypher"):
+        pass
+    end_request_phases(token)
+
+    assert list(phases) == ["cypher"]
+    assert histogram.count(phase="cypher") == 3
+
+def test_server_timing_header_in_milliseconds():
+    assert server_timing_header({"cypher": 0.0123, "total": 0.5}) == "cypher;dur=12.3, total;dur=500.0"
+
+def test_metric_without_samples_cannot_be_created():
+    from src.apge.metrics import _Metric
+
+    class Incomplete(_Metric):
+        kind = "untyped"
+
+    with pytest.raises(TypeError):
+        Incomplete("apge_incomplete", "No samples.")
@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import pytest
+
+from src.apge.main import evidence_rank_key
+from src.apge.narrative_backend import (TEMPLATE_NOTES, DeadlineNarrativeBackend, NarrativeBackend,
+                                        NarrativeGenerationError, TemplateNarrativeBackend)
+
+PROTOCOLS = [
+    {"Protocol Name": "Left DLPFC 10Hz", "Coil Type": "Figure-8", "Frequency": "10 Hz", "Pulses/Session": 3000, "Sessions": "30",
+     "Evidence": [{"level": "High", "year": 2018}, {"level": "Low", "year": 2012}]},
+    {"Protocol Name": "Deep TMS", "Coil Type": "H1", "Frequency": "18 Hz", "Pulses/Session": 1980, "Sessions": 20,
+     "Evidence Level": "Moderate", "Evidence": []},
+    {"Protocol Name": "Left DLPFC iTBS", "Coil Type": "Figure-8", "Frequency": "iTBS", "Pulses/Session": None, "Sessions": None},
+]
+
+# As seeded from protocols.yaml, where most session counts are ranges
+RANGE_PROTOCOLS = [
+    {"Protocol Name": "Left DLPFC 10Hz", "Coil Type": "Figure-8", "Frequency": "10 Hz", "Pulses/Session": 3000, "Sessions": "20-30"},
+    {"Protocol Name": "Right DLPFC 1Hz", "Coil Type": "Figure-8", "Frequency": "1 Hz", "Pulses/Session": 1200, "Sessions": "25-36"},
+    {"Protocol Name": "Maintenance", "Coil Type": "Figure-8", "Pulses/Session": "varies", "Sessions": "weekly"},
+]
+
+class SlowBackend(NarrativeBackend):
+    name = "slow"
+
+    def __init__(self, delay: float, cache: dict, error: Exception = None):
+        self.delay, self.cache, self.error = delay, cache, error
+        self.running = self.max_running = 0
+
+    async def generate(self, cache_key, protocols, lit_chunks, hits=None, reason=None, slots=None):
+        async with slots or contextlib.nullcontext():
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            try:
+                await asyncio.sleep(self.delay)
+            finally:
+                self.running -= 1
+        if self.error:
+            raise self.error
+        self.cache[cache_key] = "LLM narrative"
+        return "LLM narrative"
+
+def test_template_narrative_covers_coil_sessions_and_evidence():
+    narrative = TemplateNarrativeBackend(evidence_rank_key).render(PROTOCOLS)
+    coil, sessions, evidence = narrative.split("\n\n") # No closing note when the template is the backend
+
+    assert coil == "**Coil.** Left DLPFC 10Hz and Left DLPFC iTBS: Figure-8; Deep TMS: H1."
+    assert sessions == ("**Session burden.** Left DLPFC 10Hz: 30 sessions, 3,000 pulses per session, at 10 Hz, 90,000 pulses in total; "
+                        "Deep TMS: 20 sessions, 1,980 pulses per session, at 18 Hz, 39,600 pulses in total; "
+                        "Left DLPFC iTBS: sessions not reported, at iTBS. Deep TMS needs the fewest sessions.")
+    assert evidence == ("**Evidence.** Left DLPFC 10Hz: High (2018); Deep TMS: Moderate; Left DLPFC iTBS: no evidence level reported. "
+                        "The strongest reported evidence is for Left DLPFC 10Hz.")
+    assert TemplateNarrativeBackend(evidence_rank_key).render(list(PROTOCOLS)) == narrative # Deterministic
+
+def test_template_narrative_reports_session_ranges():
+    narrative = TemplateNarrativeBackend(evidence_rank_key).render(RANGE_PROTOCOLS)
+    sessions = narrative.split("\n\n")[1]
+    assert sessions == ("**Session burden.** Left DLPFC 10Hz: 20-30 sessions, 3,000 pulses per session, at 10 Hz, 60,000-90,000 pulses in total; "
+                        "Right DLPFC 1Hz: 25-36 sessions, 1,200 pulses per session, at 1 Hz, 30,000-43,200 pulses in total; "
+                        "Maintenance: weekly sessions, varies pulses per session. Left DLPFC 10Hz needs the fewest sessions.")
+    assert "not reported" not in sessions
+
+def test_template_note_follows_the_fallback_reason():
+    template = TemplateNarrativeBackend(evidence_rank_key)
+    assert template.render(PROTOCOLS, "deadline").endswith(TEMPLATE_NOTES["deadline"])
+    assert template.render(PROTOCOLS, "error").endswith(TEMPLATE_NOTES["error"])
+    assert "not ready in time" not in template.render(PROTOCOLS, "error")
+
+def test_primary_within_deadline_answers():
+    cache = {}
+    backend = DeadlineNarrativeBackend(SlowBackend(0, cache), TemplateNarrativeBackend(evidence_rank_key), 1)
+    assert asyncio.run(backend.generate("narrative:k", PROTOCOLS, [])) == "LLM narrative"
+    assert backend.name == "slow+template"
+
+def test_missed_deadline_answers_with_template_and_finishes_in_background():
+    cache, reasons = {}, []
+    backend = DeadlineNarrativeBackend(SlowBackend(0.2, cache), TemplateNarrativeBackend(evidence_rank_key), 0.02,
+                                       on_fallback=reasons.append)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        narrative = await backend.generate("narrative:k", PROTOCOLS, [])
+        elapsed = loop.time() - started
+        assert len(backend.pending) == 1 and cache == {}
+        await asyncio.gather(*backend.pending)
+        return narrative, elapsed
+
+    narrative, elapsed = asyncio.run(scenario())
+    assert narrative.endswith(TEMPLATE_NOTES["deadline"]) and elapsed < 0.15
+    assert cache == {"narrative:k": "LLM narrative"} # The late narrative still reached the cache
+    assert reasons == ["deadline"] and not backend.pending
+
+def test_primary_error_answers_with_template_and_other_errors_propagate():
+    reasons = []
+    failing = DeadlineNarrativeBackend(SlowBackend(0, {}, NarrativeGenerationError("LLM API down")),
+                                       TemplateNarrativeBackend(evidence_rank_key), 1, on_fallback=reasons.append)
+    assert asyncio.run(failing.generate("narrative:k", PROTOCOLS, [])).endswith(TEMPLATE_NOTES["error"])
+    assert reasons == ["error"]
+
+    broken = DeadlineNarrativeBackend(SlowBackend(0, {}, KeyError("bug")), TemplateNarrativeBackend(evidence_rank_key), 1)
+    with pytest.raises(KeyError):
+        asyncio.run(broken.generate("narrative:k", PROTOCOLS, []))
+
+def test_late_primary_keeps_its_slot_after_the_deadline():
+    primary = SlowBackend(0.1, {})
+    backend = DeadlineNarrativeBackend(primary, TemplateNarrativeBackend(evidence_rank_key), 0.02)
+
+    async def scenario():
+        slots = asyncio.Semaphore(1)
+        narratives = await asyncio.gather(*(backend.generate(f"narrative:{i}", PROTOCOLS, [], slots=slots) for i in range(3)))
+        await asyncio.gather(*backend.pending)
+        return narratives
+
+    narratives = asyncio.run(scenario())
+    assert all(narrative.endswith(TEMPLATE_NOTES["deadline"]) for narrative in narratives)
+    assert primary.max_running == 1 # The background calls still ran one at a time
+    assert len(primary.cache) == 3
+
+def test_backend_base_class_is_abstract():
+    class NoGenerate(NarrativeBackend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        NoGenerate()
@@ -0,0 +1,60 @@
+import pytest
+
+from src.apge.narrative_store import PAYLOAD_MAGIC, NarrativeTTLPolicy, decode_narrative, encode_narrative
+
+NARRATIVE = "## Coil physics\n\n" + "The figure-8 coil is more focal than the H-coil. " * 40 + "\n\n**Clinical Pearl:** Ünïcode survives."
+METADATA = {"model": "gpt-3.5-turbo", "prompt_version": "1", "tokens": 412, "created_at": 1760000000}
+
+def test_payload_round_trip_is_compressed_with_header():
+    payload = encode_narrative(NARRATIVE, METADATA)
+    assert payload.startswith(PAYLOAD_MAGIC)
+    assert len(payload) < len(NARRATIVE.encode("utf-8")) / 4
+    assert decode_narrative(payload) == (NARRATIVE, METADATA)
+
+def test_short_narratives_are_stored_uncompressed():
+    payload = encode_narrative("Short.", METADATA)
+    assert payload.endswith(b"Short.") and b'"codec":"raw"' in payload
+    assert decode_narrative(payload) == ("Short.", METADATA)
+
+def test_plain_values_from_before_the_payload_format_are_served():
+    assert decode_narrative("Plain narrative") == ("Plain narrative", None)
+    assert decode_narrative("Plain ünïcode".encode("utf-8")) == ("Plain ünïcode", None)
+
+def test_corrupt_payload_raises_value_error():
+    payload = encode_narrative(NARRATIVE, METADATA)
+    with pytest.raises(ValueError):
+        decode_narrative(payload[:-20])
+    with pytest.raises(ValueError):
+        decode_narrative(PAYLOAD_MAGIC + b"\x00")
+
+def test_ttl_grows_with_popularity_up_to_the_maximum():
+    policy = NarrativeTTLPolicy(base_ttl=3600, min_ttl=900, max_ttl=86400)
+    assert policy.ttl_for(1) == 900
+    assert policy.ttl_for(2) == 3600
+    assert policy.ttl_for(4) == 3600 + 2700
+    assert policy.ttl_for(None) == 3600
+    assert policy.ttl_for(10 ** 12) == 86400
+    assert policy.should_store(1) and policy.pressure == 1.0
+    with pytest.raises(ValueError):
+        NarrativeTTLPolicy(base_ttl=600, min_ttl=900, max_ttl=86400)
+
+def test_over_budget_shrinks_ttls_and_skips_one_off_sets():
+    now = [0.0]
+    policy = NarrativeTTLPolicy(base_ttl=3600, min_ttl=900, max_ttl=86400, memory_budget_bytes=1000,
+                                check_interval=60, clock=lambda: now[0])
+    assert policy.memory_check_due()
+    policy.update_memory(800)
+    assert not policy.memory_check_due() and policy.ttl_for(4) == 6300 # Within budget
+
+    now[0] = 60.0
+    assert policy.memory_check_due()
+    policy.update_memory(2000)
+    assert policy.pressure == 0.5
+    assert policy.ttl_for(4) == 900 + 2700 # Half the popularity bonus
+    assert policy.ttl_for(1) == 900
+    assert not policy.should_store(1)
+    assert policy.should_store(2) and policy.should_store(None)
+    assert policy.stats() == {"memory_budget_bytes": 1000, "used_memory_bytes": 2000, "ttl_pressure": 0.5}
+
+def test_memory_is_never_sampled_without_a_budget():
+    assert not NarrativeTTLPolicy(base_ttl=3600, min_ttl=900, max_ttl=86400).memory_check_due()
@@ -0,0 +1,71 @@
+import json
+
+from src.apge.prompt import (LOW_PRIORITY_FIELDS, build_compare_prompt, encode_protocols, estimate_message_tokens,
+                             estimate_tokens)
+
+DEVICE = {"device_name": "MagPro R30", "coil_type": "Figure-8", "manufacturer": "MagVenture"}
+SHARED_STUDY = {"level": "High", "year": 2018, "title": "THREE-D non-inferiority trial", "doi": "10.1016/s0140-6736(18)30295-2"}
+
+def protocol(name, frequency, evidence):
+    return {
+        "Protocol Name": name, "Coil Type": "Figure-8", "Frequency": frequency, "Intensity": "120.0%",
+        "Pulses/Session": 3000, "Sessions": 30, "Evidence Level": evidence[0]["level"], "Device Name": DEVICE["device_name"],
+        "Manufacturer": DEVICE["manufacturer"], "Publication Title": evidence[0]["title"],
+        "Publication Year": evidence[0]["year"], "DOI": evidence[0]["doi"],
+        "Stim Params": [{"frequency": frequency, "intensity": "120.0%", "pulses_per_session": 3000, "sessions": 30, **DEVICE}],
+        "Evidence": evidence,
+    }
+
+PROTOCOLS = [
+    protocol("Left DLPFC 10Hz", "10 Hz", [SHARED_STUDY]),
+    protocol("Left DLPFC iTBS", "iTBS", [SHARED_STUDY, {"level": "Moderate", "year": 2014, "title": "Open-label iTBS", "doi": None}]),
+]
+
+def test_protocols_are_encoded_once_with_shared_devices_and_evidence():
+    text = encode_protocols(PROTOCOLS)
+    lines = text.splitlines()
+
+    assert "P1 | Left DLPFC 10Hz | S1 | E1" in lines and "P2 | Left DLPFC iTBS | S2 | E1 E2" in lines
+    assert text.count("MagPro R30") == 1 and text.count("THREE-D") == 1
+    assert text.count("pulses/session") == 1 # One header per table
+    assert "None" not in text and "null" not in text
+    assert "E2 | Moderate | 2014 | Open-label iTBS | " in lines # Missing DOI left blank
+    assert estimate_tokens(text) * 2 < estimate_tokens(json.dumps(PROTOCOLS, indent=2))
+
+def test_columns_without_values_are_left_out_and_flat_rows_still_encode():
+    flat = {"Protocol Name": "Legacy row", "Frequency": "1 Hz", "Coil Type": None, "Evidence Level": "Low"}
+    text = encode_protocols([flat])
+    assert "Stimulation: id | frequency\nS1 | 1 Hz" in text
+    assert "Devices" not in text
+    assert "Evidence: id | level\nE1 | Low" in text
+
+def test_prompt_within_budget_is_unchanged():
+    messages, report = build_compare_prompt("System.", PROTOCOLS, ["Chunk one.", "Chunk two."], token_budget=10000)
+    assert "Chunk two." in messages[1]["content"] and "here are 2 literature abstracts" in messages[1]["content"]
+    assert report["prompt_tokens"] == estimate_message_tokens(messages)
+    assert report["within_budget"] and report["lit_chunks_dropped"] == 0 and report["fields_dropped"] == []
+
+def test_budget_drops_literature_then_low_priority_fields_then_extra_evidence():
+    chunks = ["Most relevant study. " * 20, "Less relevant study. " * 20]
+    _, full = build_compare_prompt("System.", PROTOCOLS, chunks)
+    no_chunks_messages, no_chunks = build_compare_prompt("System.", PROTOCOLS, [])
+
+    messages, report = build_compare_prompt("System.", PROTOCOLS, chunks, token_budget=full["prompt_tokens"] - 1)
+    assert report["lit_chunks_dropped"] == 1 and "Most relevant study." in messages[1]["content"]
+    assert report["within_budget"]
+
+    messages, report = build_compare_prompt("System.", PROTOCOLS, chunks, token_budget=no_chunks["prompt_tokens"] - 1)
+    assert report["lit_chunks_dropped"] == 2 and report["fields_dropped"] == ["evidence.doi"]
+    assert "10.1016" not in messages[1]["content"] and "MagVenture" in messages[1]["content"]
+
+    messages, report = build_compare_prompt("System.", PROTOCOLS, chunks, token_budget=1)
+    assert report["fields_dropped"] == [f"{table}.{field}" for table, field in LOW_PRIORITY_FIELDS]
+    assert report["best_evidence_only"] and not report["within_budget"]
+    assert "P2 | Left DLPFC iTBS | S2 | E1" in messages[1]["content"].splitlines() # Protocols are never dropped
+    assert report["prompt_tokens"] < no_chunks["prompt_tokens"]
+
+def test_estimate_tokens_counts_words_numbers_and_punctuation():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("coil") == 1
+    assert estimate_tokens("stimulation") == 3
+    assert estimate_tokens("3000 pulses, 120%") == 2 + 2 + 1 + 1 + 1
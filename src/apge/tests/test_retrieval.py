@@ -0,0 +1,105 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from src.apge.retrieval import (HashingEmbedder, LiteratureRetriever, load_literature_documents,
+                                load_or_build_index)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+STUDIES = [
+    {"id": "10.1/itbs", "title": "Accelerated iTBS of the left DLPFC in treatment-resistant depression",
+     "journal": "Brain Stimulation", "year": 2024, "n": 40, "protocol": "iTBS 1800 pulses",
+     "main_finding": "Remission in 60%", "doi": "10.1/ITBS"},
+    {"id": "10.1/ocd", "title": "Deep TMS of the dACC for obsessive-compulsive disorder",
+     "journal": "Psychiatry Research", "year": 2023, "n": None,
+     "protocol": "Information not available in BibTeX", "main_finding": None, "doi": "10.1/ocd"},
+]
+
+BIBTEX = """@article{Chen2024,
+  title = {Accelerated iTBS of the left DLPFC in treatment-resistant depression},
+  author = {Chen, Wei},
+  journal = {Brain Stimulation},
+  year = {2024},
+  doi = {https://doi.org/10.1/itbs}
+}
+@misc{Park2022,
+  title = {fNIRS-guided 1 Hz rTMS over the right DLPFC for anxiety},
+  author = {Park, Min},
+  year = {2022}
+}
+"""
+
+@pytest.fixture
+def sources(tmp_path):
+    studies_path = tmp_path / "studies.json"
+    studies_path.write_text(json.dumps(STUDIES))
+    bib_path = tmp_path / "refs.bib"
+    bib_path.write_text(BIBTEX)
+    return str(studies_path), [str(bib_path)]
+
+def test_documents_merged_by_normalized_doi(sources):
+    documents = load_literature_documents(*sources)
+
+    assert [document["id"] for document in documents] == ["10.1/itbs", "10.1/ocd", "Park2022"]
+    itbs = documents[0]["chunk"]
+    assert "Brain Stimulation, 2024" in itbs
+    assert "Authors: Chen, Wei" in itbs # From the BibTeX entry
+    assert "Sample size: 40" in itbs # From studies.json
+    assert "not available" not in documents[1]["chunk"]
+
+def test_index_is_memory_mapped_and_rebuilt_when_sources_change(tmp_path, sources):
+    index_dir = str(tmp_path / "index")
+    index = load_or_build_index(index_dir, *sources)
+
+    assert isinstance(index.vectors, np.memmap)
+    assert index.vectors.dtype == np.float32
+    assert index.vectors.shape == (3, HashingEmbedder().dim)
+    assert np.allclose(np.linalg.norm(index.vectors, axis=1), 1.0)
+    assert load_or_build_index(index_dir, *sources).metadata == index.metadata # Reused as is
+
+    studies_path, bib_paths = sources
+    with open(studies_path, "w") as studies_file:
+        json.dump(STUDIES[:1], studies_file)
+    assert len(load_or_build_index(index_dir, studies_path, bib_paths)) == 2
+
+def test_index_build_does_not_touch_another_workers_temp_files(tmp_path, sources):
+    index_dir = tmp_path / "index"
+    index_dir.mkdir()
+    other_worker_file = index_dir / f"vectors.f32.{os.getpid() + 1}.tmp" # Mid-write in a worker building concurrently
+    other_worker_file.write_bytes(b"partial")
+
+    index = load_or_build_index(str(index_dir), *sources)
+
+    assert len(index) == 3
+    assert other_worker_file.read_bytes() == b"partial"
+    assert sorted(name for name in os.listdir(index_dir) if name.endswith(".tmp")) == [other_worker_file.name]
+
+def test_retriever_ranks_relevant_studies_first(tmp_path, sources):
+    retriever = LiteratureRetriever(load_or_build_index(str(tmp_path / "index"), *sources), top_k=2)
+
+    chunks = retriever.chunks_for_protocols([
+        {"Protocol Name": "Right DLPFC 1 Hz", "Frequency": "1 Hz", "Coil Type": "Figure-8"},
+        {"Protocol Name": "Left DLPFC accelerated iTBS", "Frequency": "iTBS"},
+    ])
+
+    assert len(chunks) == 2
+    assert {chunk.splitlines()[0].split(" (")[0] for chunk in chunks} == {
+        "Accelerated iTBS of the left DLPFC in treatment-resistant depression",
+        "fNIRS-guided 1 Hz rTMS over the right DLPFC for anxiety",
+    }
+    assert retriever.chunks_for_protocols([]) == []
+    assert retriever.chunks_for_protocols([{"Protocol Name": "zzz"}]) == [] # Below min_score
+
+def test_empty_index_returns_no_hits(tmp_path):
+    index = load_or_build_index(str(tmp_path / "index"), None, [])
+    assert len(index) == 0
+    assert LiteratureRetriever(index).chunks_for_protocols([{"Protocol Name": "Left DLPFC"}]) == []
+
+def test_repository_literature_sources_index():
+    documents = load_literature_documents(os.path.join(REPO_ROOT, "data", "studies.json"),
+                                          [os.path.join(REPO_ROOT, "research_sources", "lit_tms_fnirs_2025.bib")])
+    assert len(documents) == 12 # studies.json and the .bib describe the same 12 studies
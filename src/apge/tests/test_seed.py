@@ -0,0 +1,11 @@
+from scripts import seed
+
+UNCHANGED_SYNC = {"nodes_created": 0, "nodes_updated": 0, "nodes_deleted": 0, "nodes_unchanged": 12,
+                  "relationships_created": 0, "relationships_deleted": 0, "transactions": 0}
+
+def test_graph_generation_is_kept_when_a_sync_changed_nothing():
+    assert not seed.graph_changed("sync", UNCHANGED_SYNC)
+    assert not seed.graph_changed("sync", UNCHANGED_SYNC, {"created": 0, "updated": 0, "unchanged": 40})
+    assert seed.graph_changed("sync", {**UNCHANGED_SYNC, "relationships_deleted": 1})
+    assert seed.graph_changed("sync", UNCHANGED_SYNC, {"created": 0, "updated": 2, "unchanged": 38})
+    assert seed.graph_changed("bulk", {"nodes": 0, "relationships": 0}) # The graph was cleared
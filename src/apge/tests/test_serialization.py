@@ -0,0 +1,43 @@
+import gzip
+import json
+
+import pytest
+
+from src.apge import serialization
+from src.apge.serialization import compress, dumps, negotiate_encoding
+
+@pytest.mark.parametrize("content", [
+    [{"id": "p1", "label": "Protocol Ünïcode", "device": None, "evidence_level": "High"}],
+    {"table": {"columns": ["Frequency", "Intensity"], "data": [[10.0, "120.0%"], [1, None]]}, "lit_chunks": []},
+    {"nested": [{"frequency": 0.5, "pulses_per_session": 3000, "quote": "\"a\"\n"}]},
+])
+def test_dumps_matches_starlette_json_response(content):
+    from fastapi.responses import JSONResponse
+    assert dumps(content) == JSONResponse(content=content).body
+
+def test_dumps_falls_back_to_stdlib_encoder(monkeypatch):
+    monkeypatch.setattr(serialization, "orjson", None)
+    assert dumps({"a": [1.5, "é"]}) == '{"a":[1.5,"é"]}'.encode("utf-8")
+
+@pytest.mark.parametrize("header, with_brotli, expected", [
+    (None, True, None),
+    ("identity", True, None),
+    ("gzip, deflate", True, "gzip"),
+    ("gzip, br", True, "br"),
+    ("gzip, br", False, "gzip"),
+    ("br;q=0.5, gzip;q=0.8", True, "gzip"),
+    ("gzip;q=0, *", False, None),
+    ("*", True, "br"),
+    ("GZIP ; Q=1", False, "gzip"),
+])
+def test_negotiate_encoding(monkeypatch, header, with_brotli, expected):
+    monkeypatch.setattr(serialization, "brotli", object() if with_brotli else None)
+    assert negotiate_encoding(header) == expected
+
+def test_gzip_round_trip():
+    body = dumps({"data": [["x" * 10] * 10] * 50})
+    compressed = compress(body, "gzip")
+    assert len(compressed) < len(body)
+    assert json.loads(gzip.decompress(compressed)) == json.loads(body)
+    with pytest.raises(ValueError):
+        compress(body, "zstd")
@@ -0,0 +1,58 @@
+import asyncio
+from unittest.mock import AsyncMock
+
+import redis
+
+from src.apge.singleflight import SingleFlight, acquire_lease, release_lease
+
+def test_single_flight_coalesces_concurrent_calls():
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "narrative"
+
+    async def scenario():
+        flights = SingleFlight()
+        results = await asyncio.gather(*(flights.do("narrative:abc", generate) for _ in range(20)))
+        assert len(flights) == 0 # Forgotten once finished
+        return results
+
+    results = asyncio.run(scenario())
+    assert results == ["narrative"] * 20
+    assert len(calls) == 1
+
+def test_single_flight_propagates_errors_and_retries_after():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        await asyncio.sleep(0)
+        if len(attempts) == 1:
+            raise RuntimeError("LLM API Down")
+        return "ok"
+
+    async def scenario():
+        flights = SingleFlight()
+        first = await asyncio.gather(flights.do("k", flaky), flights.do("k", flaky), return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in first)
+        return await flights.do("k", flaky)
+
+    assert asyncio.run(scenario()) == "ok"
+    assert len(attempts) == 2
+
+def test_acquire_and_release_lease():
+    mock_redis = AsyncMock()
+    mock_redis.set.return_value = True
+    assert asyncio.run(acquire_lease(mock_redis, "lock:k", "token", 5000)) is True
+    mock_redis.set.assert_awaited_once_with("lock:k", "token", nx=True, px=5000)
+
+    mock_redis.set.return_value = None # SET NX on a held lock
+    assert asyncio.run(acquire_lease(mock_redis, "lock:k", "token", 5000)) is False
+
+    mock_redis.set.side_effect = redis.exceptions.ConnectionError("down")
+    assert asyncio.run(acquire_lease(mock_redis, "lock:k", "token", 5000)) is None
+
+    asyncio.run(release_lease(mock_redis, "lock:k", "token"))
+    assert mock_redis.eval.await_args.args[1:] == (1, "lock:k", "token")
@@ -0,0 +1,71 @@
+import asyncio
+
+from src.apge.snapshot import GraphSnapshot, SnapshotEngine, build_snapshot
+
+LIST_RECORDS = [
+    {"id": "p1", "label": "Protocol Alpha", "device": "Device X", "evidence_level": "High",
+     "diagnosis_keys": ["major depressive disorder", "trd"]},
+    {"id": "p2", "label": "Protocol Beta", "device": None, "evidence_level": None,
+     "diagnosis_keys": ["major depressive disorder"]},
+    {"id": "p3", "label": "Protocol Gamma", "device": "Device Z", "evidence_level": "Low", "diagnosis_keys": []},
+]
+COMPARE_ROWS = [("p1", ["Protocol Alpha", "Figure-8"]), ("p1", ["Protocol Alpha", "H-Coil"]), ("p2", ["Protocol Beta", None])]
+
+def test_build_snapshot_indexes_by_diagnosis_and_protocol_id():
+    snapshot = build_snapshot("gen-1", LIST_RECORDS, COMPARE_ROWS)
+
+    assert [card["id"] for card in snapshot.list_cards()] == ["p1", "p2", "p3"]
+    assert [card["id"] for card in snapshot.list_cards(" Major Depressive Disorder ")] == ["p1", "p2"]
+    assert [card["id"] for card in snapshot.list_cards("TRD")] == ["p1"]
+    assert snapshot.list_cards("unknown") == []
+
+    # UNWIND semantics: request order, all rows per protocol, unknown ids skipped
+    assert snapshot.compare_rows(["p2", "missing", "p1"]) == [
+        ["Protocol Beta", None], ["Protocol Alpha", "Figure-8"], ["Protocol Alpha", "H-Coil"],
+    ]
+
+def test_snapshot_engine_reloads_only_when_generation_changes():
+    generations = ["gen-1"]
+    loads = []
+
+    async def load_generation():
+        return generations[-1]
+
+    async def load_snapshot(generation):
+        loads.append(generation)
+        return GraphSnapshot(generation=generation)
+
+    async def scenario():
+        engine = SnapshotEngine(load_generation, load_snapshot, max_age_seconds=3600)
+        assert await engine.refresh() is True
+        assert await engine.refresh() is False # Same generation
+        generations.append("gen-2")
+        assert await engine.refresh() is True
+        assert engine.snapshot.generation == "gen-2"
+        assert await engine.refresh(force=True) is True
+        return engine
+
+    asyncio.run(scenario())
+    assert loads == ["gen-1", "gen-2", "gen-2"]
+
+def test_snapshot_engine_reloads_unstamped_or_expired_graphs():
+    loads = []
+
+    async def load_generation():
+        return None # Graph seeded without a generation stamp
+
+    async def load_snapshot(generation):
+        loads.append(generation)
+        return GraphSnapshot(generation=generation)
+
+    async def scenario():
+        engine = SnapshotEngine(load_generation, load_snapshot)
+        await engine.refresh()
+        await engine.refresh()
+
+    asyncio.run(scenario())
+    assert len(loads) == 2 # Nothing to compare against, so every refresh reloads
+
+    engine = SnapshotEngine(load_generation, load_snapshot, max_age_seconds=0)
+    engine.snapshot = GraphSnapshot(generation="gen-1")
+    assert engine.is_stale("gen-1")